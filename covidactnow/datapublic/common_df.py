@@ -2,11 +2,15 @@
 Shared code that handles `pandas.DataFrames` objects.
 """
 
+import gzip
 import pathlib
-from typing import TextIO, Union, List
+from typing import TextIO, Union, List, Optional
 
 import pandas as pd
 import numpy as np
+from pandas.api.types import infer_dtype
+from pandas.api.types import is_float_dtype
+from pandas.api.types import is_object_dtype
 from structlog import stdlib
 
 from covidactnow.datapublic.common_fields import (
@@ -14,6 +18,7 @@ from covidactnow.datapublic.common_fields import (
     FieldName,
     COMMON_FIELDS_ORDER_MAP,
     COMMON_FIELDS_TIMESERIES_KEYS,
+    COMMON_LEGACY_REGION_FIELDS,
 )
 
 
@@ -26,7 +31,13 @@ def index_and_sort(
         if df.index.names != [None]:
             df = df.reset_index(inplace=False)
         df = df.set_index(index_names, inplace=False)
-    df = df.sort_index()
+    sorted_categories_index = _with_sorted_categories(df.index)
+    if sorted_categories_index is not df.index:
+        df = df.set_axis(sorted_categories_index, axis="index")
+    # Each of the following steps copies the entire DataFrame so they are skipped when they
+    # wouldn't change anything.
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index()
 
     if "index" in df.columns:
         # This is not expected in our normal code path but seems to sneak in occasionally
@@ -34,11 +45,29 @@ def index_and_sort(
         log.warning("Dropping column named 'index'")
         df = df.drop(columns="index")
 
-    df = sort_common_field_columns(df)
+    if _common_field_columns_order(df.columns) != list(df.columns):
+        df = sort_common_field_columns(df)
 
     return df
 
 
+def _with_sorted_categories(index: pd.Index) -> pd.Index:
+    """Return `index` with the categories of categorical levels in sorted order.
+
+    `sort_index` orders a categorical level by the order of its categories. Sorting the categories
+    makes the rows of a categorical index sorted the same as the rows of a `str` index.
+    """
+    if isinstance(index, pd.MultiIndex):
+        levels = [index.get_level_values(i) for i in range(index.nlevels)]
+        sorted_levels = [_with_sorted_categories(level) for level in levels]
+        if all(sorted_level is level for sorted_level, level in zip(sorted_levels, levels)):
+            return index
+        return pd.MultiIndex.from_arrays(sorted_levels, names=index.names)
+    if isinstance(index, pd.CategoricalIndex) and not index.categories.is_monotonic_increasing:
+        return index.reorder_categories(index.categories.sort_values())
+    return index
+
+
 def only_common_columns(df: pd.DataFrame, log: stdlib.BoundLogger) -> pd.DataFrame:
     """Return a DataFrame with columns not in CommonFields dropped."""
     extra_columns = {col for col in df.columns if CommonFields.get(col) is None}
@@ -53,39 +82,135 @@ def write_csv(
     path: pathlib.Path,
     log: stdlib.BoundLogger,
     index_names: List[str] = COMMON_FIELDS_TIMESERIES_KEYS,
+    *,
+    chunk_rows: Optional[int] = None,
 ) -> None:
-    """Write `df` to `path` as a CSV with index set by `index_and_sort`."""
+    """Write `df` to `path` as a CSV with index set by `index_and_sort`.
+
+    Region columns may have dtype `category`, as returned by `read_csv` with `categorical_regions`.
+
+    Args:
+        df: DataFrame to write
+        path: Path of the output. If it ends with `.gz` the output is gzip compressed.
+        log: Logger
+        index_names: Names of the index columns, which are the first columns of the output
+        chunk_rows: If set, format and write at most this many rows at a time so that the memory
+          used for the formatted output is bounded. The output is the same as without it.
+    """
     df = index_and_sort(df, index_names, log)
     log.info("Writing DataFrame", current_index=df.index.names)
-    # A column with floats and pd.NA (which is different from np.nan) is given type 'object' and does
-    # not get formatted by to_csv float_format. Changing the pd.NA to np.nan seems to let convert_dtypes
-    # to change 'object' columns to 'float64' and 'Int64'.
-    df = df.replace({pd.NA: np.nan}).convert_dtypes()
+    df = _convert_dtypes_for_csv(df)
     # Format that outputs floats without a fraction as an integer without decimal point. Very large and small
     # floats (uncommon in our data) are output in exponent format. We currently output a large number of fractional
     # sig digits; 7 is likely enough but I don't see a way to limit them when formatting output.
-    df.to_csv(path, date_format="%Y-%m-%d", index=True, float_format="%.12g")
+    to_csv_kwargs = dict(date_format="%Y-%m-%d", index=True, float_format="%.12g")
+    if chunk_rows is None:
+        df.to_csv(path, **to_csv_kwargs)
+        return
+
+    # Open the file here, instead of passing the path to to_csv, so the chunks are appended to
+    # one stream and compressed as they are written. newline="" matches how to_csv opens a path.
+    if pathlib.Path(path).suffix == ".gz":
+        output = gzip.open(path, "wt", newline="")
+    else:
+        output = open(path, "w", newline="")
+    with output:
+        # Always write at least one chunk so that the header is written for an empty `df`.
+        for start in range(0, max(len(df), 1), chunk_rows):
+            df.iloc[start : start + chunk_rows].to_csv(output, header=(start == 0), **to_csv_kwargs)
+
+
+def _convert_column_for_csv(column: pd.Series) -> Optional[pd.Series]:
+    """Return `column` converted to the dtype used when writing a CSV or None if it is unchanged.
+
+    A column with floats and pd.NA (which is different from np.nan) is given type 'object' and does
+    not get formatted by to_csv float_format. Changing the pd.NA to np.nan seems to let
+    convert_dtypes to change 'object' columns to 'float64' and 'Int64'. Float columns with only
+    integer values are changed to 'Int64' so large values are not output in exponent format.
+    """
+    if is_object_dtype(column.dtype):
+        if infer_dtype(column, skipna=True) in ("string", "empty"):
+            # Already output the same as the 'string' dtype from convert_dtypes.
+            return None
+        converted = column.replace({pd.NA: np.nan}).convert_dtypes()
+    elif is_float_dtype(column.dtype):
+        converted = column.convert_dtypes()
+    else:
+        # Other dtypes are output the same as after convert_dtypes.
+        return None
+    if converted.dtype == column.dtype:
+        return None
+    return converted
+
+
+def _convert_dtypes_for_csv(df: pd.DataFrame) -> pd.DataFrame:
+    """Return `df` with the same values as `df.replace({pd.NA: np.nan}).convert_dtypes()`.
+
+    Only columns with a dtype that is changed are copied, one at a time, instead of copying all of
+    `df` twice. `df` is not modified.
+    """
+    converted_columns = {}
+    for i in range(len(df.columns)):
+        converted = _convert_column_for_csv(df.iloc[:, i])
+        if converted is not None:
+            converted_columns[i] = converted
+    if not converted_columns:
+        return df
+
+    # Replace the converted columns in a shallow copy. Deleting a column before inserting the new
+    # one makes pandas add a new block instead of writing into an array shared with `df`.
+    df = df.copy(deep=False)
+    for i, converted in converted_columns.items():
+        column_name = df.columns[i]
+        del df[column_name]
+        df.insert(i, column_name, converted)
+    return df
 
 
 # Alias to support old name. Please `import common_df` and call `common_df.write_csv(...)`.
 write_df_as_csv = write_csv
 
 
-def read_csv(path_or_buf: Union[pathlib.Path, TextIO], set_index: bool = True) -> pd.DataFrame:
+def write_parquet(
+    df: pd.DataFrame,
+    path: pathlib.Path,
+    log: stdlib.BoundLogger,
+    index_names: List[str] = COMMON_FIELDS_TIMESERIES_KEYS,
+) -> None:
+    """Write `df` to `path` as a Parquet file with index set by `index_and_sort`.
+
+    This is the same DataFrame that `write_csv` writes but the dtypes are stored in the file so
+    `read_parquet` returns it without parsing dates and numbers. Requires the `pyarrow` package.
+    """
+    df = index_and_sort(df, index_names, log)
+    log.info("Writing DataFrame", current_index=df.index.names, format="parquet")
+    df.to_parquet(path)
+
+
+def read_csv(
+    path_or_buf: Union[pathlib.Path, TextIO],
+    set_index: bool = True,
+    *,
+    categorical_regions: bool = False,
+) -> pd.DataFrame:
     """Read `path_or_buf` containing CommonFields and return a DataFrame with index optionally set.
 
     Args:
         path_or_buf: Path to csv file, or buffer containing csv timseries data.
         set_index: If True, sets index to common fields timeseries_keys.
+        categorical_regions: If True, read the region columns in `COMMON_LEGACY_REGION_FIELDS` with
+          dtype `category`, which uses much less memory and makes comparisons faster than `str`.
+          The categories of each file are the values found in it; `pd.concat` of DataFrames with
+          different categories returns `object` columns so combine them with
+          `pandas.api.types.union_categoricals`.
 
     Returns: DataFrame of timeseries data.
     """
-    data = pd.read_csv(
-        path_or_buf,
-        parse_dates=[CommonFields.DATE],
-        dtype={CommonFields.FIPS: str},
-        low_memory=False,
-    )
+    if categorical_regions:
+        dtype = {field: "category" for field in COMMON_LEGACY_REGION_FIELDS}
+    else:
+        dtype = {CommonFields.FIPS: str}
+    data = pd.read_csv(path_or_buf, parse_dates=[CommonFields.DATE], dtype=dtype, low_memory=False,)
 
     if set_index:
         return data.set_index(COMMON_FIELDS_TIMESERIES_KEYS)
@@ -97,6 +222,23 @@ def read_csv(path_or_buf: Union[pathlib.Path, TextIO], set_index: bool = True) -
 read_csv_to_indexed_df = read_csv
 
 
+def read_parquet(path: pathlib.Path, set_index: bool = True) -> pd.DataFrame:
+    """Read a file written by `write_parquet` and return a DataFrame with index optionally set.
+
+    Args:
+        path: Path to parquet file.
+        set_index: If True, keep the index that was written, usually common fields timeseries_keys.
+
+    Returns: DataFrame of timeseries data.
+    """
+    data = pd.read_parquet(path)
+
+    if set_index:
+        return data
+
+    return data.reset_index()
+
+
 def strip_whitespace(df: pd.DataFrame) -> pd.DataFrame:
     """Return `df` with `str.strip` applied to columns with `object` dtype."""
 
@@ -111,11 +253,15 @@ def strip_whitespace(df: pd.DataFrame) -> pd.DataFrame:
 
 def sort_common_field_columns(df: pd.DataFrame) -> pd.DataFrame:
     """Sort columns to match the order of CommonFields, followed by remaining columns in alphabetical order."""
+    return df.loc[:, _common_field_columns_order(df.columns)]
+
+
+def _common_field_columns_order(columns: pd.Index) -> List:
     this_columns_order = {
         col: COMMON_FIELDS_ORDER_MAP.get(col, i + len(COMMON_FIELDS_ORDER_MAP))
-        for i, col in enumerate(sorted(df.columns))
+        for i, col in enumerate(sorted(columns))
     }
-    return df.loc[:, sorted(df.columns, key=lambda c: this_columns_order[c])]
+    return sorted(columns, key=lambda c: this_columns_order[c])
 
 
 def get_timeseries(data: pd.DataFrame, field: FieldName, default: pd.Series) -> pd.Series:
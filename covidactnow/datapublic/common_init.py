@@ -20,6 +20,12 @@ class Environment(str, enum.Enum):
     STAGING = "staging"  # Not used as of 2020-06-23
 
 
+# Handler added to the root logger by `configure_logging`, so that calling it again in the same
+# process, as done by the updaters run in a scripts/update_pipeline.py worker, doesn't duplicate
+# every log line.
+_root_handler: Optional[logging.Handler] = None
+
+
 def configure_logging(command: Optional[str] = None):
     """Configure stdlib logging and structlog, and if SENTRY_DSN is set, Sentry.
 
@@ -64,11 +70,15 @@ def configure_logging(command: Optional[str] = None):
         ],
     )
 
+    global _root_handler
     handler = logging.StreamHandler()
     handler.setFormatter(formatter)
 
     root_logger = logging.getLogger()
+    if _root_handler is not None:
+        root_logger.removeHandler(_root_handler)
     root_logger.addHandler(handler)
+    _root_handler = handler
     root_logger.setLevel(logging.INFO)
 
     # Initialize sentry_sdk.
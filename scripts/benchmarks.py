@@ -0,0 +1,437 @@
+"""Benchmarks of the data loading and transform helpers, run on synthetic data.
+
+These are not run by the update jobs or tests. Run a benchmark with, for example,
+`python scripts/benchmarks.py ccd-query --rows 20000000`.
+"""
+import concurrent.futures
+import contextlib
+import dataclasses
+import itertools
+import multiprocessing
+import pathlib
+import resource
+import tempfile
+import time
+import tracemalloc
+from typing import Iterator, List, Optional, Tuple
+
+import click
+import numpy as np
+import pandas as pd
+import structlog
+
+from covidactnow.datapublic import common_df
+from covidactnow.datapublic import common_init
+from covidactnow.datapublic.common_fields import CommonFields
+from scripts import ccd_helpers
+from scripts import helpers
+from scripts import update_aws_lake
+
+Fields = ccd_helpers.Fields
+
+_logger = structlog.getLogger()
+
+
+@contextlib.contextmanager
+def _timer(name: str, **kwargs) -> Iterator[None]:
+    start = time.perf_counter()
+    yield
+    _logger.info("Timed", name=name, seconds=round(time.perf_counter() - start, 3), **kwargs)
+
+
+@contextlib.contextmanager
+def _timer_and_peak_memory(name: str, **kwargs) -> Iterator[None]:
+    """Logs the time and peak memory allocated, including by numpy, while in the context."""
+    tracemalloc.start()
+    try:
+        with _timer(name, **kwargs):
+            yield
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    _logger.info("Peak memory", name=name, mib=round(peak / 2 ** 20, 1))
+
+
+def _synthetic_can_scrape_df(rows: int, seed: int = 0) -> pd.DataFrame:
+    """Returns a DataFrame with the columns and a similar distribution of values to the can-scrape
+    parquet file."""
+    rng = np.random.default_rng(seed)
+
+    def choice(values: List[str], first_weight: float = 0.0) -> pd.Series:
+        # Most demographic rows are "all" so optionally give the first value a larger weight.
+        weights = np.full(len(values), (1 - first_weight) / len(values))
+        weights[0] += first_weight
+        # Build from category codes so each distinct value is a single shared object.
+        codes = rng.choice(len(values), rows, p=weights)
+        return pd.Categorical.from_codes(codes, categories=values).astype(object)
+
+    state_fips = list(range(1, 57))
+    county_fips = list(range(1001, 57000, 7))
+    locations = rng.choice(np.array(state_fips + county_fips, dtype=np.int64), rows)
+    return pd.DataFrame(
+        {
+            Fields.PROVIDER: choice(["state", "cdc", "hhs", "usafacts", "ctp"]),
+            Fields.DATE: pd.Timestamp("2020-03-01")
+            + pd.to_timedelta(rng.integers(0, 400, rows), unit="D"),
+            Fields.LOCATION_TYPE: np.where(locations < 100, "state", "county"),
+            Fields.LOCATION: locations,
+            Fields.VARIABLE_NAME: choice([f"variable_{i}" for i in range(60)]),
+            Fields.MEASUREMENT: choice(["cumulative", "current", "new", "rolling_average_7_day"]),
+            Fields.UNIT: choice(["people", "specimens", "beds", "doses", "percentage"]),
+            Fields.AGE: choice(["all", "0-17", "18-64", "65_plus"], 0.8),
+            Fields.RACE: choice(["all", "white", "black", "asian"], 0.8),
+            Fields.SEX: choice(["all", "male", "female"], 0.8),
+            Fields.VALUE: rng.random(rows) * 1000,
+        }
+    )
+
+
+def _synthetic_variables(count: int) -> List[ccd_helpers.ScraperVariable]:
+    combinations = itertools.product(
+        [f"variable_{i}" for i in range(60)], ["cumulative", "current"], ["people", "beds"]
+    )
+    return [
+        ccd_helpers.ScraperVariable(
+            variable_name=variable_name,
+            provider="state",
+            measurement=measurement,
+            unit=unit,
+            common_field=CommonFields.CASES,
+        )
+        for variable_name, measurement, unit in itertools.islice(combinations, count)
+    ]
+
+
+def _get_rows_with_masks(
+    all_df: pd.DataFrame, variable: ccd_helpers.ScraperVariable
+) -> pd.DataFrame:
+    """Copy of `CovidCountyDataset._get_rows` before the `VariableIndex` was added."""
+    is_selected_data = (
+        (all_df[Fields.PROVIDER] == variable.provider)
+        & (all_df[Fields.VARIABLE_NAME] == variable.variable_name)
+        & (all_df[Fields.AGE] == variable.age)
+        & (all_df[Fields.RACE] == variable.race)
+        & (all_df[Fields.SEX] == variable.sex)
+    )
+    if variable.measurement:
+        is_selected_data = is_selected_data & (all_df[Fields.MEASUREMENT] == variable.measurement)
+    if variable.unit:
+        is_selected_data = is_selected_data & (all_df[Fields.UNIT] == variable.unit)
+    return all_df.loc[is_selected_data, :].copy()
+
+
+def _synthetic_county_timeseries_df(counties: int, days: int, seed: int = 0) -> pd.DataFrame:
+    """Returns a DataFrame similar to a county level timeseries-common.csv, with the index unset."""
+    rng = np.random.default_rng(seed)
+    fips = [f"{i:05}" for i in range(1001, 1001 + counties)]
+    dates = pd.date_range("2020-03-01", periods=days)
+    index = pd.MultiIndex.from_product([fips, dates], names=[CommonFields.FIPS, CommonFields.DATE])
+    rows = len(index)
+    df = pd.DataFrame(index=index).reset_index()
+    df[CommonFields.STATE] = df[CommonFields.FIPS].str[:2]
+    df[CommonFields.COUNTRY] = "USA"
+    df[CommonFields.AGGREGATE_LEVEL] = "county"
+    for field in [CommonFields.CASES, CommonFields.DEATHS, CommonFields.TOTAL_TESTS]:
+        df[field] = rng.integers(0, 100_000, rows).astype(float)
+    for field in [CommonFields.TEST_POSITIVITY_7D, CommonFields.CURRENT_ICU]:
+        values = rng.random(rows) * 100
+        values[rng.random(rows) < 0.3] = np.nan
+        df[field] = values
+    return df
+
+
+def _write_synthetic_parquet(path: pathlib.Path, rows: int) -> None:
+    df = _synthetic_can_scrape_df(rows)
+    # Cluster rows by provider and variable so that row group statistics are useful, as they are
+    # expected to be in the real file which is written from a database query.
+    df = df.sort_values([Fields.PROVIDER, Fields.VARIABLE_NAME], kind="mergesort")
+    df.to_parquet(path, row_group_size=1_000_000)
+
+
+def _read_parquet_and_measure(
+    path: pathlib.Path, variables: Optional[List[ccd_helpers.ScraperVariable]]
+) -> Tuple[float, int, int]:
+    """Returns seconds to read `path`, the number of rows and the peak RSS of the process in KiB."""
+    start = time.perf_counter()
+    df = ccd_helpers.read_parquet(path, variables)
+    seconds = time.perf_counter() - start
+    return seconds, len(df), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _run_in_new_process(fn, *args):
+    """Runs `fn` in a fresh interpreter so that the peak RSS it reports is not polluted by this
+    process."""
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(fn, *args).result()
+
+
+def _write_csv_with_full_copies(df: pd.DataFrame, path: pathlib.Path) -> None:
+    """Copy of `common_df.write_csv` before the copies were reduced, for an unindexed `df`."""
+    df = df.set_index([CommonFields.FIPS, CommonFields.DATE])
+    df = df.sort_index()
+    df = common_df.sort_common_field_columns(df)
+    df = df.replace({pd.NA: np.nan}).convert_dtypes()
+    df.to_csv(path, date_format="%Y-%m-%d", index=True, float_format="%.12g")
+
+
+def _write_synthetic_covidcast_parts(
+    source_dir: pathlib.Path, parts: int, rows_per_part: int, seed: int = 0
+) -> List[pathlib.Path]:
+    """Writes JSON lines files similar to the parts of a covidcast source in the AWS data lake."""
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(parts):
+        geo_values = rng.choice(np.arange(1001, 57000, 7), rows_per_part)
+        part_df = pd.DataFrame(
+            {
+                "geo_value": geo_values,
+                "signal": rng.choice([f"smoothed_signal_{s}" for s in range(8)], rows_per_part),
+                "time_value": (
+                    pd.Timestamp("2020-04-01")
+                    + pd.to_timedelta(rng.integers(0, 200, rows_per_part), unit="D")
+                )
+                .strftime("%Y%m%d")
+                .astype(int),
+                "direction": None,
+                "sample_size": rng.integers(100, 5000, rows_per_part),
+                "stderr": rng.random(rows_per_part),
+                "time_type": "day",
+                "geo_type": "county",
+                "value": rng.random(rows_per_part) * 10,
+                "data_source": "fb-survey",
+            }
+        )
+        path = source_dir / f"part-{i:05}.json"
+        part_df.to_json(path, orient="records", lines=True)
+        paths.append(path)
+    return paths
+
+
+def _load_json_lines_with_append(source_files: List[pathlib.Path]) -> pd.DataFrame:
+    """Copy of `AwsDataLakeTransformer._load_json_lines` before parts were concatenated once."""
+    Fields = update_aws_lake.Fields
+    combined_df = pd.DataFrame()
+    for f in source_files:
+        part_df = pd.read_json(f, lines=True)
+        part_df[Fields.TIME_VALUE] = pd.to_datetime(part_df[Fields.TIME_VALUE], format="%Y%m%d")
+        combined_df = combined_df.append(part_df, ignore_index=True)
+    return combined_df.loc[:, list(Fields)]
+
+
+def _make_column_per_signal_with_unstack(combined_df: pd.DataFrame) -> pd.DataFrame:
+    """Copy of `AwsDataLakeTransformer._make_column_per_signal` before it was rewritten, without
+    the check for duplicates."""
+    Fields = update_aws_lake.Fields
+    grouped = combined_df.groupby(
+        [Fields.GEO_TYPE, Fields.GEO_VALUE, Fields.TIME_TYPE, Fields.TIME_VALUE, Fields.SIGNAL],
+        observed=True,
+    )
+    unstacked_df = grouped.last().unstack()
+    unstacked_df.columns = unstacked_df.columns.droplevel().astype(object)
+    return unstacked_df.reset_index()
+
+
+def _query_multiple_variables_with_pivot_table(
+    dataset: ccd_helpers.CovidCountyDataset, variables: List[ccd_helpers.ScraperVariable]
+) -> pd.DataFrame:
+    """Copy of `CovidCountyDataset.query_multiple_variables` before `pivot_variables` was added."""
+    positions = [dataset._index.positions(v) for v in variables]
+    combined_df = dataset.timeseries_df.take(np.concatenate(positions))
+    combined_df[Fields.VARIABLE_NAME] = np.concatenate(
+        [np.full(len(p), v.common_field, dtype=object) for v, p in zip(variables, positions)]
+    )
+    data = combined_df.pivot_table(
+        index=[Fields.LOCATION, Fields.DATE, Fields.LOCATION_TYPE],
+        columns=Fields.VARIABLE_NAME,
+        values=Fields.VALUE,
+    ).reset_index()
+    data = data.rename(
+        columns={
+            Fields.LOCATION: CommonFields.FIPS,
+            Fields.DATE: CommonFields.DATE,
+            Fields.LOCATION_TYPE: CommonFields.AGGREGATE_LEVEL,
+        }
+    )
+    data.columns.name = None
+    return data
+
+
+@click.group()
+def main():
+    common_init.configure_logging()
+
+
+@main.command()
+@click.option("--rows", default=20_000_000, show_default=True)
+@click.option("--variables", default=35, show_default=True)
+def ccd_query(rows: int, variables: int):
+    """Compare boolean mask scans with the VariableIndex of CovidCountyDataset."""
+    scraper_variables = _synthetic_variables(variables)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        parquet_path = pathlib.Path(tmp_dir) / "can_scrape.parquet"
+        _write_synthetic_parquet(parquet_path, rows)
+        all_df = pd.read_parquet(parquet_path)
+
+    with _timer("masks: select rows", rows=rows, variables=variables):
+        mask_rows = [_get_rows_with_masks(all_df, v) for v in scraper_variables]
+
+    with _timer("index: build", rows=rows):
+        dataset = ccd_helpers.CovidCountyDataset(all_df)
+    with _timer("index: select rows", rows=rows, variables=variables):
+        index_rows = [dataset._get_rows(v) for v in scraper_variables]
+    with _timer("index: query_multiple_variables", rows=rows, variables=variables):
+        dataset.query_multiple_variables(scraper_variables)
+    with _timer("index: query_multiple_variables with coverage", rows=rows, variables=variables):
+        dataset.query_multiple_variables(scraper_variables, log_provider_coverage_warnings=True)
+
+    assert [len(df) for df in mask_rows] == [len(df) for df in index_rows]
+
+
+@main.command()
+@click.option("--rows", default=20_000_000, show_default=True)
+def ccd_load(rows: int):
+    """Compare reading the entire can-scrape parquet with reading rows of a few variables."""
+    variables = [dataclasses.replace(v, provider="cdc") for v in _synthetic_variables(4)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        parquet_path = pathlib.Path(tmp_dir) / "can_scrape.parquet"
+        _write_synthetic_parquet(parquet_path, rows)
+        for name, load_variables in [("full", None), ("filtered", variables)]:
+            seconds, loaded_rows, peak_rss_kib = _run_in_new_process(
+                _read_parquet_and_measure, parquet_path, load_variables
+            )
+            _logger.info(
+                "Loaded parquet",
+                name=name,
+                seconds=round(seconds, 3),
+                loaded_rows=loaded_rows,
+                peak_rss_mib=peak_rss_kib // 1024,
+            )
+
+
+@main.command()
+@click.option("--rows", default=20_000_000, show_default=True)
+def fips_from_int(rows: int):
+    """Compare formatting every FIPS with helpers.fips_from_int."""
+    locations = _synthetic_can_scrape_df(rows)[Fields.LOCATION]
+
+    with _timer("per row apply", rows=rows):
+        per_row = locations.apply(lambda v: f"{v:0>{2 if v < 100 else 5}}")
+    with _timer("fips_from_int", rows=rows):
+        vectorized = helpers.fips_from_int(locations)
+    with _timer("fips_from_int categorical", rows=rows):
+        helpers.fips_from_int(locations, categorical=True)
+
+    pd.testing.assert_series_equal(per_row, vectorized)
+
+
+@main.command()
+@click.option("--counties", default=3200, show_default=True)
+@click.option("--days", default=365, show_default=True)
+def common_df_formats(counties: int, days: int):
+    """Compare writing and reading a timeseries as CSV and Parquet with common_df."""
+    df = _synthetic_county_timeseries_df(counties, days)
+    log = structlog.get_logger()
+    formats = [
+        ("csv", common_df.write_csv, common_df.read_csv),
+        ("parquet", common_df.write_parquet, common_df.read_parquet),
+    ]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, write, read in formats:
+            path = pathlib.Path(tmp_dir) / f"timeseries.{name}"
+            with _timer(f"{name}: write", rows=len(df)):
+                write(df, path, log)
+            with _timer(f"{name}: read", rows=len(df)):
+                read(path)
+            _logger.info("File size", name=name, mib=round(path.stat().st_size / 2 ** 20, 1))
+
+
+@main.command()
+@click.option("--counties", default=3200, show_default=True)
+@click.option("--days", default=365, show_default=True)
+def write_csv(counties: int, days: int):
+    """Compare common_df.write_csv before and after removing copies of the DataFrame."""
+    df = _synthetic_county_timeseries_df(counties, days)
+    # Most updaters pass a DataFrame that is already indexed and sorted.
+    indexed_df = df.set_index([CommonFields.FIPS, CommonFields.DATE])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = pathlib.Path(tmp_dir) / "timeseries.csv"
+        with _timer_and_peak_memory("full copies", rows=len(df)):
+            _write_csv_with_full_copies(df, path)
+        expected = path.read_text()
+        with _timer_and_peak_memory("write_csv", rows=len(df)):
+            common_df.write_csv(indexed_df, path, structlog.get_logger())
+        assert path.read_text() == expected
+
+
+@main.command()
+@click.option("--parts", default=200, show_default=True)
+@click.option("--rows-per-part", default=5000, show_default=True)
+@click.option("--workers", default=4, show_default=True)
+def aws_lake_load(parts: int, rows_per_part: int, workers: int):
+    """Compare loading covidcast JSON parts with DataFrame.append and with the streaming parser."""
+    log = structlog.get_logger()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = _write_synthetic_covidcast_parts(pathlib.Path(tmp_dir), parts, rows_per_part)
+        rows = parts * rows_per_part
+        with _timer("append", rows=rows):
+            expected = _load_json_lines_with_append(paths)
+        for parse_workers in sorted({1, workers}):
+            transformer = update_aws_lake.AwsDataLakeTransformer(
+                geo_fields_to_common_fields=pd.DataFrame(), parse_workers=parse_workers
+            )
+            with _timer("streaming", rows=rows, parse_workers=parse_workers):
+                loaded = transformer._load_json_lines(log, paths)
+            categorical_fields = update_aws_lake.CATEGORICAL_FIELDS
+            pd.testing.assert_frame_equal(
+                loaded.astype({f: object for f in categorical_fields}), expected
+            )
+
+
+@main.command()
+@click.option("--parts", default=20, show_default=True)
+@click.option("--rows-per-part", default=100_000, show_default=True)
+def aws_lake_pivot(parts: int, rows_per_part: int):
+    """Compare making a column per signal with groupby and unstack and with the dense array."""
+    log = structlog.get_logger()
+    transformer = update_aws_lake.AwsDataLakeTransformer(geo_fields_to_common_fields=pd.DataFrame())
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = _write_synthetic_covidcast_parts(pathlib.Path(tmp_dir), parts, rows_per_part)
+        combined_df = transformer._load_json_lines(log, paths)
+    # Synthetic rows are drawn at random so drop duplicates, which are not expected.
+    combined_df = combined_df.drop_duplicates(
+        [f for f in update_aws_lake.Fields if f != update_aws_lake.Fields.VALUE]
+    )
+
+    with _timer_and_peak_memory("groupby and unstack", rows=len(combined_df)):
+        expected = _make_column_per_signal_with_unstack(combined_df)
+    with _timer_and_peak_memory("dense array", rows=len(combined_df)):
+        unstacked_df = transformer._make_column_per_signal(combined_df, log)
+    # Signal columns of the unstack are in the order they are found in the input.
+    pd.testing.assert_frame_equal(unstacked_df, expected, check_like=True, check_names=False)
+
+
+@main.command()
+@click.option("--rows", default=20_000_000, show_default=True)
+@click.option("--variables", default=35, show_default=True)
+def ccd_pivot(rows: int, variables: int):
+    """Compare query_multiple_variables with pivot_table and with the dense array."""
+    all_df = _synthetic_can_scrape_df(rows)
+    # Synthetic rows are drawn at random so drop duplicates, which are not expected.
+    all_df = all_df.drop_duplicates([f for f in Fields if f != Fields.VALUE])
+    # Give each variable its own column.
+    scraper_variables = [
+        dataclasses.replace(v, common_field=field)
+        for v, field in zip(_synthetic_variables(variables), CommonFields)
+    ]
+    dataset = ccd_helpers.CovidCountyDataset(all_df)
+
+    with _timer_and_peak_memory("pivot_table", rows=len(all_df), variables=variables):
+        expected = _query_multiple_variables_with_pivot_table(dataset, scraper_variables)
+    with _timer_and_peak_memory("dense array", rows=len(all_df), variables=variables):
+        data = dataset.query_multiple_variables(scraper_variables)
+    pd.testing.assert_frame_equal(data, expected, check_column_type=False)
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
@@ -1,18 +1,29 @@
 """Helpers to access and query data surfaced from the scraped Covid County Data.
 """
+import collections
+import functools
+import operator
 import pathlib
+from typing import Dict
+from typing import FrozenSet
+from typing import Iterable
 from typing import List
+from typing import Tuple
 import enum
 import dataclasses
 from typing import Optional
 
 import more_itertools
-import requests
+import numpy as np
 import structlog
 import pandas as pd
+import pyarrow
+import pyarrow.dataset
+import pyarrow.parquet
 from covidactnow.datapublic.common_fields import FieldNameAndCommonField
 from covidactnow.datapublic.common_fields import GetByValueMixin
 from covidactnow.datapublic.common_fields import CommonFields
+from scripts import fetch_helpers
 from scripts import helpers
 
 DATA_ROOT = pathlib.Path(__file__).parent.parent / "data"
@@ -22,6 +33,9 @@ DATA_ROOT = pathlib.Path(__file__).parent.parent / "data"
 DATA_URL = "https://storage.googleapis.com/can-scrape-outputs/final/can_scrape_api_covid_us.parquet"
 DATA_PATH = DATA_ROOT / "can-scrape" / "can_scrape_api_covid_us.parquet"
 
+# Rows per record batch read by `scan_parquet`.
+SCAN_BATCH_ROWS = 256 * 1024
+
 
 _logger = structlog.getLogger()
 
@@ -44,6 +58,10 @@ class Fields(GetByValueMixin, FieldNameAndCommonField, enum.Enum):
     VALUE = "value", None
 
 
+# (provider, variable_name, age, race, sex) of a ScraperVariable.
+VariablePrefix = Tuple[str, str, str, str, str]
+
+
 @dataclasses.dataclass(frozen=True)
 class ScraperVariable:
     """Represents a specific variable scraped in CAN Scraper Dataset.
@@ -66,30 +84,102 @@ class ScraperVariable:
     race: str = "all"
     sex: str = "all"
 
+    @property
+    def prefix(self) -> VariablePrefix:
+        """Fields identifying the variable, not including the measurement and unit."""
+        return self.provider, self.variable_name, self.age, self.race, self.sex
+
+
+# Fields that identify the rows of one variable. The prefix without MEASUREMENT and UNIT is the key of
+# `VariableIndex`. Each value is one (measurement, unit) group within that prefix.
+_VARIABLE_PREFIX_FIELDS = [
+    Fields.PROVIDER,
+    Fields.VARIABLE_NAME,
+    Fields.AGE,
+    Fields.RACE,
+    Fields.SEX,
+]
+_VARIABLE_KEY_FIELDS = _VARIABLE_PREFIX_FIELDS + [Fields.MEASUREMENT, Fields.UNIT]
+
+
+@dataclasses.dataclass(frozen=True)
+class VariableIndex:
+    """Offsets of the rows of each variable in a DataFrame sorted by `_VARIABLE_KEY_FIELDS`.
+
+    Because MEASUREMENT and UNIT are the last sort keys every (measurement, unit) group of a
+    (provider, variable_name, age, race, sex) prefix is a contiguous slice of rows.
+    """
+
+    groups: Dict[VariablePrefix, List[Tuple[str, str, slice]]]
+
+    @staticmethod
+    def sort_and_build(df: pd.DataFrame) -> Tuple[pd.DataFrame, "VariableIndex"]:
+        """Returns `df` sorted by `_VARIABLE_KEY_FIELDS` and a VariableIndex of the sorted rows."""
+        # Factorize each key column and combine the small integer codes into a single int64 key
+        # so the sort and group boundary detection are done on one numeric array.
+        combined_key = np.zeros(len(df), dtype=np.int64)
+        radices = []
+        uniques = []
+        for field in _VARIABLE_KEY_FIELDS:
+            codes, field_uniques = pd.factorize(df[field], sort=True)
+            # factorize returns -1 for missing values; shift so that missing is code 0.
+            radix = len(field_uniques) + 1
+            assert np.prod(radices + [radix], dtype=float) < 2 ** 62, "Too many distinct keys"
+            combined_key = combined_key * radix + (codes + 1)
+            radices.append(radix)
+            uniques.append([None] + list(field_uniques))
+
+        order = np.argsort(combined_key, kind="stable")
+        sorted_key = combined_key[order]
+        # Every key is >= 0 so prepending -1 makes the first row the start of a group.
+        starts = np.flatnonzero(np.diff(sorted_key, prepend=-1))
+        stops = np.append(starts[1:], len(sorted_key))
+
+        # Decode the key of each group back to the code of every field.
+        group_codes = []
+        remaining = sorted_key[starts]
+        for radix in reversed(radices):
+            remaining, codes = np.divmod(remaining, radix)
+            group_codes.append(codes)
+        group_codes.reverse()
+
+        groups: Dict[VariablePrefix, List[Tuple[str, str, slice]]] = {}
+        for i, (start, stop) in enumerate(zip(starts.tolist(), stops.tolist())):
+            key = tuple(uniques[f][group_codes[f][i]] for f in range(len(_VARIABLE_KEY_FIELDS)))
+            *prefix, measurement, unit = key
+            groups.setdefault(tuple(prefix), []).append((measurement, unit, slice(start, stop)))
+
+        return df.take(order).reset_index(drop=True), VariableIndex(groups=groups)
+
+    def positions(self, variable: ScraperVariable) -> np.ndarray:
+        """Returns the positions of rows matching `variable`.
+
+        A falsy `measurement` or `unit` matches any value, as done by `CovidCountyDataset._get_rows`.
+        """
+        ranges = [
+            np.arange(rows.start, rows.stop)
+            for measurement, unit, rows in self.groups.get(variable.prefix, [])
+            if (not variable.measurement or variable.measurement == measurement)
+            and (not variable.unit or variable.unit == unit)
+        ]
+        if not ranges:
+            return np.array([], dtype=int)
+        return np.concatenate(ranges)
+
 
 @dataclasses.dataclass
 class CovidCountyDataset:
 
     timeseries_df: pd.DataFrame
 
-    def _get_rows(self, variable: ScraperVariable) -> pd.DataFrame:
-        all_df = self.timeseries_df
-
-        is_selected_data = (
-            (all_df[Fields.PROVIDER] == variable.provider)
-            & (all_df[Fields.VARIABLE_NAME] == variable.variable_name)
-            & (all_df[Fields.AGE] == variable.age)
-            & (all_df[Fields.RACE] == variable.race)
-            & (all_df[Fields.SEX] == variable.sex)
-        )
-        if variable.measurement:
-            is_selected_data = is_selected_data & (
-                all_df[Fields.MEASUREMENT] == variable.measurement
-            )
-        if variable.unit:
-            is_selected_data = is_selected_data & (all_df[Fields.UNIT] == variable.unit)
+    # Built once in __post_init__. `timeseries_df` is replaced by a copy sorted to match the index.
+    _index: VariableIndex = dataclasses.field(init=False, repr=False)
 
-        return all_df.loc[is_selected_data, :].copy()
+    def __post_init__(self):
+        self.timeseries_df, self._index = VariableIndex.sort_and_build(self.timeseries_df)
+
+    def _get_rows(self, variable: ScraperVariable) -> pd.DataFrame:
+        return self.timeseries_df.take(self._index.positions(variable))
 
     def query_multiple_variables(
         self, variables: List[ScraperVariable], *, log_provider_coverage_warnings: bool = False
@@ -99,11 +189,12 @@ class CovidCountyDataset:
         Args:
             variables: Variables to query
             log_provider_coverage_warnings: Log warnings when upstream data has variables not in
-              `variables` and hints when a variable has no data.
+              `variables` and hints when a variable has no data. See `check_variable_coverage`.
         """
         if log_provider_coverage_warnings:
             self.check_variable_coverage(variables)
-        selected_data = []
+        positions = []
+        variable_columns = []
 
         for variable in variables:
             # Check that `variable` agrees with stuff in the ScraperVariable docstring.
@@ -116,63 +207,289 @@ class CovidCountyDataset:
                 assert variable.measurement
                 assert variable.unit
 
-            data = self._get_rows(variable)
-            if data.empty and log_provider_coverage_warnings:
-                _logger.info("No data rows found for variable", variable=variable)
-                more_data = self._get_rows(dataclasses.replace(variable, measurement="", unit=""))
-                _logger.info(
-                    "Try these parameters",
-                    variable_name=variable.variable_name,
-                    measurement_counts=str(more_data[Fields.MEASUREMENT].value_counts().to_dict()),
-                    unit_counts=str(more_data[Fields.UNIT].value_counts().to_dict()),
-                )
-
-            # Rename fields if common field name exists
-            if variable.common_field:
-                data.loc[:, Fields.VARIABLE_NAME] = variable.common_field
-
-            selected_data.append(data)
-
-        combined_df = pd.concat(selected_data)
-
-        wide_df = combined_df.pivot_table(
-            index=[Fields.LOCATION.value, Fields.DATE.value, Fields.LOCATION_TYPE.value],
-            columns=Fields.VARIABLE_NAME.value,
-            values=Fields.VALUE.value,
-        ).reset_index()
-
-        data = wide_df.rename(
+            positions.append(self._index.positions(variable))
+            # Rename fields to the common field name
+            variable_columns.append(variable.common_field)
+
+        # Copy only the columns used by the pivot, for the rows of all variables, in one batch.
+        pivot_fields = [Fields.LOCATION, Fields.DATE, Fields.LOCATION_TYPE, Fields.VALUE]
+        all_positions = np.concatenate(positions) if positions else np.array([], dtype=int)
+        long_df = self.timeseries_df.iloc[
+            all_positions, self.timeseries_df.columns.get_indexer(pivot_fields)
+        ]
+        # The output column of each row, as a position in `variable_columns`.
+        column_positions = np.repeat(np.arange(len(positions)), [len(p) for p in positions])
+
+        data = pivot_variables(long_df, column_positions, variable_columns)
+        return data.rename(
             columns={
-                Fields.LOCATION.value: CommonFields.FIPS,
-                Fields.DATE.value: CommonFields.DATE,
-                Fields.LOCATION_TYPE.value: CommonFields.AGGREGATE_LEVEL,
+                Fields.LOCATION: CommonFields.FIPS,
+                Fields.DATE: CommonFields.DATE,
+                Fields.LOCATION_TYPE: CommonFields.AGGREGATE_LEVEL,
             }
         )
-        data.columns.name = None
-        return data
+
+    def provider_coverage(
+        self, provider: str
+    ) -> Dict[Tuple[str, str, str, str], List[Tuple[str, str, slice]]]:
+        """Returns the rows of `provider` by variable, demographic, measurement and unit.
+
+        The groups of the VariableIndex are returned without scanning any rows or copying them.
+
+        Returns: Dict mapping (variable_name, age, race, sex) to a list of
+          (measurement, unit, slice of rows) tuples
+        """
+        return {
+            prefix[1:]: groups
+            for prefix, groups in self._index.groups.items()
+            if prefix[0] == provider
+        }
 
     def check_variable_coverage(self, variables: List[ScraperVariable]):
+        """Logs variables of the provider of `variables` that are not queried and hints for
+        queried variables without data, all counted from the groups of `provider_coverage`."""
         provider_name = more_itertools.one(set(v.provider for v in variables))
-        provider_mask = self.timeseries_df[Fields.PROVIDER] == provider_name
-        counts = self.timeseries_df.loc[provider_mask, Fields.VARIABLE_NAME].value_counts()
-        variables_by_name = {var.variable_name: var for var in variables}
-        for variable_name, count in counts.iteritems():
-            if variable_name not in variables_by_name:
+        coverage = self.provider_coverage(provider_name)
+
+        counts = collections.Counter()
+        for (variable_name, *_), groups in coverage.items():
+            counts[variable_name] += sum(rows.stop - rows.start for _, _, rows in groups)
+        variable_names = {var.variable_name for var in variables}
+        for variable_name, count in counts.most_common():
+            if variable_name not in variable_names:
                 _logger.info(
                     "Upstream has variable not in variables list",
                     variable_name=variable_name,
                     count=count,
                 )
 
+        for variable in variables:
+            if variable.common_field is None:
+                continue
+            groups = coverage.get(variable.prefix[1:], [])
+            if any(
+                (not variable.measurement or variable.measurement == measurement)
+                and (not variable.unit or variable.unit == unit)
+                for measurement, unit, _ in groups
+            ):
+                continue
+
+            measurement_counts = collections.Counter()
+            unit_counts = collections.Counter()
+            for measurement, unit, rows in groups:
+                measurement_counts[measurement] += rows.stop - rows.start
+                unit_counts[unit] += rows.stop - rows.start
+            _logger.info("No data rows found for variable", variable=variable)
+            _logger.info(
+                "Try these parameters",
+                variable_name=variable.variable_name,
+                measurement_counts=str(dict(measurement_counts.most_common())),
+                unit_counts=str(dict(unit_counts.most_common())),
+            )
+
     @staticmethod
-    def load(*, fetch: bool) -> "CovidCountyDataset":
-        """Loads CovidCountyData, performing minor cleanup."""
+    def load(
+        *, fetch: bool, variables: Optional[Iterable[ScraperVariable]] = None
+    ) -> "CovidCountyDataset":
+        """Loads CovidCountyData, performing minor cleanup.
+
+        Args:
+            fetch: If True, download the latest file before loading it.
+            variables: If set, only read rows that may be used to query `variables`.
+        """
 
         if fetch:
-            response = requests.get(DATA_URL)
-            DATA_PATH.write_bytes(response.content)
+            CovidCountyDataset.fetch()
+
+        return CovidCountyDataset.read(DATA_PATH, variables)
+
+    @staticmethod
+    def fetch():
+        """Downloads the latest can-scrape parquet file to DATA_PATH, if it changed.
+
+        The download is continued after a dropped connection and the existing file is only
+        replaced once the new one is complete and has a valid parquet footer.
+        """
+        fetch_helpers.fetch(
+            DATA_URL, DATA_PATH, log=_logger, validate=pyarrow.parquet.read_metadata
+        )
 
-        all_df = pd.read_parquet(DATA_PATH)
+    @staticmethod
+    def read(
+        path: pathlib.Path, variables: Optional[Iterable[ScraperVariable]] = None
+    ) -> "CovidCountyDataset":
+        """Reads a can-scrape parquet file, reusing a dataset already read from the same bytes.
+
+        The returned dataset may be shared with other callers so must not be modified.
+        """
+        file_hash = helpers.file_sha256(path)
+        prefixes = frozenset(v.prefix for v in variables) if variables is not None else None
+        # A dataset read without a filter contains the rows of every filtered read.
+        for cache_key in [(file_hash, None), (file_hash, prefixes)]:
+            if cache_key in _READ_CACHE:
+                _logger.info("Using cached CovidCountyDataset", path=str(path))
+                return _READ_CACHE[cache_key]
+
+        all_df = read_parquet(path, variables)
         all_df[Fields.LOCATION] = helpers.fips_from_int(all_df[Fields.LOCATION])
 
-        return CovidCountyDataset(all_df)
+        dataset = CovidCountyDataset(all_df)
+        _READ_CACHE[(file_hash, prefixes)] = dataset
+        return dataset
+
+    def select_rows(self, variables: Iterable[ScraperVariable]) -> pd.DataFrame:
+        """Returns a copy of the rows of `variables`, in the long format of the source file."""
+        positions = [self._index.positions(v) for v in variables]
+        return self.timeseries_df.take(np.concatenate(positions) if positions else [])
+
+
+def pivot_variables(
+    long_df: pd.DataFrame, column_positions: np.ndarray, columns: List[CommonFields]
+) -> pd.DataFrame:
+    """Returns a DataFrame with a row per location, date and location type and a column per field.
+
+    This does the same as `pivot_table` on the long rows, without its groupby machinery: the row
+    keys are factorized once and each value is copied directly into a preallocated matrix of rows
+    by columns. Rows are sorted by their keys, columns by name and, like `pivot_table`, rows with
+    a missing key are ignored and rows and columns without any value are dropped. Unlike
+    `pivot_table`, which averages them, duplicate values of a row and column are logged and the
+    last one is kept.
+
+    Args:
+        long_df: DataFrame with LOCATION, DATE, LOCATION_TYPE and VALUE columns
+        column_positions: For each row of `long_df`, the position of its field in `columns`
+        columns: Fields of the output columns. A field may appear more than once, in which case
+          the values of all its positions are combined in one column.
+    """
+    row_keys = [Fields.LOCATION, Fields.DATE, Fields.LOCATION_TYPE]
+    has_keys = np.logical_and.reduce([long_df[key].notna().to_numpy() for key in row_keys])
+    if not has_keys.all():
+        long_df = long_df.loc[has_keys]
+        column_positions = column_positions[has_keys]
+
+    # Factorize each row key, sorted so that rows are in the same order as pivot_table, and
+    # combine the codes into a single row code.
+    row_code = np.zeros(len(long_df), dtype="int64")
+    key_uniques = []
+    for key in row_keys:
+        codes, uniques = pd.factorize(long_df[key], sort=True)
+        row_code = row_code * len(uniques) + codes
+        key_uniques.append(uniques)
+    row_code, row_code_uniques = pd.factorize(row_code, sort=True)
+    column_names, column_code_by_position = np.unique(
+        np.array([str(c) for c in columns], dtype=object), return_inverse=True
+    )
+    column_code = column_code_by_position[column_positions] if len(columns) else column_positions
+    cell_code = row_code * len(column_names) + column_code
+
+    values = long_df[Fields.VALUE].to_numpy(dtype="float64")
+    # Like pivot_table, missing values are skipped.
+    is_selected = ~np.isnan(values)
+    is_duplicate = pd.Series(cell_code[is_selected]).duplicated(keep=False).to_numpy()
+    if is_duplicate.any():
+        duplicate_rows = long_df.loc[is_selected].loc[is_duplicate]
+        _logger.warning(
+            "Found duplicate values, keeping the last",
+            count=len(np.unique(cell_code[is_selected][is_duplicate])),
+            rows=duplicate_rows.head(10).to_dict(orient="records"),
+        )
+        is_selected[is_selected] = ~pd.Series(cell_code[is_selected]).duplicated(keep="last")
+
+    matrix = np.full(len(row_code_uniques) * len(column_names), np.nan)
+    matrix[cell_code[is_selected]] = values[is_selected]
+    matrix = matrix.reshape(len(row_code_uniques), len(column_names))
+
+    has_value = ~np.isnan(matrix)
+    keep_rows = has_value.any(axis=1)
+    keep_columns = has_value.any(axis=0)
+    if not keep_rows.all():
+        matrix = matrix[keep_rows]
+        row_code_uniques = row_code_uniques[keep_rows]
+    if not keep_columns.all():
+        matrix = matrix[:, keep_columns]
+        column_names = column_names[keep_columns]
+
+    # Wrap the matrix without copying it and add the row keys, decoded from the combined row code.
+    wide_df = pd.DataFrame(
+        matrix, columns=pd.Index([CommonFields(name) for name in column_names], dtype=object)
+    )
+    value_dtype = long_df[Fields.VALUE].dtype
+    if pd.api.types.is_integer_dtype(value_dtype):
+        # Like pivot_table, keep integer values in columns without a missing value as integers.
+        for column in wide_df.columns[~np.isnan(matrix).any(axis=0)]:
+            wide_df[column] = wide_df[column].astype(value_dtype)
+    remaining = row_code_uniques
+    for key, uniques in reversed(list(zip(row_keys, key_uniques))):
+        remaining, codes = np.divmod(remaining, len(uniques))
+        wide_df.insert(0, key, uniques.take(codes))
+    return wide_df
+
+
+# Datasets returned by `CovidCountyDataset.read`, keyed by the SHA-256 of the file and the
+# prefixes of the variables it was filtered by or None when not filtered.
+_READ_CACHE: Dict[Tuple[str, Optional[FrozenSet[VariablePrefix]]], CovidCountyDataset] = {}
+
+
+def _dataset_filter(variables: Iterable[ScraperVariable]) -> pyarrow.dataset.Expression:
+    """Returns a pyarrow dataset expression selecting rows of `variables`.
+
+    The expression doesn't include the measurement and unit so that rows with other values are
+    still available for the hints logged by `CovidCountyDataset.check_variable_coverage`.
+    """
+    prefix_expressions = [
+        functools.reduce(
+            operator.and_,
+            [
+                pyarrow.dataset.field(str(field.value)) == value
+                for field, value in zip(_VARIABLE_PREFIX_FIELDS, prefix)
+            ],
+        )
+        for prefix in sorted({v.prefix for v in variables})
+    ]
+    return functools.reduce(operator.or_, prefix_expressions)
+
+
+def scan_parquet(
+    path: pathlib.Path,
+    variables: Iterable[ScraperVariable],
+    *,
+    batch_rows: int = SCAN_BATCH_ROWS,
+) -> pd.DataFrame:
+    """Reads the `Fields` columns of the rows of `variables` from a can-scrape parquet file.
+
+    The file is scanned one record batch at a time and only the rows of each batch matching
+    `variables` are kept, so peak memory is bounded by a batch, and the row group it is decoded
+    from, plus the selected rows instead of by the size of the file. Row groups whose statistics
+    show that they contain none of `variables` are skipped without being read.
+    """
+    dataset = pyarrow.dataset.dataset(str(path), format="parquet")
+    columns = _parquet_columns()
+    variables = list(variables)
+    selected_batches = []
+    if variables:
+        batches = dataset.to_batches(
+            columns=columns, filter=_dataset_filter(variables), batch_size=batch_rows
+        )
+        selected_batches = [batch for batch in batches if batch.num_rows]
+    schema = pyarrow.schema([dataset.schema.field(column) for column in columns])
+    return pyarrow.Table.from_batches(selected_batches, schema=schema).to_pandas()
+
+
+def _parquet_columns() -> List[str]:
+    # pyarrow requires column names that are exactly `str`, not a subclass such as `Fields`.
+    return [str(f.value) for f in Fields]
+
+
+def read_parquet(
+    path: pathlib.Path, variables: Optional[Iterable[ScraperVariable]] = None
+) -> pd.DataFrame:
+    """Reads the `Fields` columns of a can-scrape parquet file.
+
+    Args:
+        path: Path of the parquet file
+        variables: If set, only rows that may be used to query `variables` are read, streaming
+          the file with `scan_parquet`. Otherwise the entire file is read.
+    """
+    if variables is not None:
+        return scan_parquet(path, variables)
+    return pd.read_parquet(path, columns=_parquet_columns())
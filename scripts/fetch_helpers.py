@@ -0,0 +1,313 @@
+"""Downloads source files over HTTP, skipping the body when the server says it is unchanged.
+
+The ETag, Last-Modified header and SHA-256 of each downloaded file are stored next to it in
+`<file name>.http.json`. The next fetch of the same URL sends them back as If-None-Match and
+If-Modified-Since so a server that supports conditional requests answers 304 Not Modified
+without a body. push_update.sh commits the metadata with the file so this works across runs of
+the update workflow.
+"""
+import base64
+import dataclasses
+import hashlib
+import json
+import pathlib
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+import requests
+import structlog
+
+from scripts import helpers
+
+
+METADATA_SUFFIX = ".http.json"
+# Seconds to wait for a connection and for each read of a response so a stuck server can't hang
+# the update.
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 120
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Attempts to download each file, including the first. Each attempt after a dropped connection
+# continues the partial file when the server supports Range requests.
+DOWNLOAD_ATTEMPTS = 3
+
+_logger = structlog.getLogger()
+
+_session: Optional[requests.Session] = None
+
+
+def get_session() -> requests.Session:
+    """Returns the Session shared by all fetches in this process, reusing pooled connections."""
+    global _session
+    if _session is None:
+        _session = requests.Session()
+    return _session
+
+
+@dataclasses.dataclass(frozen=True)
+class FetchResult:
+    path: pathlib.Path
+    # True if the file now has different contents than before the fetch.
+    changed: bool
+    # Bytes of response body read from the server by the attempt that finished the download.
+    bytes_downloaded: int
+    # Bytes not downloaded because the server answered 304 Not Modified.
+    bytes_saved: int
+
+
+def metadata_path(path: pathlib.Path) -> pathlib.Path:
+    """Returns the path of the file holding the HTTP metadata of `path`."""
+    return path.with_name(path.name + METADATA_SUFFIX)
+
+
+def _read_metadata(path: pathlib.Path, url: str) -> Dict[str, Any]:
+    """Returns the stored metadata of `path` if it was fetched from `url` and still exists."""
+    meta_path = metadata_path(path)
+    if not path.exists() or not meta_path.exists():
+        return {}
+    metadata = json.loads(meta_path.read_text())
+    if metadata.get("url") != url or metadata.get("size") != path.stat().st_size:
+        return {}
+    return metadata
+
+
+def _write_json(path: pathlib.Path, data: Dict[str, Any]) -> None:
+    path.write_text(json.dumps(data, indent=2, sort_keys=True) + "\n")
+
+
+def _file_digests(path: pathlib.Path) -> Tuple[str, str]:
+    """Returns the hex SHA-256 and base64 MD5, as found in the x-goog-hash header, of a file."""
+    sha256 = hashlib.sha256()
+    md5 = hashlib.md5()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+            md5.update(chunk)
+    return sha256.hexdigest(), base64.b64encode(md5.digest()).decode()
+
+
+def _goog_md5(headers) -> Optional[str]:
+    """Returns the MD5 of the whole object from a Google Cloud Storage x-goog-hash header."""
+    for part in headers.get("x-goog-hash", "").split(","):
+        name, _, value = part.strip().partition("=")
+        if name == "md5":
+            return value
+    return None
+
+
+class DownloadVerificationError(Exception):
+    """The downloaded file doesn't match the size or checksum sent by the server."""
+
+
+@dataclasses.dataclass(frozen=True)
+class _Download:
+    """Downloads a URL to a `.part` file, resuming a partial file left by an earlier attempt.
+
+    The URL, ETag and Last-Modified of the response that started the `.part` file are stored in
+    `<name>.part.json`. An attempt with an existing `.part` file sends a Range request for the
+    remaining bytes with If-Range, so the server only continues the file when it is unchanged
+    and otherwise sends the whole new body.
+    """
+
+    url: str
+    path: pathlib.Path
+    params: Any
+
+    @property
+    def part_path(self) -> pathlib.Path:
+        return self.path.with_name(self.path.name + ".part")
+
+    @property
+    def part_metadata_path(self) -> pathlib.Path:
+        return self.path.with_name(self.path.name + ".part.json")
+
+    def _resume_from(self) -> Tuple[int, Optional[str]]:
+        """Returns the offset to resume the download at and the validator sent as If-Range."""
+        if not self.part_path.exists() or not self.part_metadata_path.exists():
+            return 0, None
+        part_metadata = json.loads(self.part_metadata_path.read_text())
+        validator = part_metadata.get("etag") or part_metadata.get("last_modified")
+        if part_metadata.get("url") != self.url or not validator:
+            return 0, None
+        return self.part_path.stat().st_size, validator
+
+    def attempt(self, conditional_headers: Dict[str, str], log) -> Tuple[Any, int]:
+        """Downloads the rest of the `.part` file.
+
+        Returns: The response headers, or None when the server answered 304 Not Modified, and the
+          number of bytes of the `.part` file that were continued instead of downloaded again.
+        """
+        headers = dict(conditional_headers)
+        offset, validator = self._resume_from()
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = validator
+
+        with get_session().get(
+            self.url,
+            params=self.params,
+            headers=headers,
+            stream=True,
+            timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+        ) as response:
+            if response.status_code == requests.codes.not_modified:
+                # The complete file is current so a partial download left by an earlier attempt
+                # is not needed.
+                self.discard()
+                return None, 0
+            if offset and response.status_code == requests.codes.requested_range_not_satisfiable:
+                # The `.part` file is already as long as the file on the server.
+                log.info("Discarding partial download", offset=offset)
+                self.discard()
+                return self.attempt(conditional_headers, log)
+            response.raise_for_status()
+
+            if response.status_code == requests.codes.partial_content:
+                log.info("Resuming download", offset=offset)
+                mode = "ab"
+            else:
+                mode = "wb"
+                # Only a body sent without a content encoding can be continued with a Range.
+                if response.headers.get("Accept-Ranges") == "bytes" and not response.headers.get(
+                    "Content-Encoding"
+                ):
+                    _write_json(
+                        self.part_metadata_path,
+                        {
+                            "url": self.url,
+                            "etag": response.headers.get("ETag"),
+                            "last_modified": response.headers.get("Last-Modified"),
+                        },
+                    )
+                elif self.part_metadata_path.exists():
+                    self.part_metadata_path.unlink()
+                offset = 0
+
+            with self.part_path.open(mode) as f:
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+            return response.headers, offset
+
+    @staticmethod
+    def _expected_size(response_headers) -> Optional[int]:
+        if response_headers.get("Content-Encoding"):
+            return None
+        content_range = response_headers.get("Content-Range")
+        if content_range:
+            # For example "bytes 100-199/200"
+            total = content_range.rpartition("/")[2]
+            return int(total) if total != "*" else None
+        content_length = response_headers.get("Content-Length")
+        return int(content_length) if content_length else None
+
+    @staticmethod
+    def _expected_md5(response_headers) -> Optional[str]:
+        # With a content encoding, such as GCS decompressive transcoding, x-goog-hash is the MD5
+        # of the stored encoded object while the file has the decoded body.
+        if response_headers.get("Content-Encoding"):
+            return None
+        return _goog_md5(response_headers)
+
+    def verify(self, response_headers, validate: Optional[Callable[[pathlib.Path], None]]) -> str:
+        """Checks the complete `.part` file, removing it and raising if it doesn't match what the
+        server sent or isn't accepted by `validate`. Returns the SHA-256 of the file."""
+        try:
+            size = self.part_path.stat().st_size
+            expected_size = self._expected_size(response_headers)
+            if expected_size is not None and size != expected_size:
+                raise DownloadVerificationError(f"Expected {expected_size} bytes, got {size}")
+            sha256, md5 = _file_digests(self.part_path)
+            expected_md5 = self._expected_md5(response_headers)
+            if expected_md5 is not None and md5 != expected_md5:
+                raise DownloadVerificationError(f"Expected MD5 {expected_md5}, got {md5}")
+            if validate:
+                validate(self.part_path)
+        except Exception:
+            self.discard()
+            raise
+        return sha256
+
+    def discard(self):
+        for part_file in [self.part_path, self.part_metadata_path]:
+            if part_file.exists():
+                part_file.unlink()
+
+
+def fetch(
+    url: str,
+    path: pathlib.Path,
+    *,
+    log=_logger,
+    params=None,
+    validate: Optional[Callable[[pathlib.Path], None]] = None,
+    attempts: int = DOWNLOAD_ATTEMPTS,
+) -> FetchResult:
+    """Downloads `url` to `path` unless the server says it is unchanged since the last fetch.
+
+    The body is streamed in chunks to `<name>.part`, so large files are never held in memory.
+    When the connection drops the next attempt, or the next call after all attempts failed,
+    continues the `.part` file with a Range request if the server supports it. The complete file
+    is checked against the Content-Length and x-goog-hash MD5 sent by the server, which describe
+    the encoded body and are ignored when the response has a Content-Encoding, and by
+    `validate`, before it is renamed to `path`, so `path` is never a partial or corrupt file.
+
+    Args:
+        url: URL to download
+        path: Local file, replaced when the server returns a new body
+        log: Logger
+        params: Optional query parameters of the request
+        validate: Optional function raising an exception if the downloaded file is invalid
+        attempts: Attempts to download the file, including the first
+    """
+    log = log.bind(url=url, path=str(path))
+    metadata = _read_metadata(path, url)
+    previous_sha256 = metadata.get("sha256")
+    if previous_sha256 is None and path.exists():
+        previous_sha256 = helpers.file_sha256(path)
+    conditional_headers = {}
+    if metadata.get("etag"):
+        conditional_headers["If-None-Match"] = metadata["etag"]
+    if metadata.get("last_modified"):
+        conditional_headers["If-Modified-Since"] = metadata["last_modified"]
+
+    download = _Download(url, path, params)
+    for attempt in range(1, attempts + 1):
+        try:
+            response_headers, resumed_bytes = download.attempt(conditional_headers, log)
+            break
+        except (
+            requests.ConnectionError,
+            requests.Timeout,
+            # Raised when the connection drops while reading the body.
+            requests.exceptions.ChunkedEncodingError,
+        ) as e:
+            if attempt == attempts:
+                raise
+            log.warning("Retrying download", attempt=attempt, exception=repr(e))
+
+    if response_headers is None:
+        bytes_saved = metadata.get("size", 0)
+        log.info("Source not modified", bytes_saved=bytes_saved)
+        return FetchResult(path, changed=False, bytes_downloaded=0, bytes_saved=bytes_saved)
+
+    sha256 = download.verify(response_headers, validate)
+    size = download.part_path.stat().st_size
+    bytes_downloaded = size - resumed_bytes
+    download.part_path.replace(path)
+    download.discard()
+    _write_json(
+        metadata_path(path),
+        {
+            "url": url,
+            "etag": response_headers.get("ETag"),
+            "last_modified": response_headers.get("Last-Modified"),
+            "size": size,
+            "sha256": sha256,
+        },
+    )
+
+    changed = sha256 != previous_sha256
+    log.info("Fetched source", bytes_downloaded=bytes_downloaded, changed=changed)
+    return FetchResult(path, changed=changed, bytes_downloaded=bytes_downloaded, bytes_saved=0)
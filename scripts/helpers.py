@@ -1,10 +1,14 @@
 import datetime
+import functools
+import hashlib
 import pathlib
 import re
+from typing import Mapping
 from typing import MutableMapping
 from typing import Set
 from typing import Type
 
+import numpy as np
 import pandas as pd
 import pytz
 
@@ -70,6 +74,57 @@ def load_census_state(census_state_path: pathlib.Path) -> pd.DataFrame:
     return state_df
 
 
+@functools.lru_cache(maxsize=None)
+def load_region_metadata(
+    county_fips_csv: pathlib.Path, census_state_path: pathlib.Path
+) -> pd.DataFrame:
+    """Returns the state, county and aggregate level of every county and state, indexed by FIPS.
+
+    The table is read once per process and shared by every caller, so it must not be modified.
+    Attach it to data with `add_region_metadata`.
+
+    Args:
+        county_fips_csv: Path of fips_population.csv
+        census_state_path: Path of state.txt, copied from census.gov
+    """
+    Fields = common_fields.CommonFields
+    states = load_census_state(census_state_path).loc[:, [Fields.FIPS, Fields.STATE]]
+    states[Fields.AGGREGATE_LEVEL] = "state"
+    counties = load_county_fips_data(county_fips_csv).loc[
+        :, [Fields.FIPS, Fields.STATE, Fields.COUNTY]
+    ]
+    counties[Fields.AGGREGATE_LEVEL] = "county"
+    region_df = pd.concat([states, counties], ignore_index=True)
+    return region_df.set_index(Fields.FIPS, verify_integrity=True).loc[
+        :, [Fields.STATE, Fields.COUNTY, Fields.AGGREGATE_LEVEL]
+    ]
+
+
+def add_region_metadata(
+    df: pd.DataFrame,
+    region_metadata: pd.DataFrame,
+    *,
+    fips_field: str = common_fields.CommonFields.FIPS,
+) -> pd.DataFrame:
+    """Returns `df` with the columns of `region_metadata` joined on the FIPS of each row.
+
+    Rows with a FIPS that is not in `region_metadata` are kept with a missing STATE and COUNTY.
+    Their AGGREGATE_LEVEL is found from the length of the FIPS, "state" for 2 digits and
+    "county" for 5, so they are never written without one.
+
+    Args:
+        df: DataFrame with a column of FIPS, without any of the columns of `region_metadata`
+        region_metadata: Table indexed by FIPS, usually returned by `load_region_metadata`
+        fips_field: Column of `df` with the FIPS
+    """
+    Fields = common_fields.CommonFields
+    df = df.join(region_metadata, on=fips_field)
+    if Fields.AGGREGATE_LEVEL in region_metadata.columns:
+        level_by_length = df[fips_field].str.len().map({2: "state", 5: "county"})
+        df[Fields.AGGREGATE_LEVEL] = df[Fields.AGGREGATE_LEVEL].fillna(level_by_length)
+    return df
+
+
 def extract_state_fips(fips: str) -> str:
     """Extracts the state FIPS code from a county or state FIPS code."""
     return fips[:2]
@@ -82,9 +137,68 @@ def version_timestamp():
     return d.strftime("%A %b %d %I:%M:%S %p %Z")
 
 
-def fips_from_int(param: pd.Series):
+def _format_fips(v) -> str:
+    return f"{v:0>{2 if v < 100 else 5}}"
+
+
+def fips_from_int(param: pd.Series, *, categorical: bool = False) -> pd.Series:
     """Transform FIPS from an int64 to a string of 2 or 5 chars.
 
+    Each distinct value is formatted once and the strings are copied to rows by position, which is
+    much faster than formatting every row because there are only a few thousand distinct FIPS.
+
     See https://github.com/valorumdata/covid_county_data.py/issues/3
+
+    Args:
+        param: Series of FIPS as numbers
+        categorical: If True return a Series with dtype `category`, otherwise with dtype `object`.
+    """
+    codes, uniques = pd.factorize(param)
+    formatted = [_format_fips(v) for v in uniques]
+    if (codes == -1).any():
+        # Missing values are returned as formatted by the original per-row implementation.
+        codes = np.where(codes == -1, len(formatted), codes)
+        formatted.append(_format_fips(np.nan))
+    if categorical:
+        values = pd.Categorical.from_codes(codes, categories=formatted)
+    else:
+        values = np.array(formatted, dtype=object).take(codes)
+    return pd.Series(values, index=param.index, name=param.name)
+
+
+def filter_start_dates(
+    df: pd.DataFrame,
+    default_start_date: str,
+    start_dates: Mapping[str, str],
+    *,
+    region_field: str = common_fields.CommonFields.FIPS,
+    date_field: str = common_fields.CommonFields.DATE,
+) -> pd.DataFrame:
+    """Returns the rows of `df` on or after the start date of their region.
+
+    The start date of each distinct region is looked up once and copied to rows by position so the
+    dates are compared in a single pass, however many regions have their own start date.
+
+    Args:
+        df: DataFrame with a region and datetime column
+        default_start_date: Start date of regions not in `start_dates`
+        start_dates: Start date by region, for example keyed by state FIPS
+        region_field: Column matched with the keys of `start_dates`
+        date_field: Column compared with the start dates
     """
-    return param.apply(lambda v: f"{v:0>{2 if v < 100 else 5}}")
+    codes, uniques = pd.factorize(df[region_field])
+    # The last element is the start date of rows with a missing region, which have code -1.
+    region_start_dates = pd.to_datetime(
+        [start_dates.get(region, default_start_date) for region in uniques] + [default_start_date]
+    ).to_numpy()
+    keep_rows = df[date_field].to_numpy() >= region_start_dates[codes]
+    return df.loc[keep_rows]
+
+
+def file_sha256(path: pathlib.Path) -> str:
+    """Returns the hex SHA-256 digest of the contents of `path`."""
+    digest = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
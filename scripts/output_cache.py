@@ -0,0 +1,129 @@
+"""Skips regenerating an output file when its inputs and the code producing it are unchanged.
+
+The SHA-256 of each input file and of the code files of the transform are stored next to the
+output in `<output name>.sha256.json`. push_update.sh commits it with the output so that the next
+update run skips transforms whose inputs haven't changed, leaving the output untouched instead
+of rewriting it and making a noisy commit. Delete the `.sha256.json` file to force an update.
+"""
+import hashlib
+import json
+import os
+import pathlib
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import Optional
+
+import structlog
+
+from covidactnow.datapublic import common_df
+from covidactnow.datapublic import common_fields
+from scripts import ccd_helpers
+from scripts import fetch_helpers
+from scripts import helpers
+
+
+DIGEST_SUFFIX = ".sha256.json"
+
+# Code used by most transforms. Changes to these files invalidate every cached output.
+_SHARED_CODE_PATHS = [
+    pathlib.Path(common_df.__file__),
+    pathlib.Path(common_fields.__file__),
+    pathlib.Path(ccd_helpers.__file__),
+    pathlib.Path(fetch_helpers.__file__),
+    pathlib.Path(helpers.__file__),
+]
+
+_REPO_ROOT = pathlib.Path(__file__).parent.parent
+
+_logger = structlog.getLogger()
+
+
+def digest_path(output_path: pathlib.Path) -> pathlib.Path:
+    """Returns the path of the file holding the input digests of `output_path`."""
+    return output_path.with_name(output_path.name + DIGEST_SUFFIX)
+
+
+def path_sha256(path: pathlib.Path) -> Optional[str]:
+    """Returns the SHA-256 of a file, of the names and contents of the files in a directory or None
+    if `path` doesn't exist."""
+    if path.is_file():
+        return helpers.file_sha256(path)
+    if not path.is_dir():
+        return None
+    digest = hashlib.sha256()
+    for file_path in sorted(p for p in path.rglob("*") if p.is_file()):
+        digest.update(file_path.relative_to(path).as_posix().encode())
+        digest.update(helpers.file_sha256(file_path).encode())
+    return digest.hexdigest()
+
+
+def _digests(
+    output_path: pathlib.Path,
+    input_paths: Iterable[pathlib.Path],
+    code_paths: Iterable[pathlib.Path],
+) -> Dict[str, Dict[str, Optional[str]]]:
+    def relative_name(path: pathlib.Path, start: pathlib.Path) -> str:
+        # Relative so that the digests match in every checkout of the repo.
+        return pathlib.Path(os.path.relpath(path, start)).as_posix()
+
+    code_paths = list(code_paths) + _SHARED_CODE_PATHS
+    return {
+        "inputs": {relative_name(p, output_path.parent): path_sha256(p) for p in input_paths},
+        # Code is relative to the repo root because it isn't in a fixed location relative to data.
+        "code": {relative_name(p, _REPO_ROOT): path_sha256(p) for p in code_paths},
+    }
+
+
+def is_up_to_date(
+    output_path: pathlib.Path,
+    input_paths: Iterable[pathlib.Path],
+    code_paths: Iterable[pathlib.Path],
+) -> bool:
+    """Returns True if `output_path` was written from the current `input_paths` and code."""
+    digests_path = digest_path(output_path)
+    if not output_path.exists() or not digests_path.exists():
+        return False
+    return json.loads(digests_path.read_text()) == _digests(output_path, input_paths, code_paths)
+
+
+def write_if_changed(
+    output_path: pathlib.Path,
+    input_paths: Iterable[pathlib.Path],
+    code_paths: Iterable[pathlib.Path],
+    write_output: Callable[[], None],
+    log=_logger,
+) -> bool:
+    """Calls `write_output` unless `output_path` was written from the same inputs and code.
+
+    Args:
+        output_path: File written by `write_output`, next to which the digests are stored
+        input_paths: Files and directories read by `write_output`
+        code_paths: Source files of the transform, usually `[pathlib.Path(__file__)]` of the
+          updater. Shared modules such as common_df and helpers are always included.
+        write_output: Function that transforms the inputs and writes `output_path`
+        log: Logger
+
+    Returns: True if `write_output` was called.
+    """
+    input_paths = list(input_paths)
+    digests = _digests(output_path, input_paths, code_paths)
+    digests_path = digest_path(output_path)
+    log = log.bind(output_path=str(output_path))
+
+    if output_path.exists() and digests_path.exists():
+        previous = json.loads(digests_path.read_text())
+        if previous == digests:
+            log.info("Inputs and code unchanged, skipping transform")
+            return False
+        changed = sorted(
+            name
+            for kind in digests
+            for name, digest in digests[kind].items()
+            if previous.get(kind, {}).get(name) != digest
+        )
+        log.info("Inputs or code changed", changed=changed)
+
+    write_output()
+    digests_path.write_text(json.dumps(digests, indent=2, sort_keys=True) + "\n")
+    return True
@@ -1,14 +1,22 @@
+import concurrent.futures
 import enum
+import itertools
+import json
 import pathlib
 import shutil
+import time
 from collections import defaultdict
-from typing import Union, Optional, List, Dict, Any, Iterable, Tuple
+from typing import Union, Optional, List, Dict, Any, Iterable, Tuple, Set
 
 import boto3
 import botocore
 import botocore.client
+import botocore.exceptions
 import click
+import numpy as np
 import pandas as pd
+from pandas.api.types import is_categorical_dtype
+from pandas.api.types import union_categoricals
 
 import structlog
 from pydantic import BaseModel
@@ -24,8 +32,11 @@ from covidactnow.datapublic.common_fields import (
     FieldNameAndCommonField,
 )
 from scripts import helpers
+from scripts import output_cache
 
 DATA_ROOT = pathlib.Path(__file__).parent.parent / "data"
+# Files read by `AwsDataLakeTransformer.make_with_data_root`, used by output_cache.
+GEO_INPUT_PATHS = [DATA_ROOT / "misc" / "fips_population.csv", DATA_ROOT / "misc" / "state.txt"]
 
 
 @enum.unique
@@ -53,8 +64,50 @@ DELPHI_BUCKET_NAME = "covid19-lake"
 COVIDCAST_PREFIX = "covidcast/json"
 
 
-def _get_unsigned_s3_client():
-    return boto3.client("s3", config=botocore.client.Config(signature_version=botocore.UNSIGNED))
+# Number of objects downloaded concurrently, which is also the size of the client connection pool.
+DEFAULT_DOWNLOAD_WORKERS = 16
+# Seconds to wait for a connection and for each read of a response so a stuck object can't hang
+# the update.
+S3_CONNECT_TIMEOUT = 10
+S3_READ_TIMEOUT = 60
+# Attempts to download each object, including the first. Each attempt also uses the retries of
+# botocore for failed requests.
+DOWNLOAD_ATTEMPTS = 3
+# Error codes of a ClientError, such as throttling by S3, that are worth retrying.
+RETRYABLE_CLIENT_ERROR_CODES = {
+    "InternalError",
+    "RequestTimeout",
+    "RequestLimitExceeded",
+    "ServiceUnavailable",
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+}
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def _is_retryable_download_error(e: Exception) -> bool:
+    """Returns True if downloading an object may succeed after failing with `e`."""
+    if isinstance(e, botocore.exceptions.ClientError):
+        status_code = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        return (
+            e.response.get("Error", {}).get("Code") in RETRYABLE_CLIENT_ERROR_CODES
+            or status_code >= 500
+        )
+    return isinstance(e, (botocore.exceptions.BotoCoreError, OSError))
+
+
+def _get_unsigned_s3_client(max_pool_connections: int = DEFAULT_DOWNLOAD_WORKERS):
+    return boto3.client(
+        "s3",
+        config=botocore.client.Config(
+            signature_version=botocore.UNSIGNED,
+            max_pool_connections=max_pool_connections,
+            connect_timeout=S3_CONNECT_TIMEOUT,
+            read_timeout=S3_READ_TIMEOUT,
+            retries={"max_attempts": 5, "mode": "standard"},
+        ),
+    )
 
 
 def _group_covidcast_files_by_source(s3_keys: List[str]) -> Dict[str, List[str]]:
@@ -90,66 +143,203 @@ def _get_delphi_covidcast_metadata(bucket_name: str = DELPHI_BUCKET_NAME) -> pd.
 class AwsDataLakeCopier(BaseModel):
     local_mirror_dir: pathlib.Path
 
-    # An unsigned s3 client
+    # An unsigned s3 client, shared by all download threads
     s3: Any
 
     log: Union[structlog.BoundLoggerBase, BoundLoggerLazyProxy]
 
+    # Number of objects downloaded concurrently
+    download_workers: int = DEFAULT_DOWNLOAD_WORKERS
+
     class Config:
         arbitrary_types_allowed = True
 
     @staticmethod
-    def make_with_data_root(data_root: pathlib.Path) -> "AwsDataLakeCopier":
+    def make_with_data_root(
+        data_root: pathlib.Path, download_workers: int = DEFAULT_DOWNLOAD_WORKERS
+    ) -> "AwsDataLakeCopier":
         return AwsDataLakeCopier(
             local_mirror_dir=data_root / "aws-lake" / "mirror",
-            s3=_get_unsigned_s3_client(),
+            s3=_get_unsigned_s3_client(max_pool_connections=download_workers),
             log=structlog.get_logger(),
+            download_workers=download_workers,
         )
 
-    def _get_latest_delphi_files(
+    MANIFEST_FILENAME = "manifest.json"
+
+    @property
+    def manifest_path(self) -> pathlib.Path:
+        """Path of a file with the ETag, LastModified and Size of each object in the local mirror."""
+        return self.local_mirror_dir / self.MANIFEST_FILENAME
+
+    def _list_delphi_objects(
         self, bucket_name: str = DELPHI_BUCKET_NAME, prefix: Optional[str] = COVIDCAST_PREFIX
-    ) -> List[str]:
+    ) -> List[Dict[str, Any]]:
         """
-        Given an s3 bucket name and optional path prefix, fetch all file names matching that prefix.
+        Given an s3 bucket name and optional path prefix, fetch the `Contents` entries, with `Key`,
+        `ETag`, `LastModified` and `Size`, of all objects matching that prefix.
         """
         paginator = self.s3.get_paginator("list_objects")
         # The bucket has a ton of stuff and depending on the prefix value you
         # choose you may exceed the max list_objects return size (1000).
         # The paginator allows you always fetch all of the file paths.
         page_iterator = paginator.paginate(Bucket=bucket_name, Prefix=prefix)
-        s3_keys = []
+        s3_objects = []
         for page in page_iterator:
-            s3_keys.extend(x["Key"] for x in page["Contents"])
-        return s3_keys
+            s3_objects.extend(page["Contents"])
+        return s3_objects
+
+    def _get_latest_delphi_files(
+        self, bucket_name: str = DELPHI_BUCKET_NAME, prefix: Optional[str] = COVIDCAST_PREFIX
+    ) -> List[str]:
+        """
+        Given an s3 bucket name and optional path prefix, fetch all file names matching that prefix.
+        """
+        return [x["Key"] for x in self._list_delphi_objects(bucket_name, prefix)]
+
+    def _local_path(self, key: str) -> pathlib.Path:
+        data_source = key.split("/")[3]
+        return self.local_mirror_dir / data_source / pathlib.Path(key).name
+
+    def _read_manifest(self) -> Dict[str, Dict[str, Any]]:
+        if not self.manifest_path.exists():
+            return {}
+        return json.loads(self.manifest_path.read_text())
+
+    def _write_manifest(self, manifest: Dict[str, Dict[str, Any]]) -> None:
+        tmp_path = self.manifest_path.with_name(self.manifest_path.name + ".tmp")
+        tmp_path.write_text(json.dumps(manifest, indent=1, sort_keys=True))
+        tmp_path.replace(self.manifest_path)
+
+    def _download_file(self, bucket_name: str, key: str, local_file: pathlib.Path) -> int:
+        """Download one object to `local_file`, retrying failures, and return the number of bytes."""
+        # Write to a temporary file, renamed only after a complete download, so a failed download
+        # doesn't leave a partial file.
+        tmp_file = local_file.with_name(local_file.name + ".tmp")
+        for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+            try:
+                response = self.s3.get_object(Bucket=bucket_name, Key=key)
+                with tmp_file.open("wb") as f:
+                    shutil.copyfileobj(response["Body"], f, DOWNLOAD_CHUNK_SIZE)
+                break
+            except Exception as e:
+                if attempt == DOWNLOAD_ATTEMPTS or not _is_retryable_download_error(e):
+                    if tmp_file.exists():
+                        tmp_file.unlink()
+                    raise
+                self.log.warning("Retrying download", key=key, attempt=attempt, exception=repr(e))
+        tmp_file.replace(local_file)
+        return local_file.stat().st_size
 
     def _cache_data_locally(
-        self, s3_keys: List[str], source_dir: pathlib.Path, bucket_name=DELPHI_BUCKET_NAME
-    ) -> None:
-        """Download json files from s3"""
-        source_dir.mkdir(parents=True)
-
-        s3 = _get_unsigned_s3_client()
-        for key in s3_keys:
-            self.log.info(f"Downloading file s3://{bucket_name}/{key}")
-            filename = pathlib.Path(key).name
-            local_file = source_dir / filename
-            s3.download_file(bucket_name, key, str(local_file))
+        self, keys_by_dir: Dict[pathlib.Path, List[str]], bucket_name=DELPHI_BUCKET_NAME
+    ) -> int:
+        """Download json files from s3 to the directory of their source, in parallel, and return
+        the number of bytes downloaded"""
+        downloads = []
+        for source_dir, s3_keys in keys_by_dir.items():
+            source_dir.mkdir(parents=True, exist_ok=True)
+            downloads.extend((key, source_dir / pathlib.Path(key).name) for key in s3_keys)
+
+        self.log.info(
+            "Downloading files",
+            bucket=bucket_name,
+            files=len(downloads),
+            workers=self.download_workers,
+        )
+        start = time.perf_counter()
+        total_bytes = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.download_workers) as executor:
+            futures = [
+                executor.submit(self._download_file, bucket_name, key, local_file)
+                for key, local_file in downloads
+            ]
+            try:
+                for done_count, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                    total_bytes += future.result()
+                    if done_count % 100 == 0 or done_count == len(futures):
+                        seconds = time.perf_counter() - start
+                        self.log.info(
+                            "Download progress",
+                            files=done_count,
+                            total_files=len(futures),
+                            mib=round(total_bytes / 2 ** 20, 1),
+                            mib_per_second=round(total_bytes / 2 ** 20 / max(seconds, 1e-6), 2),
+                        )
+            except Exception:
+                # Don't start downloads that are still queued when one has failed.
+                for future in futures:
+                    future.cancel()
+                raise
+        return total_bytes
 
     def replace_local_mirror(self):
-        keys = self._get_latest_delphi_files()
-        files_by_source = _group_covidcast_files_by_source(keys)
         if self.local_mirror_dir.exists():
             self.log.info(
                 "Removing existing local mirror directory", mirror_dir=self.local_mirror_dir
             )
             shutil.rmtree(self.local_mirror_dir)
+        self.sync_local_mirror()
 
+    def sync_local_mirror(self):
+        """Update the local mirror to match the bucket, downloading only new and changed files.
+
+        Objects listed in the bucket are compared with the manifest written by the previous sync.
+        Every other file in the mirror, such as the file of an object no longer in the bucket or
+        one left by an interrupted sync, is deleted.
+        """
+        previous_manifest = self._read_manifest()
+        s3_objects = {x["Key"]: x for x in self._list_delphi_objects()}
+        files_by_source = _group_covidcast_files_by_source(list(s3_objects))
+
+        manifest = {}
+        keys_by_dir = {}
         for data_source, keys in files_by_source.items():
-            if not data_source.startswith("jhu"):
-                self.log.info(f"Caching {len(keys)} {data_source} files locally.")
-                self._cache_data_locally(keys, self.local_mirror_dir / data_source)
+            if data_source.startswith("jhu"):
+                continue
+            changed_keys = []
+            for key in keys:
+                s3_object = s3_objects[key]
+                manifest[key] = {
+                    "ETag": s3_object["ETag"],
+                    "LastModified": s3_object["LastModified"].isoformat(),
+                    "Size": s3_object["Size"],
+                }
+                if (
+                    previous_manifest.get(key) != manifest[key]
+                    or not self._local_path(key).exists()
+                ):
+                    changed_keys.append(key)
+            if changed_keys:
+                self.log.info(
+                    f"Caching {len(changed_keys)} of {len(keys)} {data_source} files locally."
+                )
+                keys_by_dir[self.local_mirror_dir / data_source] = changed_keys
+
+        # Compare the files in the mirror, not the previous manifest, with the bucket so files
+        # that were never in a manifest are removed too.
+        expected_paths = {self._local_path(key) for key in manifest}
+        removed_paths = []
+        if self.local_mirror_dir.exists():
+            for source_dir in [p for p in self.local_mirror_dir.iterdir() if p.is_dir()]:
+                for local_path in source_dir.iterdir():
+                    if local_path not in expected_paths:
+                        local_path.unlink()
+                        removed_paths.append(local_path)
+                if not any(source_dir.iterdir()):
+                    source_dir.rmdir()
+
+        downloaded_bytes = self._cache_data_locally(keys_by_dir)
+        self.local_mirror_dir.mkdir(parents=True, exist_ok=True)
+        self._write_manifest(manifest)
         self.log.info(
-            "Finished download to local mirror directory", mirror_dir=self.local_mirror_dir
+            "Finished sync of local mirror directory",
+            mirror_dir=self.local_mirror_dir,
+            downloaded_files=sum(len(keys) for keys in keys_by_dir.values()),
+            removed_files=len(removed_paths),
+            total_files=len(manifest),
+            downloaded_mib=round(downloaded_bytes / 2 ** 20, 1),
+            total_mib=round(sum(entry["Size"] for entry in manifest.values()) / 2 ** 20, 1),
         )
 
     def cleanup_local_mirror(self):
@@ -161,51 +351,181 @@ class AwsDataLakeCopier(BaseModel):
             yield dir.name, dir.glob("*.json")
 
 
+# Number of lines parsed into arrays at a time.
+JSON_LINES_BATCH_SIZE = 100_000
+# Number of lines at the start of each part that are checked for unknown fields.
+UNKNOWN_FIELDS_SAMPLE_LINES = 1000
+# Fields with a few distinct values that are returned as categorical columns.
+CATEGORICAL_FIELDS = [Fields.TIME_TYPE, Fields.GEO_TYPE, Fields.SIGNAL]
+
+
+def _parse_json_lines_batch(
+    lines: List[str], categories: Dict[Fields, Dict[str, int]]
+) -> Dict[Fields, np.ndarray]:
+    """Parse JSON lines into arrays of the `Fields` values.
+
+    Values of `CATEGORICAL_FIELDS` are returned as integer codes of the values in `categories`,
+    which is updated with new values.
+    """
+    count = len(lines)
+    time_values = np.empty(count, dtype="int64")
+    geo_values = np.empty(count, dtype=object)
+    values = np.empty(count, dtype="float64")
+    time_types = np.empty(count, dtype=object)
+    geo_types = np.empty(count, dtype=object)
+    signals = np.empty(count, dtype=object)
+    for i, line in enumerate(lines):
+        record = json.loads(line)
+        get = record.get
+        time_values[i] = record["time_value"]
+        geo_values[i] = get("geo_value")
+        value = get("value")
+        values[i] = np.nan if value is None else value
+        time_types[i] = get("time_type")
+        geo_types[i] = get("geo_type")
+        signals[i] = get("signal")
+
+    batch = {Fields.TIME_VALUE: time_values, Fields.GEO_VALUE: geo_values, Fields.VALUE: values}
+    categorical_values = {
+        Fields.TIME_TYPE: time_types,
+        Fields.GEO_TYPE: geo_types,
+        Fields.SIGNAL: signals,
+    }
+    for field, field_values in categorical_values.items():
+        # The object array of the batch is replaced by codes of the values in all batches.
+        codes, uniques = pd.factorize(field_values)
+        field_categories = categories[field]
+        unique_codes = [field_categories.setdefault(u, len(field_categories)) for u in uniques]
+        batch[field] = np.append(np.array(unique_codes, dtype="int32"), -1)[codes]
+    return batch
+
+
+def _infer_numeric(values: np.ndarray) -> np.ndarray:
+    """Returns `values` as integers or floats if they all are numbers, like `pd.read_json`."""
+    try:
+        as_float = values.astype("float64")
+    except (TypeError, ValueError):
+        return values
+    as_int = as_float.astype("int64")
+    if np.array_equal(as_int, as_float):
+        return as_int
+    return as_float
+
+
+def _read_json_lines_part(path: pathlib.Path) -> Tuple[pd.DataFrame, Set[str]]:
+    """Read one JSON lines part file, returning the `Fields` columns and names of the fields found
+    in the first `UNKNOWN_FIELDS_SAMPLE_LINES` lines.
+
+    Lines are parsed in batches into arrays of only the `Fields` so that memory used is proportional
+    to the kept columns. This is a module level function so that it can be run in worker processes.
+    The columns are plain `str` because `Fields` members can't be pickled.
+    """
+    found_fields = set()
+    categories = {field: {} for field in CATEGORICAL_FIELDS}
+    batches = []
+    with path.open() as f:
+        while True:
+            lines = list(itertools.islice(f, JSON_LINES_BATCH_SIZE))
+            if not lines:
+                break
+            lines = [line for line in lines if line.strip()]
+            if not batches:
+                for line in lines[:UNKNOWN_FIELDS_SAMPLE_LINES]:
+                    found_fields.update(json.loads(line))
+            batches.append(_parse_json_lines_batch(lines, categories))
+
+    columns = {}
+    for field in Fields:
+        field_values = [batch[field] for batch in batches]
+        if field_values:
+            field_values = np.concatenate(field_values)
+        else:
+            field_values = np.empty(0, dtype="int32" if field in categories else "float64")
+        if field in categories:
+            field_values = pd.Categorical.from_codes(
+                field_values, categories=list(categories[field])
+            )
+        elif field == Fields.GEO_VALUE:
+            field_values = _infer_numeric(field_values)
+        columns[str(field.value)] = field_values
+    return pd.DataFrame(columns), found_fields
+
+
+def _concat_parts(part_dfs: List[pd.DataFrame]) -> pd.DataFrame:
+    """Concatenate DataFrames returned by `_read_json_lines_part`, combining the categories of
+    categorical columns instead of converting them to `object`."""
+    columns = {}
+    for column in part_dfs[0].columns:
+        column_parts = [df[column] for df in part_dfs]
+        if is_categorical_dtype(column_parts[0].dtype):
+            columns[column] = union_categoricals(
+                [c.values for c in column_parts], sort_categories=True
+            )
+        else:
+            columns[column] = pd.concat(column_parts, ignore_index=True)
+    return pd.DataFrame(columns)
+
+
 class AwsDataLakeTransformer(BaseModel):
     # A DataFrame with rows containing CommonFields values for regions (`fips`, `county`, ...) indexed by
     # `geo_value` and `geo_type`. This is used to merge the CommonFields values into the combined_df for both
     # states and counties.
     geo_fields_to_common_fields: pd.DataFrame
 
+    # Number of worker processes used to parse the JSON part files of a source
+    parse_workers: int = 1
+
     class Config:
         arbitrary_types_allowed = True
 
     @staticmethod
-    def make_with_data_root(data_root: pathlib.Path) -> "AwsDataLakeTransformer":
-        county_geos = helpers.load_county_fips_data(data_root / "misc" / "fips_population.csv")
-        county_geos[Fields.GEO_VALUE] = pd.to_numeric(county_geos[CommonFields.FIPS])
-        county_geos[Fields.GEO_TYPE] = "county"
-        county_geos[CommonFields.AGGREGATE_LEVEL] = "county"
-        county_geos[CommonFields.COUNTRY] = "USA"
-
-        state_geos = helpers.load_census_state(data_root / "misc" / "state.txt")
-        state_geos[Fields.GEO_VALUE] = state_geos[CommonFields.STATE].str.lower()
-        state_geos[Fields.GEO_TYPE] = "state"
-        state_geos[CommonFields.AGGREGATE_LEVEL] = "state"
-        state_geos[CommonFields.COUNTRY] = "USA"
-
-        all_geos = pd.concat([county_geos, state_geos])
+    def make_with_data_root(
+        data_root: pathlib.Path, parse_workers: int = 1
+    ) -> "AwsDataLakeTransformer":
+        all_geos = helpers.load_region_metadata(
+            data_root / "misc" / "fips_population.csv", data_root / "misc" / "state.txt"
+        ).reset_index()
+        is_county = all_geos[CommonFields.AGGREGATE_LEVEL] == "county"
+        # Counties are identified by their numeric FIPS and states by their lower case abbreviation.
+        all_geos[Fields.GEO_VALUE] = (
+            pd.to_numeric(all_geos[CommonFields.FIPS])
+            .astype(object)
+            .where(is_county, all_geos[CommonFields.STATE].str.lower())
+        )
+        all_geos[Fields.GEO_TYPE] = all_geos[CommonFields.AGGREGATE_LEVEL]
+        all_geos[CommonFields.COUNTRY] = "USA"
 
         return AwsDataLakeTransformer(
             geo_fields_to_common_fields=all_geos.set_index([Fields.GEO_TYPE, Fields.GEO_VALUE])[
                 COMMON_LEGACY_REGION_FIELDS
-            ]
+            ],
+            parse_workers=parse_workers,
         )
 
     def _load_json_lines(self, log, source_files: Iterable[pathlib.Path]):
-        combined_df = pd.DataFrame()
-        for f in source_files:
-            part_df = pd.read_json(f, lines=True)
-            part_df[Fields.TIME_VALUE] = pd.to_datetime(part_df[Fields.TIME_VALUE], format="%Y%m%d")
-            combined_df = combined_df.append(part_df, ignore_index=True)
-        unknown_fields = set(combined_df.columns) - ALL_KNOWN_FIELDS
+        source_files = list(source_files)
+        if self.parse_workers > 1 and len(source_files) > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.parse_workers) as executor:
+                parts = list(executor.map(_read_json_lines_part, source_files))
+        else:
+            parts = [_read_json_lines_part(f) for f in source_files]
+
+        # Concatenate all parts at once instead of appending each part, which copies all previous
+        # parts every time.
+        if parts:
+            combined_df = _concat_parts([part_df for part_df, _ in parts])
+        else:
+            combined_df = pd.DataFrame(columns=[str(f.value) for f in Fields])
+        combined_df.columns = list(Fields)
+        combined_df[Fields.TIME_VALUE] = pd.to_datetime(
+            combined_df[Fields.TIME_VALUE], format="%Y%m%d"
+        )
+        unknown_fields = set().union(*(columns for _, columns in parts)) - ALL_KNOWN_FIELDS
         if unknown_fields:
             log.warning(
                 "Found unknown fields. Did the structure of the JSON change?",
                 unknown_fields=unknown_fields,
             )
-        # Keep only columns that appear in the Fields enum.
-        combined_df = combined_df.loc[:, list(Fields)]
         return combined_df
 
     def _map_columns(self, df: pd.DataFrame, log: structlog.BoundLoggerBase) -> pd.DataFrame:
@@ -230,23 +550,56 @@ class AwsDataLakeTransformer(BaseModel):
         return df
 
     def _make_column_per_signal(self, combined_df, log):
-        grouped = combined_df.groupby(
-            [Fields.GEO_TYPE, Fields.GEO_VALUE, Fields.TIME_TYPE, Fields.TIME_VALUE, Fields.SIGNAL]
+        """Return a DataFrame with a row per region and date and a column per signal.
+
+        Each key column is factorized once and values are copied directly into a dense array of
+        rows by signals, avoiding the temporary objects of a groupby and unstack.
+        """
+        row_keys = [Fields.GEO_TYPE, Fields.GEO_VALUE, Fields.TIME_TYPE, Fields.TIME_VALUE]
+        # Like groupby, drop rows with a missing key.
+        has_keys = np.logical_and.reduce(
+            [combined_df[key].notna().values for key in row_keys + [Fields.SIGNAL]]
         )
-        group_sizes = grouped.size()
-        if (group_sizes > 1).any():
+        if not has_keys.all():
+            combined_df = combined_df.loc[has_keys]
+
+        # Factorize each row key, sorted so that rows are in the same order as a groupby, and
+        # combine the codes into a single row code.
+        row_code = np.zeros(len(combined_df), dtype="int64")
+        key_uniques = []
+        for key in row_keys:
+            codes, uniques = pd.factorize(combined_df[key], sort=True)
+            row_code = row_code * len(uniques) + codes
+            key_uniques.append(uniques)
+        row_code, row_code_uniques = pd.factorize(row_code, sort=True)
+        signal_code, signals = pd.factorize(combined_df[Fields.SIGNAL], sort=True)
+        cell_code = row_code * len(signals) + signal_code
+
+        is_duplicate = pd.Series(cell_code).duplicated(keep=False).values
+        if is_duplicate.any():
             log.warning(
                 "Found duplicate values",
-                count=(group_sizes > 1).sum(),
-                rows=grouped[group_sizes > 1],
+                count=len(np.unique(cell_code[is_duplicate])),
+                rows=combined_df.loc[is_duplicate].head(10).to_dict(orient="records"),
             )
-        # Proceed as though each group in `grouped` contains a single row. last() turns the groups into a DataFrame
-        # and unstack moves values in the last row index, Fields.SIGNAL, to the column index.
-        unstacked_df = grouped.last().unstack()
-        # Remove the top level *column* index `signal` leaving the values from signal as the column names.
-        unstacked_df.columns = unstacked_df.columns.droplevel()
-        # Restore the row indexes created by the groupby to be regular columns.
-        unstacked_df = unstacked_df.reset_index()
+
+        # Proceed as though each row and signal has a single value. Like `groupby.last`, missing
+        # values are skipped and the last of duplicate values is kept.
+        values = combined_df[Fields.VALUE].to_numpy(dtype="float64")
+        is_selected = ~np.isnan(values)
+        if is_duplicate.any():
+            is_selected[is_selected] = ~pd.Series(cell_code[is_selected]).duplicated(keep="last")
+        signal_values = np.full(len(row_code_uniques) * len(signals), np.nan)
+        signal_values[cell_code[is_selected]] = values[is_selected]
+        signal_values = signal_values.reshape(len(row_code_uniques), len(signals))
+
+        # Wrap the array of values without copying it and add the row keys, decoded from the
+        # combined row code.
+        unstacked_df = pd.DataFrame(signal_values, columns=pd.Index(list(signals), dtype=object))
+        remaining = row_code_uniques
+        for key, uniques in reversed(list(zip(row_keys, key_uniques))):
+            remaining, codes = np.divmod(remaining, len(uniques))
+            unstacked_df.insert(0, key, uniques.take(codes))
         return unstacked_df
 
     def transform(self, source_files: Iterable[pathlib.Path], log) -> pd.DataFrame:
@@ -263,7 +616,7 @@ class AwsDataLakeTransformer(BaseModel):
         log.info(
             "Loaded dataframe",
             input_rows=len(combined_df),
-            input_by_geo_types=combined_df.groupby(Fields.GEO_TYPE).size().to_dict(),
+            input_by_geo_types=combined_df.groupby(Fields.GEO_TYPE, observed=True).size().to_dict(),
             input_signals=list(combined_df[Fields.SIGNAL].unique()),
             output_rows=len(output_df),
             output_by_agg_level=output_df.groupby(CommonFields.AGGREGATE_LEVEL).size().to_dict(),
@@ -271,27 +624,128 @@ class AwsDataLakeTransformer(BaseModel):
         return output_df
 
 
+# The transformer used by `_update_source`. It is set once in each worker process by
+# `_init_update_source_worker` so that the geo DataFrame is not pickled with every source.
+_source_transformer: Optional[AwsDataLakeTransformer] = None
+
+
+def _init_update_source_worker(transformer: AwsDataLakeTransformer) -> None:
+    global _source_transformer
+    _source_transformer = transformer
+
+
+def _update_source(
+    source_name: str, source_files: List[pathlib.Path], output_path: pathlib.Path
+) -> None:
+    log = structlog.get_logger(source_name=source_name)
+    output_cache.write_if_changed(
+        output_path,
+        source_files + GEO_INPUT_PATHS,
+        [pathlib.Path(__file__)],
+        lambda: write_df_as_csv(_source_transformer.transform(source_files, log), output_path, log),
+        log,
+    )
+
+
+def update_sources(
+    transformer: AwsDataLakeTransformer,
+    sources: Iterable[Tuple[str, Iterable[pathlib.Path]]],
+    output_dir: pathlib.Path,
+    jobs: int = 1,
+) -> List[str]:
+    """Transform and write the timeseries of each source, returning the names of failed sources.
+
+    An exception transforming or writing one source is logged and does not stop the others.
+
+    Args:
+        transformer: Transformer used for all sources
+        sources: Source names with the paths of their JSON files, as returned by `get_sources`
+        output_dir: Directory of the output CSV files
+        jobs: Number of sources updated at the same time, each in a separate process. Sources
+            are parsed in the process updating them, so `jobs` and the `parse_workers` of
+            `transformer` are exclusive and `parse_workers` is ignored when `jobs` is more than 1.
+    """
+    tasks = {
+        source_name: (source_name, list(source_files), output_dir / f"timeseries-{source_name}.csv")
+        for source_name, source_files in sources
+    }
+    failed_sources = []
+    if jobs > 1:
+        # Don't start a pool of parse workers in each job.
+        transformer = transformer.copy(update={"parse_workers": 1})
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, initializer=_init_update_source_worker, initargs=(transformer,),
+        ) as executor:
+            futures = {
+                executor.submit(_update_source, *task): source_name
+                for source_name, task in tasks.items()
+            }
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception:
+                    structlog.get_logger(source_name=futures[future]).exception(
+                        "Failed to update source"
+                    )
+                    failed_sources.append(futures[future])
+    else:
+        _init_update_source_worker(transformer)
+        for source_name, task in tasks.items():
+            try:
+                _update_source(*task)
+            except Exception:
+                structlog.get_logger(source_name=source_name).exception("Failed to update source")
+                failed_sources.append(source_name)
+    return sorted(failed_sources)
+
+
 @click.command()
 @click.option("--replace-local-mirror", is_flag=True)
+@click.option(
+    "--sync-local-mirror", is_flag=True, help="Download only files changed since the last sync."
+)
 @click.option("--cleanup-local-mirror", is_flag=True)
-def main(replace_local_mirror: bool, cleanup_local_mirror: bool):
+@click.option("--download-workers", default=DEFAULT_DOWNLOAD_WORKERS, show_default=True)
+@click.option(
+    "--parse-workers",
+    default=1,
+    show_default=True,
+    help="Processes used to parse each source. Can't be used with --jobs.",
+)
+@click.option(
+    "--jobs",
+    default=1,
+    show_default=True,
+    help="Sources transformed in parallel processes. Can't be used with --parse-workers.",
+)
+def main(
+    replace_local_mirror: bool,
+    sync_local_mirror: bool,
+    cleanup_local_mirror: bool,
+    download_workers: int,
+    parse_workers: int,
+    jobs: int,
+):
+    if jobs > 1 and parse_workers > 1:
+        # Each job would start its own pool of parse workers, using jobs * parse_workers CPUs.
+        raise click.UsageError("--jobs and --parse-workers can't both be more than 1")
     common_init.configure_logging()
 
-    copier = AwsDataLakeCopier.make_with_data_root(DATA_ROOT)
+    copier = AwsDataLakeCopier.make_with_data_root(DATA_ROOT, download_workers=download_workers)
     if replace_local_mirror:
         copier.replace_local_mirror()
+    elif sync_local_mirror:
+        copier.sync_local_mirror()
 
-    transformer = AwsDataLakeTransformer.make_with_data_root(DATA_ROOT)
-    for source_name, source_files in copier.get_sources():
-        log = structlog.get_logger(source_name=source_name)
-        write_df_as_csv(
-            transformer.transform(source_files, log),
-            DATA_ROOT / "aws-lake" / f"timeseries-{source_name}.csv",
-            log,
-        )
+    transformer = AwsDataLakeTransformer.make_with_data_root(DATA_ROOT, parse_workers=parse_workers)
+    failed_sources = update_sources(
+        transformer, copier.get_sources(), DATA_ROOT / "aws-lake", jobs=jobs
+    )
 
     if cleanup_local_mirror:
         copier.cleanup_local_mirror()
+    if failed_sources:
+        raise Exception(f"Failed to update sources: {', '.join(failed_sources)}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,58 @@
+"""Runs every updater that reads the can-scrape parquet file against a single loaded dataset.
+
+This replaces running each of the updaters below as a separate process, each of which reads
+and cleans the same parquet file. The file isn't read at all when every output is up to date
+according to output_cache.
+"""
+from types import ModuleType
+from typing import Callable, List, Tuple
+
+import click
+import pandas as pd
+import structlog
+
+from covidactnow.datapublic import common_df
+from covidactnow.datapublic import common_init
+
+from scripts import ccd_helpers
+from scripts import output_cache
+from scripts import update_can_scraper_state_providers
+from scripts import update_cdc_test_data
+from scripts import update_cdc_vaccine_data
+from scripts import update_hhs_hospital_data
+
+
+# The transform function of each updater using the CovidCountyDataset and the updater module,
+# which declares the OUTPUT_PATH, INPUT_PATHS and CODE_PATHS of the transform.
+TRANSFORMS: List[Tuple[Callable[[ccd_helpers.CovidCountyDataset], pd.DataFrame], ModuleType]] = [
+    (update_can_scraper_state_providers.transform, update_can_scraper_state_providers),
+    (update_cdc_test_data.transform, update_cdc_test_data),
+    (update_cdc_vaccine_data.transform, update_cdc_vaccine_data),
+    (update_hhs_hospital_data.update, update_hhs_hospital_data),
+]
+
+
+@click.command()
+@click.option("--fetch/--no-fetch", default=True)
+def main(fetch: bool):
+    common_init.configure_logging()
+
+    if fetch:
+        ccd_helpers.CovidCountyDataset.fetch()
+
+    for transform, module in TRANSFORMS:
+        log = structlog.get_logger(transform=f"{transform.__module__}.{transform.__name__}")
+
+        def write_output():
+            # Only read once, by the first transform that isn't skipped; later calls return the
+            # dataset cached by CovidCountyDataset.read.
+            ccd_dataset = ccd_helpers.CovidCountyDataset.load(fetch=False)
+            common_df.write_csv(transform(ccd_dataset), module.OUTPUT_PATH, log, chunk_rows=100_000)
+
+        output_cache.write_if_changed(
+            module.OUTPUT_PATH, module.INPUT_PATHS, module.CODE_PATHS, write_output, log
+        )
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
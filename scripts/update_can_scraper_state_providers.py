@@ -14,6 +14,7 @@ from covidactnow.datapublic.common_fields import GetByValueMixin
 
 from scripts import helpers
 from scripts import ccd_helpers
+from scripts import output_cache
 
 
 # Force SettingWithCopyWarning to raise instead of logging a warning so it is easier to find the
@@ -26,6 +27,9 @@ Fields = ccd_helpers.Fields
 DATA_ROOT = pathlib.Path(__file__).parent.parent / "data"
 COUNTY_DATA_PATH = DATA_ROOT / "misc" / "fips_population.csv"
 OUTPUT_PATH = DATA_ROOT / "can-scrapers-state-providers" / "timeseries-common.csv"
+# Files read by `transform` and source of the code producing OUTPUT_PATH, used by output_cache.
+INPUT_PATHS = [ccd_helpers.DATA_PATH]
+CODE_PATHS = [pathlib.Path(__file__), pathlib.Path(ccd_helpers.__file__)]
 
 
 def transform(dataset: ccd_helpers.CovidCountyDataset):
@@ -157,10 +161,14 @@ def main(fetch: bool):
     common_init.configure_logging()
     log = structlog.get_logger()
 
-    ccd_dataset = ccd_helpers.CovidCountyDataset.load(fetch=fetch)
-    all_df = transform(ccd_dataset)
+    if fetch:
+        ccd_helpers.CovidCountyDataset.fetch()
 
-    common_df.write_csv(all_df, OUTPUT_PATH, log)
+    def write_output():
+        ccd_dataset = ccd_helpers.CovidCountyDataset.load(fetch=False)
+        common_df.write_csv(transform(ccd_dataset), OUTPUT_PATH, log, chunk_rows=100_000)
+
+    output_cache.write_if_changed(OUTPUT_PATH, INPUT_PATHS, CODE_PATHS, write_output, log)
 
 
 if __name__ == "__main__":
@@ -12,6 +12,7 @@ from covidactnow.datapublic.common_fields import CommonFields
 
 from scripts import helpers
 from scripts import ccd_helpers
+from scripts import output_cache
 
 Fields = ccd_helpers.Fields
 
@@ -20,6 +21,20 @@ DATA_URL = "https://storage.googleapis.com/can-scrape-outputs/final/can_scrape_a
 DATA_ROOT = pathlib.Path(__file__).parent.parent / "data"
 COUNTY_DATA_PATH = DATA_ROOT / "misc" / "fips_population.csv"
 OUTPUT_PATH = DATA_ROOT / "testing-cdc" / "timeseries-common.csv"
+# Files read by `transform` and source of the code producing OUTPUT_PATH, used by output_cache.
+INPUT_PATHS = [ccd_helpers.DATA_PATH]
+CODE_PATHS = [pathlib.Path(__file__), pathlib.Path(ccd_helpers.__file__)]
+
+
+VARIABLES = [
+    ccd_helpers.ScraperVariable(
+        variable_name="pcr_tests_positive",
+        measurement="rolling_average_7_day",
+        provider="cdc",
+        unit="percentage",
+        common_field=CommonFields.TEST_POSITIVITY_7D,
+    ),
+]
 
 
 DC_COUNTY_FIPS = "11001"
@@ -52,17 +67,7 @@ def remove_trailing_zeros(data: pd.DataFrame) -> pd.DataFrame:
 
 
 def transform(dataset: ccd_helpers.CovidCountyDataset):
-
-    variables = [
-        ccd_helpers.ScraperVariable(
-            variable_name="pcr_tests_positive",
-            measurement="rolling_average_7_day",
-            provider="cdc",
-            unit="percentage",
-            common_field=CommonFields.TEST_POSITIVITY_7D,
-        ),
-    ]
-    results = dataset.query_multiple_variables(variables)
+    results = dataset.query_multiple_variables(VARIABLES)
     # Test positivity should be a ratio
     results.loc[:, CommonFields.TEST_POSITIVITY_7D] = (
         results.loc[:, CommonFields.TEST_POSITIVITY_7D] / 100.0
@@ -88,10 +93,14 @@ def main(fetch: bool):
     common_init.configure_logging()
     log = structlog.get_logger()
 
-    ccd_dataset = ccd_helpers.CovidCountyDataset.load(fetch=fetch)
-    all_df = transform(ccd_dataset)
+    if fetch:
+        ccd_helpers.CovidCountyDataset.fetch()
+
+    def write_output():
+        ccd_dataset = ccd_helpers.CovidCountyDataset.load(fetch=False, variables=VARIABLES)
+        common_df.write_csv(transform(ccd_dataset), OUTPUT_PATH, log)
 
-    common_df.write_csv(all_df, OUTPUT_PATH, log)
+    output_cache.write_if_changed(OUTPUT_PATH, INPUT_PATHS, CODE_PATHS, write_output, log)
 
 
 if __name__ == "__main__":
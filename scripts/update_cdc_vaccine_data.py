@@ -12,48 +12,53 @@ from covidactnow.datapublic.common_fields import CommonFields
 
 from scripts import helpers
 from scripts import ccd_helpers
+from scripts import output_cache
 
 Fields = ccd_helpers.Fields
 
 DATA_ROOT = pathlib.Path(__file__).parent.parent / "data"
 COUNTY_DATA_PATH = DATA_ROOT / "misc" / "fips_population.csv"
 OUTPUT_PATH = DATA_ROOT / "vaccines-cdc" / "timeseries-common.csv"
+# Files read by `transform` and source of the code producing OUTPUT_PATH, used by output_cache.
+INPUT_PATHS = [ccd_helpers.DATA_PATH]
+CODE_PATHS = [pathlib.Path(__file__), pathlib.Path(ccd_helpers.__file__)]
+
+
+VARIABLES = [
+    ccd_helpers.ScraperVariable(
+        variable_name="total_vaccine_allocated",
+        measurement="cumulative",
+        unit="doses",
+        provider="cdc",
+        common_field=CommonFields.VACCINES_ALLOCATED,
+    ),
+    ccd_helpers.ScraperVariable(
+        variable_name="total_vaccine_distributed",
+        measurement="cumulative",
+        unit="doses",
+        provider="cdc",
+        common_field=CommonFields.VACCINES_DISTRIBUTED,
+    ),
+    ccd_helpers.ScraperVariable(
+        variable_name="total_vaccine_initiated",
+        measurement="cumulative",
+        unit="people",
+        provider="cdc",
+        common_field=CommonFields.VACCINATIONS_INITIATED,
+    ),
+    ccd_helpers.ScraperVariable(
+        variable_name="total_vaccine_completed",
+        measurement="cumulative",
+        unit="people",
+        provider="cdc",
+        common_field=CommonFields.VACCINATIONS_COMPLETED,
+    ),
+]
 
 
 def transform(dataset: ccd_helpers.CovidCountyDataset):
 
-    variables = [
-        ccd_helpers.ScraperVariable(
-            variable_name="total_vaccine_allocated",
-            measurement="cumulative",
-            unit="doses",
-            provider="cdc",
-            common_field=CommonFields.VACCINES_ALLOCATED,
-        ),
-        ccd_helpers.ScraperVariable(
-            variable_name="total_vaccine_distributed",
-            measurement="cumulative",
-            unit="doses",
-            provider="cdc",
-            common_field=CommonFields.VACCINES_DISTRIBUTED,
-        ),
-        ccd_helpers.ScraperVariable(
-            variable_name="total_vaccine_initiated",
-            measurement="cumulative",
-            unit="people",
-            provider="cdc",
-            common_field=CommonFields.VACCINATIONS_INITIATED,
-        ),
-        ccd_helpers.ScraperVariable(
-            variable_name="total_vaccine_completed",
-            measurement="cumulative",
-            unit="people",
-            provider="cdc",
-            common_field=CommonFields.VACCINATIONS_COMPLETED,
-        ),
-    ]
-
-    results = dataset.query_multiple_variables(variables)
+    results = dataset.query_multiple_variables(VARIABLES)
     return results
 
 
@@ -63,10 +68,14 @@ def main(fetch: bool):
     common_init.configure_logging()
     log = structlog.get_logger()
 
-    ccd_dataset = ccd_helpers.CovidCountyDataset.load(fetch=fetch)
-    all_df = transform(ccd_dataset)
+    if fetch:
+        ccd_helpers.CovidCountyDataset.fetch()
+
+    def write_output():
+        ccd_dataset = ccd_helpers.CovidCountyDataset.load(fetch=False, variables=VARIABLES)
+        common_df.write_csv(transform(ccd_dataset), OUTPUT_PATH, log)
 
-    common_df.write_csv(all_df, OUTPUT_PATH, log)
+    output_cache.write_if_changed(OUTPUT_PATH, INPUT_PATHS, CODE_PATHS, write_output, log)
 
 
 if __name__ == "__main__":
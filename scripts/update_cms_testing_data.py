@@ -45,6 +45,7 @@ from covidactnow.datapublic.common_fields import CommonFields
 from covidactnow.datapublic.common_fields import FieldNameAndCommonField
 from covidactnow.datapublic.common_fields import GetByValueMixin
 from scripts import helpers
+from scripts import output_cache
 
 DATA_ROOT = pathlib.Path(os.path.realpath(__file__)).parent.parent / "data"
 CMS_TESTING_DATA_ROOT = DATA_ROOT / "testing-cms"
@@ -195,7 +196,13 @@ def main(replace_local_mirror: bool, generate_common_csv: bool):
         update_datasets()
 
     if generate_common_csv:
-        common_df.write_csv(transform_cms_datasets(), TIMESERIES_CSV_PATH, _logger)
+        output_cache.write_if_changed(
+            TIMESERIES_CSV_PATH,
+            # The archive directory also contains index.html, which isn't read by the transform.
+            sorted(ARCHIVE_DATASETS_PATH.glob("*.zip")),
+            [pathlib.Path(__file__)],
+            lambda: common_df.write_csv(transform_cms_datasets(), TIMESERIES_CSV_PATH, _logger),
+        )
 
 
 if __name__ == "__main__":
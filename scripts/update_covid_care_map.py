@@ -5,7 +5,6 @@ import pathlib
 import pandas as pd
 import click
 import pytz
-import requests
 import structlog
 
 from covidactnow.datapublic import common_df
@@ -13,7 +12,9 @@ from covidactnow.datapublic import common_init
 from covidactnow.datapublic.common_fields import CommonFields
 from covidactnow.datapublic.common_fields import FieldNameAndCommonField
 from covidactnow.datapublic.common_fields import GetByValueMixin
+from scripts import fetch_helpers
 from scripts import helpers
+from scripts import output_cache
 import us.states
 
 DATA_ROOT = pathlib.Path(__file__).parent.parent / "data"
@@ -83,10 +84,10 @@ class CovidCareMapUpdater(object):
 
     def update(self):
         structlog.get_logger().info("Updating Covid Care Map data.")
-        response = requests.get(self.COUNTY_DATA_URL)
-        self.output_path.write_bytes(response.content)
-        response = requests.get(self.STATE_DATA_URL)
-        self.state_output_path.write_bytes(response.content)
+        county_result = fetch_helpers.fetch(self.COUNTY_DATA_URL, self.output_path)
+        state_result = fetch_helpers.fetch(self.STATE_DATA_URL, self.state_output_path)
+        if not (county_result.changed or state_result.changed):
+            return
 
         version_path = self.version_path
         version_path.write_text(f"Updated at {self._stamp()}\n")
@@ -146,8 +147,13 @@ def main(fetch: bool):
     if fetch:
         updater.update()
 
-    df = updater.transform()
-    common_df.write_csv(df, STATIC_CSV_PATH, log, [CommonFields.FIPS])
+    output_cache.write_if_changed(
+        STATIC_CSV_PATH,
+        [updater.output_path, updater.state_output_path],
+        [pathlib.Path(__file__)],
+        lambda: common_df.write_csv(updater.transform(), STATIC_CSV_PATH, log, [CommonFields.FIPS]),
+        log,
+    )
 
 
 if __name__ == "__main__":
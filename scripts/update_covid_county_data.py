@@ -229,39 +229,19 @@ class CovidCountyDataTransformer:
             counties and states DataFrame objects
         """
         df[CommonFields.COUNTRY] = "USA"
-        # Partition df by region type so states and counties can by merged with different
-        # data to get their names.
+        region_metadata = helpers.load_region_metadata(self.county_fips_csv, self.census_state_path)
+        df = helpers.add_region_metadata(df, region_metadata)
+        # Partition df by region type. States without a match are dropped by `_drop_bad_rows`.
         state_mask = df[CommonFields.FIPS].str.len() == 2
         states = df.loc[state_mask, :]
         counties = df.loc[~state_mask, :]
-        fips_data = helpers.load_county_fips_data(self.county_fips_csv).set_index(
-            [CommonFields.FIPS]
-        )
-        counties = counties.merge(
-            fips_data[[CommonFields.STATE, CommonFields.COUNTY]],
-            left_on=[CommonFields.FIPS],
-            suffixes=(False, False),
-            how="left",
-            right_index=True,
-        )
-        no_match_counties_mask = counties.state.isna()
+        no_match_counties_mask = counties[CommonFields.STATE].isna()
         if no_match_counties_mask.sum() > 0:
             self.log.warning(
                 "Some counties did not match by fips",
                 bad_fips=counties.loc[no_match_counties_mask, CommonFields.FIPS].unique().tolist(),
             )
         counties = counties.loc[~no_match_counties_mask, :]
-        counties[CommonFields.AGGREGATE_LEVEL] = "county"
-
-        state_df = helpers.load_census_state(self.census_state_path).set_index(CommonFields.FIPS)
-        states = states.merge(
-            state_df[[CommonFields.STATE]],
-            left_on=[CommonFields.FIPS],
-            suffixes=(False, False),
-            how="left",
-            right_index=True,
-        )
-        states[CommonFields.AGGREGATE_LEVEL] = "state"
 
         return counties, states
 
@@ -6,7 +6,6 @@ import pathlib
 
 import click
 import pytz
-import requests
 import pandas as pd
 import numpy as np
 import structlog
@@ -16,7 +15,9 @@ from covidactnow.datapublic import common_init
 from covidactnow.datapublic.common_fields import CommonFields
 from covidactnow.datapublic.common_fields import FieldNameAndCommonField
 from covidactnow.datapublic.common_fields import GetByValueMixin
+from scripts import fetch_helpers
 from scripts import helpers
+from scripts import output_cache
 
 DATA_ROOT = pathlib.Path(__file__).parent.parent / "data"
 COVID_TRACKING_ROOT = DATA_ROOT / "covid-tracking"
@@ -34,8 +35,7 @@ _logger = logging.getLogger(__name__)
 
 def update_local_json():
     _logger.info("Fetching JSON")
-    response = requests.get(HISTORICAL_STATE_DATA_URL)
-    LOCAL_JSON_PATH.write_bytes(response.content)
+    fetch_helpers.fetch(HISTORICAL_STATE_DATA_URL, LOCAL_JSON_PATH)
 
 
 def load_local_json() -> pd.DataFrame:
@@ -212,11 +212,20 @@ def main(replace_local_mirror: bool, generate_common_csv: bool):
     if replace_local_mirror:
         update_local_json()
 
-    CovidTrackingDataUpdater().update()
+    log = structlog.get_logger()
+    code_paths = [pathlib.Path(__file__)]
+    updater = CovidTrackingDataUpdater()
+    output_cache.write_if_changed(
+        updater.output_path, [LOCAL_JSON_PATH], code_paths, updater.update, log
+    )
 
     if generate_common_csv:
-        common_df.write_csv(
-            transform(load_local_json()), TIMESERIES_CSV_PATH, structlog.get_logger(),
+        output_cache.write_if_changed(
+            TIMESERIES_CSV_PATH,
+            [LOCAL_JSON_PATH],
+            code_paths,
+            lambda: common_df.write_csv(transform(load_local_json()), TIMESERIES_CSV_PATH, log),
+            log,
         )
 
 
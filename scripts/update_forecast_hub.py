@@ -13,6 +13,7 @@ import zoltpy.util
 
 from covidactnow.datapublic import common_init, common_df
 from scripts import helpers
+from scripts import output_cache
 
 
 from covidactnow.datapublic.common_fields import (
@@ -224,9 +225,19 @@ def main(fetch: bool):
         _logger.info("Fetching new data.")
         transformer.update_source_data()
 
-    data = transformer.load_source_data()
-    data = transformer.transform(data)
-    common_df.write_csv(data, transformer.timeseries_output_path, _logger)
+    def write_output():
+        data = transformer.transform(transformer.load_source_data())
+        # The quantile output is large so write it in chunks to bound the memory used.
+        common_df.write_csv(
+            data, transformer.timeseries_output_path, _logger, chunk_rows=100_000
+        )
+
+    output_cache.write_if_changed(
+        transformer.timeseries_output_path,
+        [transformer.raw_path],
+        [pathlib.Path(__file__)],
+        write_output,
+    )
 
 
 if __name__ == "__main__":
@@ -1,23 +1,26 @@
 import enum
 import pathlib
-import pandas as pd
+
+import click
 import structlog
-import us
 
 from covidactnow.datapublic import common_df
 from covidactnow.datapublic import common_init
-from covidactnow.datapublic import census_data_helpers
 from covidactnow.datapublic.common_fields import CommonFields
 from covidactnow.datapublic.common_fields import FieldNameAndCommonField
 from covidactnow.datapublic.common_fields import GetByValueMixin
 
+from scripts import ccd_helpers
+from scripts import output_cache
 from scripts import helpers
 
 DATA_ROOT = pathlib.Path(__file__).parent.parent / "data"
 COUNTY_DATA_PATH = DATA_ROOT / "misc" / "fips_population.csv"
+STATE_DATA_PATH = DATA_ROOT / "misc" / "state.txt"
 OUTPUT_PATH = DATA_ROOT / "hospital-hhs" / "timeseries-common.csv"
-
-DATA_URL = "https://storage.googleapis.com/can-scrape-outputs/final/can_scrape_api_covid_us.parquet"
+# Files read by `update` and source of the code producing OUTPUT_PATH, used by output_cache.
+INPUT_PATHS = [ccd_helpers.DATA_PATH, COUNTY_DATA_PATH, STATE_DATA_PATH]
+CODE_PATHS = [pathlib.Path(__file__), pathlib.Path(ccd_helpers.__file__)]
 
 _logger = structlog.getLogger()
 
@@ -60,13 +63,12 @@ class Fields(GetByValueMixin, FieldNameAndCommonField, enum.Enum):
     HOSPITAL_BEDS_IN_USE_COVID = "hospital_beds_in_use_covid", CommonFields.CURRENT_HOSPITALIZED
 
 
-def update(data_url: str):
-
-    # TODO(tom): Switch to ccd_helpers. See
-    #  https://github.com/covid-projections/covid-data-public/pull/196
-    all_df = pd.read_parquet(data_url)
-
-    variables = [
+# Rows of these variables with either measurement are averaged by the pivot in `update`.
+VARIABLES = [
+    ccd_helpers.ScraperVariable(
+        variable_name=variable_name, provider="hhs", measurement=measurement, unit="beds"
+    )
+    for variable_name in [
         "adult_icu_beds_capacity",
         "adult_icu_beds_in_use",
         "hospital_beds_capacity",
@@ -74,24 +76,17 @@ def update(data_url: str):
         "adult_icu_beds_in_use_covid",
         "hospital_beds_in_use_covid",
     ]
-    unit = "beds"
-    measurements = ["current", "rolling_average_7_day"]
-
-    is_federal_hospital_data = (
-        (all_df[Fields.PROVIDER] == "hhs")
-        & (all_df[Fields.VARIABLE_NAME].isin(variables))
-        & (all_df[Fields.MEASUREMENT].isin(measurements))
-        & (all_df[Fields.UNIT] == unit)
-        & (all_df[Fields.AGE] == "all")
-        & (all_df[Fields.RACE] == "all")
-        & (all_df[Fields.SEX] == "all")
-    )
+    for measurement in ["current", "rolling_average_7_day"]
+]
+
+
+def update(dataset: ccd_helpers.CovidCountyDataset):
 
     # Subset only to hospital data we want.
-    df = all_df.loc[is_federal_hospital_data].copy()
+    df = dataset.select_rows(VARIABLES)
 
-    # Add FIPS column.
-    df[Fields.FIPS] = helpers.fips_from_int(df[Fields.LOCATION])
+    # Add FIPS column. CovidCountyDataset has already transformed the location to a FIPS.
+    df[Fields.FIPS] = df[Fields.LOCATION]
 
     # Subset only to columns we want.
     df = df[[Fields.FIPS, Fields.DATE, Fields.VARIABLE_NAME, Fields.VALUE]]
@@ -106,27 +101,10 @@ def update(data_url: str):
     # Rename to common fields.
     wide_df = helpers.rename_fields(wide_df, Fields, set(), _logger)
 
-    # Split counties and states.
-    counties_df = wide_df.loc[wide_df[Fields.FIPS].str.len() == 5].copy()
-    states_df = wide_df.loc[wide_df[Fields.FIPS].str.len() == 2].copy()
-
-    # Add county metadata.
-    census_data = census_data_helpers.load_county_fips_data(COUNTY_DATA_PATH).data
-    census_data = census_data.set_index(CommonFields.FIPS)
-    counties_df[CommonFields.COUNTY] = counties_df[Fields.FIPS].map(
-        census_data[CommonFields.COUNTY]
-    )
-    counties_df[CommonFields.STATE] = counties_df[Fields.FIPS].map(census_data[CommonFields.STATE])
-    counties_df[CommonFields.AGGREGATE_LEVEL] = "county"
-
-    # Add state metadata.
-    states_df[CommonFields.STATE] = states_df[Fields.FIPS].apply(
-        lambda fips: us.states.lookup(fips).abbr
-    )
-    states_df[CommonFields.AGGREGATE_LEVEL] = "state"
-
-    # Merge counties and states back together.
-    out_df = pd.concat([counties_df, states_df])
+    # Keep only counties and states and add their metadata.
+    wide_df = wide_df.loc[wide_df[Fields.FIPS].str.len().isin([2, 5])]
+    region_metadata = helpers.load_region_metadata(COUNTY_DATA_PATH, STATE_DATA_PATH)
+    out_df = helpers.add_region_metadata(wide_df, region_metadata)
 
     # Add country metadata.
     out_df[CommonFields.COUNTRY] = "USA"
@@ -137,20 +115,23 @@ def update(data_url: str):
 
 
 def filter_early_data(df):
-    keep_rows = df[CommonFields.DATE.value] >= pd.to_datetime(DEFAULT_START_DATE)
-    df = df.loc[keep_rows]
+    return helpers.filter_start_dates(df, DEFAULT_START_DATE, CUSTOM_START_DATES)
 
-    for (fips, start_date) in CUSTOM_START_DATES.items():
-        keep_rows = (df[Fields.FIPS] != fips) | (
-            df[CommonFields.DATE] >= pd.to_datetime(start_date)
-        )
-        df = df.loc[keep_rows]
 
-    return df
+@click.command()
+@click.option("--fetch/--no-fetch", default=True)
+def main(fetch: bool):
+    common_init.configure_logging()
 
+    if fetch:
+        ccd_helpers.CovidCountyDataset.fetch()
 
-if __name__ == "__main__":
+    def write_output():
+        ccd_dataset = ccd_helpers.CovidCountyDataset.load(fetch=False, variables=VARIABLES)
+        common_df.write_csv(update(ccd_dataset), OUTPUT_PATH, _logger)
 
-    common_init.configure_logging()
-    all_df = update(DATA_URL)
-    common_df.write_csv(all_df, OUTPUT_PATH, _logger)
+    output_cache.write_if_changed(OUTPUT_PATH, INPUT_PATHS, CODE_PATHS, write_output, _logger)
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
@@ -2,11 +2,11 @@
 # https://healthdata.gov/dataset/covid-19-diagnostic-laboratory-testing-pcr-testing-time-series
 
 import enum
+import json
 import os
 import pathlib
 
 import click
-import requests
 import pandas as pd
 import structlog
 
@@ -15,7 +15,9 @@ from covidactnow.datapublic import common_init
 from covidactnow.datapublic.common_fields import CommonFields
 from covidactnow.datapublic.common_fields import FieldNameAndCommonField
 from covidactnow.datapublic.common_fields import GetByValueMixin
+from scripts import fetch_helpers
 from scripts import helpers
+from scripts import output_cache
 
 DATA_ROOT = pathlib.Path(os.path.realpath(__file__)).parent.parent / "data"
 HHS_TESTING_DATA_ROOT = DATA_ROOT / "testing-hhs"
@@ -32,15 +34,15 @@ _logger = structlog.getLogger()
 def update_dataset_csv():
     # Fetch the JSON metadata to get the latest CSV url.
     _logger.info("Fetching metadata JSON", {"url": METADATA_URL, "path": METADATA_JSON_PATH})
-    response = requests.get(METADATA_URL)
-    METADATA_JSON_PATH.write_bytes(response.content)
-    metadata = response.json()
+    fetch_helpers.fetch(METADATA_URL, METADATA_JSON_PATH)
+    metadata = json.loads(METADATA_JSON_PATH.read_bytes())
 
     # Fetch the latest CSV.
     dataset_url = metadata["result"][0]["resources"][0]["url"]
     _logger.info("Fetching Dataset", {"url": dataset_url, "path": DATASET_CSV_PATH})
-    response = requests.get(dataset_url)
-    DATASET_CSV_PATH.write_bytes(response.content)
+    if not fetch_helpers.fetch(dataset_url, DATASET_CSV_PATH).changed:
+        _logger.info("Dataset unchanged", url=dataset_url)
+        return
 
     # Update version.txt file.
     VERSION_PATH.write_text(f"Updated at {helpers.version_timestamp()} from {dataset_url}\n")
@@ -97,7 +99,7 @@ def main(replace_local_mirror: bool, generate_common_csv: bool):
     if replace_local_mirror:
         update_dataset_csv()
 
-    if generate_common_csv:
+    def write_output():
         dataset = pd.read_csv(
             DATASET_CSV_PATH,
             parse_dates=[Fields.DATE],
@@ -109,6 +111,11 @@ def main(replace_local_mirror: bool, generate_common_csv: bool):
             transform(dataset), TIMESERIES_CSV_PATH, _logger,
         )
 
+    if generate_common_csv:
+        output_cache.write_if_changed(
+            TIMESERIES_CSV_PATH, [DATASET_CSV_PATH], [pathlib.Path(__file__)], write_output
+        )
+
 
 if __name__ == "__main__":
     main()  # pylint: disable=no-value-for-parameter
@@ -1,4 +1,4 @@
-from typing import Dict, Tuple, List
+from typing import Tuple, List
 import enum
 import logging
 import datetime
@@ -8,6 +8,7 @@ import tempfile
 
 import pathlib
 import requests
+import numpy as np
 import pandas as pd
 import pydantic
 import structlog
@@ -21,9 +22,13 @@ from covidactnow.datapublic.common_fields import (
     COMMON_FIELDS_TIMESERIES_KEYS,
     FieldNameAndCommonField,
 )
+from scripts import fetch_helpers
 from scripts import helpers
+from scripts import output_cache
 
 DATA_ROOT = pathlib.Path(__file__).parent.parent / "data"
+# Source of the code producing the output, used by output_cache.
+CODE_PATHS = [pathlib.Path(__file__)]
 _logger = structlog.get_logger(__name__)
 
 
@@ -120,9 +125,16 @@ COUNTY_BACKFILLED_CASES = [
 ]
 
 
-def _calculate_county_adjustments(
-    data: pd.DataFrame, date: str, backfilled_cases: int, state_fips: str
-) -> Dict[str, int]:
+def _backfills_df(backfilled_cases: List[Tuple[str, str, int]]) -> pd.DataFrame:
+    """Returns `backfilled_cases` as a DataFrame with columns FIPS, DATE and CASES."""
+    backfills = pd.DataFrame(
+        backfilled_cases, columns=[CommonFields.FIPS, CommonFields.DATE, CommonFields.CASES]
+    )
+    backfills[CommonFields.DATE] = pd.to_datetime(backfills[CommonFields.DATE])
+    return backfills
+
+
+def _calculate_county_adjustments(data: pd.DataFrame, backfills: pd.DataFrame) -> pd.DataFrame:
     """Calculating number of cases to remove per county, weighted on number of new cases per county.
 
     Weighting on number of new cases per county gives a reasonable measure of where the backfilled
@@ -130,28 +142,76 @@ def _calculate_county_adjustments(
 
     Args:
         data: Input Data.
-        date: Date of backfill.
-        backfilled_cases: Number of backfilled cases.
-        state_fips: FIPS code for state.
+        backfills: State backfills, with columns FIPS of the state, DATE and CASES.
 
-    Returns: Dictionary of estimated fips -> backfilled cases.
+    Returns: DataFrame of estimated backfilled cases with columns FIPS of the county, DATE and CASES.
     """
-    is_state = data[CommonFields.FIPS].str.match(f"{state_fips}[0-9][0-9][0-9]")
-    is_not_unknown = data[CommonFields.FIPS] != f"{state_fips}999"
-    if not (is_not_unknown & is_state).any():
-        return {}
-
-    fields = [CommonFields.DATE, CommonFields.FIPS, CommonFields.CASES]
-    cases = (
-        data.loc[is_state & is_not_unknown, fields]
-        .set_index([CommonFields.FIPS, CommonFields.DATE])
-        .sort_index()
+    fips = data[CommonFields.FIPS]
+    state_fips = fips.str[:2]
+    is_county = (
+        state_fips.isin(backfills[CommonFields.FIPS])
+        & fips.str.match("[0-9]{5}", na=False)
+        & (fips != state_fips + "999")
+    )
+    fields = [CommonFields.FIPS, CommonFields.DATE, CommonFields.CASES]
+    cases = data.loc[is_county, fields].sort_values(
+        [CommonFields.FIPS, CommonFields.DATE], kind="mergesort"
+    )
+    cases["state_fips"] = cases[CommonFields.FIPS].str[:2]
+    cases["new_cases"] = cases.groupby(CommonFields.FIPS, sort=False)[CommonFields.CASES].diff()
+
+    backfills = (
+        backfills.rename(
+            columns={CommonFields.FIPS: "state_fips", CommonFields.CASES: "backfilled_cases"}
+        )
+        .rename_axis(index="backfill")
+        .reset_index()
+    )
+    cases_on_date = cases.drop(columns=CommonFields.CASES).merge(
+        backfills, on=["state_fips", CommonFields.DATE]
     )
-    cases = cases.diff().reset_index(level=1)
-    cases_on_date = cases[cases.date == date]["cases"]
+    state_new_cases = cases_on_date.groupby("backfill")["new_cases"].transform("sum")
     # For states with more counties, rounding could lead to the sum of the counties diverging from
     # the backfilled cases count.
-    return (cases_on_date / cases_on_date.sum() * backfilled_cases).round().to_dict()
+    cases_on_date[CommonFields.CASES] = (
+        cases_on_date["new_cases"] / state_new_cases * cases_on_date["backfilled_cases"]
+    ).round()
+    cases_on_date = cases_on_date.dropna(subset=[CommonFields.CASES])
+    return cases_on_date.loc[:, fields].astype({CommonFields.CASES: "int64"})
+
+
+def _subtract_backfilled_cases(data: pd.DataFrame, adjustments: pd.DataFrame) -> pd.DataFrame:
+    """Subtracts adjustments from the cases of the same FIPS on and after the adjustment date.
+
+    Args:
+        data: Data
+        adjustments: DataFrame with columns FIPS, DATE and CASES to subtract.
+
+    Returns: Updated data frame.
+    """
+    # Cumulative sum of the adjustments of each FIPS, in date order.
+    offsets = adjustments.groupby([CommonFields.FIPS, CommonFields.DATE])[CommonFields.CASES].sum()
+    offsets = offsets.groupby(level=0).cumsum().reset_index()
+
+    is_adjusted = data[CommonFields.FIPS].isin(offsets[CommonFields.FIPS]) & (
+        data[CommonFields.DATE].notna()
+    )
+    if not is_adjusted.any():
+        return data
+
+    # Find the offset of the latest adjustment on or before the date of each row.
+    rows = data.loc[is_adjusted, [CommonFields.FIPS, CommonFields.DATE]]
+    rows["position"] = np.flatnonzero(is_adjusted)
+    rows = pd.merge_asof(
+        rows.sort_values(CommonFields.DATE, kind="mergesort"),
+        offsets.sort_values(CommonFields.DATE, kind="mergesort"),
+        on=CommonFields.DATE,
+        by=CommonFields.FIPS,
+    )
+    row_offsets = np.zeros(len(data), dtype="int64")
+    row_offsets[rows["position"]] = rows[CommonFields.CASES].fillna(0)
+    data[CommonFields.CASES] = data[CommonFields.CASES] - row_offsets
+    return data
 
 
 def remove_state_backfilled_cases(
@@ -165,19 +225,10 @@ def remove_state_backfilled_cases(
 
     Returns: Updated data frame.
     """
-    for state_fips, date, cases in backfilled_cases:
-        adjustments = _calculate_county_adjustments(data, date, cases, state_fips)
-        is_on_or_after_date = data[CommonFields.DATE] >= date
-        for fips, count in adjustments.items():
-            is_fips_data_after_date = is_on_or_after_date & (data[CommonFields.FIPS] == fips)
-            data.loc[is_fips_data_after_date, CommonFields.CASES] -= int(count)
-
-        # Remove state counts also.
-        is_fips_data_after_date = is_on_or_after_date & (data[CommonFields.FIPS] == state_fips)
-        if is_fips_data_after_date.any():
-            data.loc[is_fips_data_after_date, CommonFields.CASES] -= cases
-
-    return data
+    backfills = _backfills_df(backfilled_cases)
+    adjustments = _calculate_county_adjustments(data, backfills)
+    # Remove state counts also.
+    return _subtract_backfilled_cases(data, pd.concat([adjustments, backfills]))
 
 
 def remove_county_backfilled_cases(
@@ -191,18 +242,10 @@ def remove_county_backfilled_cases(
 
     Returns: Updated data frame.
     """
-    for county_fips, date, cases in backfilled_cases:
-        is_on_or_after_date = data[CommonFields.DATE] >= date
-        is_fips_data_after_date = is_on_or_after_date & (data[CommonFields.FIPS] == county_fips)
-        data.loc[is_fips_data_after_date, CommonFields.CASES] -= cases
-
-        # Remove county count from state counts as well
-        state_fips = helpers.extract_state_fips(county_fips)
-        is_fips_data_after_date = is_on_or_after_date & (data[CommonFields.FIPS] == state_fips)
-        if is_fips_data_after_date.any():
-            data.loc[is_fips_data_after_date, CommonFields.CASES] -= cases
-
-    return data
+    backfills = _backfills_df(backfilled_cases)
+    # Remove county count from state counts as well
+    state_backfills = backfills.assign(**{CommonFields.FIPS: backfills[CommonFields.FIPS].str[:2]})
+    return _subtract_backfilled_cases(data, pd.concat([backfills, state_backfills]))
 
 
 def _remove_ma_county_zeroes_data(
@@ -239,6 +282,53 @@ def _remove_ma_county_zeroes_data(
     )
 
 
+def _state_fips(data: pd.DataFrame) -> pd.Series:
+    """Returns the state FIPS of each row, found from the state name for rows without a FIPS."""
+    state_fips = data[CommonFields.FIPS].str[:2]
+    is_state = data[CommonFields.AGGREGATE_LEVEL] == "state"
+    fips_by_name = state_fips[is_state].groupby(data.loc[is_state, CommonFields.STATE_FULL_NAME])
+    return state_fips.fillna(data[CommonFields.STATE_FULL_NAME].map(fips_by_name.first()))
+
+
+def _first_changed_date_by_state(previous_data: pd.DataFrame, data: pd.DataFrame) -> pd.Series:
+    """Compares two versions of the raw data and returns the first date with a change of each state.
+
+    Args:
+        previous_data: Previous version of the data, as returned by `load_state_and_county_data`.
+        data: New version of the data.
+
+    Returns: Series of the first changed date, indexed by state FIPS of the changed states.
+    """
+    previous_hashes = pd.util.hash_pandas_object(previous_data, index=False)
+    hashes = pd.util.hash_pandas_object(data, index=False)
+
+    # A content hash of each date is the sum of the row hashes, which doesn't depend on row order.
+    previous_date_hashes = previous_hashes.groupby(previous_data[CommonFields.DATE].values).sum()
+    date_hashes = hashes.groupby(data[CommonFields.DATE].values).sum()
+    dates = previous_date_hashes.index.union(date_hashes.index)
+    is_changed_date = previous_date_hashes.reindex(dates, fill_value=0) != date_hashes.reindex(
+        dates, fill_value=0
+    )
+    changed_dates = dates[is_changed_date.values]
+
+    def changed_date_rows(df: pd.DataFrame, row_hashes: pd.Series) -> pd.DataFrame:
+        is_on_changed_date = df[CommonFields.DATE].isin(changed_dates).values
+        return pd.DataFrame(
+            {
+                "state_fips": _state_fips(df).values[is_on_changed_date],
+                CommonFields.DATE: df[CommonFields.DATE].values[is_on_changed_date],
+                "hash": row_hashes.values[is_on_changed_date],
+            }
+        )
+
+    # Rows that are only in one version are new, removed or modified.
+    rows = changed_date_rows(previous_data, previous_hashes).merge(
+        changed_date_rows(data, hashes), how="outer", indicator=True
+    )
+    changed_rows = rows.loc[rows["_merge"] != "both"]
+    return changed_rows.groupby("state_fips")[CommonFields.DATE].min()
+
+
 @enum.unique
 class Fields(GetByValueMixin, FieldNameAndCommonField, enum.Enum):
     DATE = "date", CommonFields.DATE
@@ -300,6 +390,11 @@ class NYTimesUpdater(pydantic.BaseModel):
     def state_path(self) -> pathlib.Path:
         return self.raw_data_root / self.STATE_CSV_FILENAME
 
+    @property
+    def input_paths(self) -> List[pathlib.Path]:
+        """Files read to write `timeseries_output_path`, used by output_cache."""
+        return [self.county_path, self.state_path, self.state_census_path]
+
     def get_master_commit_sha(self) -> str:
         # Getting the master commit of the states file as the master URL may contain
         # changes not applicable to the files we download.
@@ -328,12 +423,10 @@ class NYTimesUpdater(pydantic.BaseModel):
     def update_source_data(self):
         git_sha = self.get_master_commit_sha()
         _logger.info(f"Updating version file with nytimes revision {git_sha}")
-        state_data = requests.get(self.state_url).content
-        self.state_path.write_bytes(state_data)
-
-        county_data = requests.get(self.county_url).content
-        self.county_path.write_bytes(county_data)
-        self.write_version_file(git_sha)
+        state_result = fetch_helpers.fetch(self.state_url, self.state_path, log=_logger)
+        county_result = fetch_helpers.fetch(self.county_url, self.county_path, log=_logger)
+        if state_result.changed or county_result.changed:
+            self.write_version_file(git_sha)
 
     def load_state_and_county_data(self) -> pd.DataFrame:
         """Loads state and county data in one dataset, renaming fields to common field names. """
@@ -379,11 +472,93 @@ class NYTimesUpdater(pydantic.BaseModel):
 
         return data
 
+    def transform_incrementally(
+        self, previous_data: pd.DataFrame, data: pd.DataFrame
+    ) -> pd.DataFrame:
+        """Transforms `data`, reusing rows of the existing output that are not changed by it.
+
+        The transform of a row only depends on rows of the same state on the same or an earlier
+        date so rows of a state on and after the first date that changed since `previous_data`
+        are transformed and replaced in the existing output. The output is the same as
+        `transform(data)` only if the existing output was written by `transform(previous_data)`
+        using the same code and backfill lists.
+
+        Args:
+            previous_data: Data that the existing output was transformed from.
+            data: New data.
+
+        Returns: Transformed data of all states.
+        """
+        existing = common_df.read_csv(self.timeseries_output_path, set_index=False)
+        first_changed_dates = _first_changed_date_by_state(previous_data, data)
+        _logger.info(
+            "Transforming changed states",
+            states=first_changed_dates.index.tolist(),
+            first_changed_date=first_changed_dates.min(),
+        )
+        if first_changed_dates.empty:
+            return existing
+
+        data = data.loc[_state_fips(data).isin(first_changed_dates.index)].copy()
+        transformed = self.transform(data)
+
+        def is_changed(df: pd.DataFrame) -> pd.Series:
+            return df[CommonFields.DATE] >= _state_fips(df).map(first_changed_dates)
+
+        return pd.concat(
+            [existing.loc[~is_changed(existing)], transformed.loc[is_changed(transformed)]]
+        )
+
+
+def update(
+    transformer: NYTimesUpdater,
+    *,
+    fetch: bool,
+    incremental: bool,
+    code_paths: List[pathlib.Path] = CODE_PATHS,
+):
+    """Fetches the raw data and writes the output unless its inputs and code are unchanged.
+
+    With `incremental`, only states with changes since the raw data on disk are transformed again,
+    but only if the existing output was written from that raw data by the current code. Otherwise
+    the spliced output could differ from a full rebuild, so all states are transformed.
+    """
+    output_path = transformer.timeseries_output_path
+    previous_data = None
+    if incremental:
+        if output_cache.is_up_to_date(output_path, transformer.input_paths, code_paths):
+            if fetch and not transformer.is_new_data_available():
+                _logger.info("No new data available")
+                return
+            # Read the raw data before it is replaced by the fetch.
+            previous_data = transformer.load_state_and_county_data()
+        else:
+            _logger.info("Output not up to date with raw data and code, transforming all states")
+
+    if fetch:
+        _logger.info("Fetching new data.")
+        transformer.update_source_data()
+
+    def write_output():
+        data = transformer.load_state_and_county_data()
+        if previous_data is not None:
+            data = transformer.transform_incrementally(previous_data, data)
+        else:
+            data = transformer.transform(data)
+        common_df.write_csv(data, output_path, _logger)
+
+    output_cache.write_if_changed(output_path, transformer.input_paths, code_paths, write_output)
+
 
 @click.command()
 @click.option("--check-for-new-data", is_flag=True)
 @click.option("--fetch/--no-fetch", default=True)
-def main(check_for_new_data: bool, fetch: bool):
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Only transform states with changes since the raw data used for the existing output.",
+)
+def main(check_for_new_data: bool, fetch: bool, incremental: bool):
     common_init.configure_logging()
     transformer = NYTimesUpdater.make_with_data_root(DATA_ROOT)
 
@@ -393,13 +568,7 @@ def main(check_for_new_data: bool, fetch: bool):
         _logger.info("New data available")
         return
 
-    if fetch:
-        _logger.info("Fetching new data.")
-        transformer.update_source_data()
-
-    data = transformer.load_state_and_county_data()
-    data = transformer.transform(data)
-    common_df.write_csv(data, transformer.timeseries_output_path, _logger)
+    update(transformer, fetch=fetch, incremental=incremental)
 
 
 if __name__ == "__main__":
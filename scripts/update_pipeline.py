@@ -0,0 +1,291 @@
+"""Runs the updaters of update.sh, starting each as soon as the updaters it depends on finish.
+
+Each updater is a `Node` declaring the files, relative to `DATA_ROOT`, that it reads and writes.
+A node depends on every node writing one of its inputs. Independent nodes run concurrently, each
+in its own process forked from the pipeline, so each updater is started without paying for a
+new interpreter and the imports of pandas etc. but doesn't share module state with other nodes.
+
+A node that isn't `fatal` fails like the `|| echo` lines of the old update.sh: the failure is
+logged and nodes using its outputs still run, with the existing files. After a fatal failure no
+new node is started and the pipeline exits with an error once running nodes finish.
+"""
+import dataclasses
+import enum
+import importlib
+import multiprocessing
+import multiprocessing.connection
+import pathlib
+import sys
+import time
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Sequence
+from typing import Set
+from typing import Tuple
+
+import click
+import pandas as pd
+import structlog
+
+from covidactnow.datapublic import common_init
+
+
+DATA_ROOT = pathlib.Path(__file__).parent.parent / "data"
+
+_logger = structlog.getLogger()
+
+
+@dataclasses.dataclass(frozen=True)
+class Node:
+    """An updater script run by the pipeline."""
+
+    name: str
+    # Module with a click command named `main`, such as "scripts.update_nytimes_data".
+    module: str
+    args: Tuple[str, ...] = ()
+    # Paths, relative to DATA_ROOT, read by the updater that are written by other nodes.
+    inputs: Tuple[str, ...] = ()
+    # Paths, relative to DATA_ROOT, written by the updater.
+    outputs: Tuple[str, ...] = ()
+    fatal: bool = True
+
+
+NODES: List[Node] = [
+    Node(
+        "covid-tracking",
+        "scripts.update_covid_tracking_data",
+        outputs=("covid-tracking/states.json", "covid-tracking/timeseries.csv"),
+    ),
+    # TODO(brett): Change CCM to static file from 2018 Hospital Survey
+    # Node("covid-care-map", "scripts.update_covid_care_map", outputs=("covid-care-map",)),
+    Node(
+        "nytimes",
+        "scripts.update_nytimes_data",
+        outputs=("cases-nytimes/timeseries-common.csv", "cases-nytimes/version.txt"),
+    ),
+    Node("test-and-trace", "scripts.update_test_and_trace", outputs=("test-and-trace",)),
+    # Runs all the updaters that use ccd_helpers.py, loading the can-scrape file once.
+    Node(
+        "can-scrape",
+        "scripts.update_can_scrape_sources",
+        args=("--fetch",),
+        outputs=(
+            "can-scrape/can_scrape_api_covid_us.parquet",
+            "can-scrapers-state-providers/timeseries-common.csv",
+            "testing-cdc/timeseries-common.csv",
+            "vaccines-cdc/timeseries-common.csv",
+            "hospital-hhs/timeseries-common.csv",
+        ),
+    ),
+    # TODO(https://trello.com/c/PeQXdUCU): Fix Texas hospitalizations.
+    Node(
+        "texas-tsa-hospitalizations",
+        "scripts.update_texas_tsa_hospitalizations",
+        outputs=("states/tx/tx_tsa_hospitalizations.csv",),
+        fatal=False,
+    ),
+    Node(
+        "texas-fips-hospitalizations",
+        "scripts.update_texas_fips_hospitalizations",
+        inputs=("states/tx/tx_tsa_hospitalizations.csv", "states/tx/tx_tsa_region_fips_map.csv"),
+        outputs=("states/tx/tx_fips_hospitalizations.csv",),
+    ),
+    Node(
+        "forecast-hub",
+        "scripts.update_forecast_hub",
+        outputs=("forecast-hub/timeseries-common.csv", "forecast-hub/version.txt"),
+        fatal=False,
+    ),
+    Node(
+        "covid-county-data",
+        "scripts.update_covid_county_data",
+        outputs=(
+            "cases-covid-county-data/timeseries-common.csv",
+            "cases-covid-county-data/timeseries-usafacts.csv",
+        ),
+    ),
+    # AWS Lake seems to be hanging the build right now.
+    # Node(
+    #     "aws-lake",
+    #     "scripts.update_aws_lake",
+    #     args=("--replace-local-mirror", "--cleanup-local-mirror"),
+    #     outputs=("aws-lake",),
+    # ),
+    Node("hhs-testing", "scripts.update_hhs_testing_data", outputs=("testing-hhs",)),
+    # TODO(michael): Make this non-fatal once we have more trust and are relying on
+    # this data.
+    Node("cms-testing", "scripts.update_cms_testing_data", outputs=("testing-cms",), fatal=False),
+]
+
+
+class NodeStatus(enum.Enum):
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    SKIPPED = "skipped"
+
+
+def _overlaps(path_a: str, path_b: str) -> bool:
+    """Returns True if one of the paths is the same as or inside the other."""
+    parts_a, parts_b = pathlib.PurePosixPath(path_a).parts, pathlib.PurePosixPath(path_b).parts
+    shortest = min(len(parts_a), len(parts_b))
+    return parts_a[:shortest] == parts_b[:shortest]
+
+
+def build_dependencies(nodes: Sequence[Node]) -> Dict[str, Set[str]]:
+    """Returns the names of the nodes each node depends on, raising if they contain a cycle."""
+    names = [node.name for node in nodes]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Duplicate node names: {names}")
+
+    dependencies = {
+        node.name: {
+            other.name
+            for other in nodes
+            if other is not node
+            and any(_overlaps(i, o) for i in node.inputs for o in other.outputs)
+        }
+        for node in nodes
+    }
+
+    ordered: Set[str] = set()
+    remaining = set(names)
+    while remaining:
+        ready = {name for name in remaining if dependencies[name] <= ordered}
+        if not ready:
+            raise ValueError(f"Dependency cycle between nodes: {sorted(remaining)}")
+        ordered |= ready
+        remaining -= ready
+    return dependencies
+
+
+def run_node(module: str, args: Sequence[str]):
+    """Runs the click command `main` of `module`, raising if it exits with an error code.
+
+    Called in the process of a node.
+    """
+    command = importlib.import_module(module).main
+    # Without standalone mode click returns the code passed to `ctx.exit` instead of exiting.
+    exit_code = command.main(args=list(args), prog_name=module, standalone_mode=False)
+    if isinstance(exit_code, int) and exit_code != 0:
+        raise Exception(f"{module} exited with code {exit_code}")
+
+
+def _run_node_process(module: str, args: Sequence[str]):
+    """Target of the process of a node, which exits with 1 if the node fails."""
+    try:
+        run_node(module, args)
+    except Exception:
+        _logger.exception("Node raised an exception", module=module)
+        sys.exit(1)
+
+
+@dataclasses.dataclass(frozen=True)
+class NodeResult:
+    name: str
+    status: NodeStatus
+    seconds: float
+
+
+def run_pipeline(nodes: Sequence[Node], jobs: int) -> List[NodeResult]:
+    """Runs `nodes` in dependency order with up to `jobs` at a time, returning a result per node.
+
+    Each node runs in a new process, so pandas options and caches set by one node aren't seen by
+    others. It isn't a daemon process, so the node can start processes of its own. A node
+    raising an exception or exiting with an error code is logged and returned as a FAILED result.
+    """
+    dependencies = build_dependencies(nodes)
+    pending: Dict[str, Node] = {node.name: node for node in nodes}
+    # Node, process and start time of each running node, by the sentinel of its process.
+    running: Dict[int, Tuple[Node, multiprocessing.Process, float]] = {}
+    results: Dict[str, NodeResult] = {}
+    stopped = False
+
+    try:
+        while pending or running:
+            if not stopped:
+                unfinished = set(pending) | {node.name for node, _, _ in running.values()}
+                ready = [
+                    node for node in pending.values() if not (dependencies[node.name] & unfinished)
+                ]
+                for node in ready[: jobs - len(running)]:
+                    del pending[node.name]
+                    _logger.info("Starting node", node=node.name)
+                    process = multiprocessing.Process(
+                        target=_run_node_process, args=(node.module, node.args), name=node.name
+                    )
+                    process.start()
+                    running[process.sentinel] = (node, process, time.monotonic())
+            if not running:
+                break
+
+            for sentinel in multiprocessing.connection.wait(list(running)):
+                node, process, start = running.pop(sentinel)
+                process.join()
+                log = _logger.bind(node=node.name)
+                seconds = time.monotonic() - start
+                if process.exitcode == 0:
+                    status = NodeStatus.SUCCEEDED
+                    log.info("Finished node", seconds=round(seconds, 1))
+                else:
+                    status = NodeStatus.FAILED
+                    if node.fatal:
+                        log.error(
+                            "Node failed, not starting any more nodes", exit_code=process.exitcode
+                        )
+                        stopped = True
+                    else:
+                        log.error(
+                            f"Failed to update {node.name}, continuing", exit_code=process.exitcode
+                        )
+                results[node.name] = NodeResult(node.name, status, seconds)
+    finally:
+        for _, process, _ in running.values():
+            process.join()
+
+    for name in pending:
+        results[name] = NodeResult(name, NodeStatus.SKIPPED, 0.0)
+    return [results[node.name] for node in nodes]
+
+
+def format_timing_table(results: Iterable[NodeResult]) -> str:
+    df = pd.DataFrame(
+        [(r.name, r.status.value, round(r.seconds, 1)) for r in results],
+        columns=["node", "status", "seconds"],
+    )
+    return df.to_string(index=False)
+
+
+@click.command()
+@click.option(
+    "--jobs", default=4, show_default=True, help="Nodes run at the same time, each in a process."
+)
+@click.option(
+    "--only",
+    multiple=True,
+    help="Name of a node to run, may be repeated. By default all nodes are run.",
+)
+def main(jobs: int, only: Tuple[str, ...]):
+    common_init.configure_logging()
+
+    nodes = NODES
+    if only:
+        unknown = set(only) - {node.name for node in NODES}
+        if unknown:
+            raise click.BadParameter(f"Unknown nodes: {', '.join(sorted(unknown))}")
+        nodes = [node for node in NODES if node.name in only]
+
+    results = run_pipeline(nodes, jobs)
+    click.echo(format_timing_table(results))
+
+    failed_fatal = [
+        r.name
+        for r, node in zip(results, nodes)
+        if node.fatal and r.status is not NodeStatus.SUCCEEDED
+    ]
+    if failed_fatal:
+        raise Exception(f"Failed to update: {', '.join(failed_fatal)}")
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
@@ -12,6 +12,7 @@ from covidactnow.datapublic import common_df
 from covidactnow.datapublic import common_init
 from covidactnow.datapublic.common_fields import CommonFields
 from scripts import helpers
+from scripts import output_cache
 
 # Cam gave Tom this URL in a DM in https://testandtrace.slack.com/
 # The sheet name is "Data for CovidActNow"; I'm concerned that it isn't updated as part of their regular data push.
@@ -68,6 +69,15 @@ class TestAndTraceSyncer(BaseModel):
             todays_file_path = self.gsheets_copy_directory / todays_filename
             todays_file_path.write_bytes(requests.get(self.source_url).content)
 
+        output_cache.write_if_changed(
+            self.state_timeseries_path,
+            [self.census_state_path, self.gsheets_copy_directory],
+            [pathlib.Path(__file__)],
+            lambda: self.write_timeseries(log),
+            log,
+        )
+
+    def write_timeseries(self, log):
         result = pd.DataFrame.from_records(
             self.yield_dict_per_state_date(),
             columns=["fips", "state", "date", "contact_tracers_count"],
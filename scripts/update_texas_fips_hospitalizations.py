@@ -1,5 +1,6 @@
 import enum
 import pathlib
+import click
 import pandas as pd
 import pydantic
 import structlog
@@ -8,9 +9,11 @@ from covidactnow.datapublic.common_fields import CommonFields
 from covidactnow.datapublic import common_init
 from covidactnow.datapublic import census_data_helpers
 from covidactnow.datapublic import common_df
+from scripts import output_cache
 
 
 DATA_ROOT = pathlib.Path(__file__).parent.parent / "data"
+OUTPUT_CSV = DATA_ROOT / "states" / "tx" / "tx_fips_hospitalizations.csv"
 TSA_HOSPITALIZATIONS_URL = (
     "https://www.dshs.texas.gov/coronavirus/TexasCOVID-19HospitalizationsOverTimebyTSA.xlsx"
 )
@@ -89,10 +92,19 @@ class TexasFipsHospitalizationsUpdater(pydantic.BaseModel):
         return output
 
 
-if __name__ == "__main__":
+@click.command()
+def main():
     common_init.configure_logging()
     log = structlog.get_logger()
     updater = TexasFipsHospitalizationsUpdater.make_with_data_root(DATA_ROOT)
-    data = updater.update()
-    output_csv = DATA_ROOT / "states" / "tx" / "tx_fips_hospitalizations.csv"
-    common_df.write_csv(data, output_csv, log)
+    output_cache.write_if_changed(
+        OUTPUT_CSV,
+        [updater.hospitalizations_by_tsa_csv, updater.county_fips_csv, updater.tsa_to_fips_csv],
+        [pathlib.Path(__file__)],
+        lambda: common_df.write_csv(updater.update(), OUTPUT_CSV, log),
+        log,
+    )
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
@@ -1,5 +1,6 @@
 import enum
 import pathlib
+import click
 import pandas as pd
 import datetime
 import dateutil.parser
@@ -91,10 +92,15 @@ class TexasTraumaServiceAreaHospitalizationsUpdater(pydantic.BaseModel):
         ).reset_index()
 
 
-if __name__ == "__main__":
+@click.command()
+def main():
     common_init.configure_logging()
     log = structlog.get_logger()
     updater = TexasTraumaServiceAreaHospitalizationsUpdater.make_with_data_root(DATA_ROOT)
     data = updater.update()
     data.to_csv(updater.output_csv, index=False)
     log.info("Updated TSA Hospitalizations", output_csv=str(updater.output_csv))
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
@@ -11,4 +11,6 @@ setup(
     # Somewhat confusingly there is other code in this repo that is not installed by
     # setuptools. The dependencies of that code are listed in requirements.txt.
     install_requires=["pandas", "structlog", "structlog-sentry"],
+    # common_df.write_parquet and read_parquet need pyarrow.
+    extras_require={"parquet": ["pyarrow"]},
 )
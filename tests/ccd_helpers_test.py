@@ -1,9 +1,13 @@
 from typing import Dict, List
+import dataclasses
 import io
 import datetime
 from covidactnow.datapublic.common_fields import CommonFields
 from covidactnow.datapublic import common_df
+import numpy as np
 import pandas as pd
+import structlog
+import temppathlib
 
 from scripts import ccd_helpers
 
@@ -74,3 +78,212 @@ def test_query_multiple_variables():
     )
     expected = common_df.read_csv(expected_buf, set_index=False)
     pd.testing.assert_frame_equal(expected, results)
+
+
+def test_query_multiple_variables_selects_measurement_and_unit():
+    cumulative = ccd_helpers.ScraperVariable(
+        variable_name="cases",
+        measurement="cumulative",
+        unit="people",
+        provider="state",
+        common_field=CommonFields.CASES,
+    )
+    new = dataclasses.replace(cumulative, measurement="new")
+    by_age = dataclasses.replace(cumulative, age="0-17")
+    deaths = dataclasses.replace(
+        cumulative, variable_name="deaths", common_field=CommonFields.DEATHS
+    )
+    input_data = _build_can_scraper_dataframe(
+        {new: [1, 1], deaths: [2, 3], by_age: [4, 5], cumulative: [10, 11]}
+    )
+    # Shuffle the rows so the result doesn't depend on the order of the input.
+    data = ccd_helpers.CovidCountyDataset(input_data.sample(frac=1, random_state=1))
+    results = data.query_multiple_variables([cumulative, deaths])
+
+    expected_buf = io.StringIO(
+        "fips,date,aggregate_level,cases,deaths\n"
+        f"36,2021-01-01,state,10,2\n"
+        f"36,2021-01-02,state,11,3\n"
+    )
+    expected = common_df.read_csv(expected_buf, set_index=False)
+    pd.testing.assert_frame_equal(expected, results)
+
+    any_measurement = data._get_rows(dataclasses.replace(cumulative, measurement="", unit=""))
+    assert sorted(any_measurement[ccd_helpers.Fields.VALUE]) == [1, 1, 10, 11]
+
+
+def test_query_multiple_variables_reports_duplicates():
+    cases = ccd_helpers.ScraperVariable(
+        variable_name="cases",
+        measurement="cumulative",
+        unit="people",
+        provider="state",
+        common_field=CommonFields.CASES,
+    )
+    input_data = _build_can_scraper_dataframe({cases: [10, 11]})
+    duplicate = input_data.iloc[[1]].assign(value=12)
+    data = ccd_helpers.CovidCountyDataset(pd.concat([input_data, duplicate]))
+
+    with structlog.testing.capture_logs() as logs:
+        results = data.query_multiple_variables([cases])
+
+    # The duplicate is not averaged with the value of the same date.
+    assert list(results[CommonFields.CASES]) == [10, 12]
+    assert [l["event"] for l in logs] == ["Found duplicate values, keeping the last"]
+    assert logs[0]["count"] == 1
+    assert [r["value"] for r in logs[0]["rows"]] == [11, 12]
+
+
+def test_pivot_variables_matches_pivot_table():
+    rng = np.random.default_rng(1)
+    rows = 1000
+    columns = [CommonFields.DEATHS, CommonFields.CASES, CommonFields.NEW_CASES]
+    # Unique (location, date, location type, column) keys of each row.
+    keys = pd.DataFrame(
+        {
+            "location": rng.choice(["36", "06", "06075", "36061"], size=rows * 2),
+            "dt": pd.Timestamp("2021-01-01")
+            + pd.to_timedelta(rng.integers(0, 30, size=rows * 2), unit="D"),
+            "location_type": rng.choice(["state", "county"], size=rows * 2),
+            "column_position": rng.integers(0, 3, size=rows * 2),
+        }
+    ).drop_duplicates()
+    long_df = keys.assign(value=rng.random(len(keys)))
+    long_df.loc[long_df.sample(frac=0.1, random_state=1).index, "value"] = np.nan
+    long_df.loc[long_df.sample(frac=0.01, random_state=2).index, "dt"] = pd.NaT
+    column_positions = long_df.pop("column_position").to_numpy()
+
+    results = ccd_helpers.pivot_variables(long_df, column_positions, columns)
+
+    expected = (
+        long_df.assign(variable=np.array(columns, dtype=object)[column_positions])
+        .pivot_table(index=["location", "dt", "location_type"], columns="variable", values="value")
+        .reset_index()
+    )
+    expected.columns.name = None
+    pd.testing.assert_frame_equal(results, expected, check_column_type=False)
+
+    empty = ccd_helpers.pivot_variables(long_df.iloc[:0], column_positions[:0], columns)
+    assert list(empty.columns) == ["location", "dt", "location_type"]
+    assert empty.empty
+
+
+def test_query_multiple_variables_logs_provider_coverage():
+    cases = ccd_helpers.ScraperVariable(
+        variable_name="cases",
+        measurement="cumulative",
+        unit="people",
+        provider="state",
+        common_field=CommonFields.CASES,
+    )
+    deaths = dataclasses.replace(cases, variable_name="deaths", common_field=CommonFields.DEATHS)
+    new_deaths = dataclasses.replace(deaths, measurement="new")
+    deaths_by_age = dataclasses.replace(deaths, age="0-17")
+    hospitalized = dataclasses.replace(cases, variable_name="hospitalized")
+    cdc_cases = dataclasses.replace(cases, provider="cdc")
+    input_data = _build_can_scraper_dataframe(
+        {
+            cases: [1, 2],
+            new_deaths: [3, 4, 5],
+            deaths_by_age: [6],
+            hospitalized: [7, 8, 9, 10],
+            cdc_cases: [11],
+        }
+    )
+    data = ccd_helpers.CovidCountyDataset(input_data)
+
+    with structlog.testing.capture_logs() as logs:
+        data.query_multiple_variables([cases, deaths], log_provider_coverage_warnings=True)
+
+    assert [(l["event"], l.get("variable_name")) for l in logs] == [
+        ("Upstream has variable not in variables list", "hospitalized"),
+        ("No data rows found for variable", None),
+        ("Try these parameters", "deaths"),
+    ]
+    assert logs[0]["count"] == 4
+    assert logs[1]["variable"] == deaths
+    # Only rows with the same demographics as `deaths` are counted.
+    assert logs[2]["measurement_counts"] == "{'new': 3}"
+    assert logs[2]["unit_counts"] == "{'people': 3}"
+
+
+def test_read_parquet_filters_variables():
+    cases = ccd_helpers.ScraperVariable(
+        variable_name="cases",
+        measurement="cumulative",
+        unit="people",
+        provider="state",
+        common_field=CommonFields.CASES,
+    )
+    new_cases = dataclasses.replace(cases, measurement="new")
+    cdc_cases = dataclasses.replace(cases, provider="cdc")
+    deaths = dataclasses.replace(cases, variable_name="deaths")
+    input_data = _build_can_scraper_dataframe(
+        {cases: [1, 2], new_cases: [3], cdc_cases: [4], deaths: [5]}
+    )
+    input_data["extra_column"] = "dropped"
+
+    with temppathlib.NamedTemporaryFile(suffix=".parquet") as tmp:
+        input_data.to_parquet(tmp.path)
+        all_rows = ccd_helpers.read_parquet(tmp.path)
+        cases_rows = ccd_helpers.read_parquet(tmp.path, [cases])
+
+    assert list(all_rows.columns) == [f.value for f in ccd_helpers.Fields]
+    assert len(all_rows) == 5
+    # Rows of other measurements are kept so that they can be suggested by query hints.
+    assert sorted(cases_rows[ccd_helpers.Fields.VALUE]) == [1, 2, 3]
+
+
+def test_scan_parquet_in_small_batches():
+    cases = ccd_helpers.ScraperVariable(
+        variable_name="cases",
+        measurement="cumulative",
+        unit="people",
+        provider="state",
+        common_field=CommonFields.CASES,
+    )
+    cdc_cases = dataclasses.replace(cases, provider="cdc")
+    deaths = dataclasses.replace(cases, variable_name="deaths")
+    input_data = _build_can_scraper_dataframe({cases: [1, 2, 3], cdc_cases: [4, 5], deaths: [6]})
+
+    with temppathlib.NamedTemporaryFile(suffix=".parquet") as tmp:
+        input_data.to_parquet(tmp.path, row_group_size=2)
+        rows = ccd_helpers.scan_parquet(tmp.path, [cases, deaths], batch_rows=1)
+        no_rows = ccd_helpers.scan_parquet(tmp.path, [])
+
+    assert list(rows.columns) == [f.value for f in ccd_helpers.Fields]
+    assert sorted(rows[ccd_helpers.Fields.VALUE]) == [1, 2, 3, 6]
+    assert list(no_rows.columns) == [f.value for f in ccd_helpers.Fields]
+    assert no_rows.empty
+
+
+def test_read_reuses_dataset_of_same_file():
+    cases = ccd_helpers.ScraperVariable(
+        variable_name="cases",
+        measurement="cumulative",
+        unit="people",
+        provider="state",
+        common_field=CommonFields.CASES,
+    )
+    deaths = dataclasses.replace(cases, variable_name="deaths", common_field=CommonFields.DEATHS)
+    input_data = _build_can_scraper_dataframe({cases: [1, 2], deaths: [3, 4]})
+    input_data["location"] = 36
+
+    with temppathlib.TemporaryDirectory() as tmp_dir:
+        path = tmp_dir.path / "can_scrape.parquet"
+        input_data.to_parquet(path)
+        cases_dataset = ccd_helpers.CovidCountyDataset.read(path, [cases])
+        assert ccd_helpers.CovidCountyDataset.read(path, [cases]) is cases_dataset
+        assert len(cases_dataset.timeseries_df) == 2
+
+        all_dataset = ccd_helpers.CovidCountyDataset.read(path)
+        assert all_dataset is not cases_dataset
+        # Reads with a filter are served by the unfiltered dataset once it has been read.
+        assert ccd_helpers.CovidCountyDataset.read(path, [deaths]) is all_dataset
+
+        # Changing the file contents makes a new dataset.
+        input_data["value"] = input_data["value"] * 2
+        input_data.to_parquet(path)
+        assert ccd_helpers.CovidCountyDataset.read(path) is not all_dataset
+
+    assert set(all_dataset.timeseries_df["location"]) == {"36"}
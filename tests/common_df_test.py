@@ -1,3 +1,4 @@
+import gzip
 import io
 from io import StringIO
 import pandas as pd
@@ -246,3 +247,103 @@ def test_get_timeseries():
     # Check that getting a metric that isn't found returns EMPTY_TS
     assert common_df.get_timeseries(df, CommonFields.DEATHS, EMPTY_TS) is EMPTY_TS
     assert common_df.get_timeseries(df, "deaths", EMPTY_TS) is EMPTY_TS
+
+
+def test_read_csv_categorical_regions_round_trip():
+    input_csv = """fips,date,state,county,aggregate_level,cases
+06045,2020-04-01,CA,Mendocino County,county,234
+45,2020-04-02,SC,,state,456
+45123,2020-04-02,SC,Pickens County,county,
+"""
+    df = common_df.read_csv(StringIO(input_csv), categorical_regions=True)
+    assert df.index.get_level_values(CommonFields.FIPS).dtype == "category"
+    assert df[CommonFields.STATE].dtype == "category"
+    assert df[CommonFields.AGGREGATE_LEVEL].dtype == "category"
+    assert one(df.loc[df[CommonFields.STATE] == "CA", CommonFields.CASES]) == 234
+
+    # Reverse the order of the categories to check that rows are still written sorted by value.
+    df = df.reset_index()
+    df[CommonFields.FIPS] = df[CommonFields.FIPS].cat.reorder_categories(
+        df[CommonFields.FIPS].cat.categories[::-1]
+    )
+    df = df.set_index(COMMON_FIELDS_TIMESERIES_KEYS)
+
+    with temppathlib.NamedTemporaryFile("w+") as tmp, structlog.testing.capture_logs() as logs:
+        common_df.write_csv(df, tmp.path, structlog.get_logger())
+        assert input_csv == tmp.file.read()
+    assert [l["event"] for l in logs] == ["Writing DataFrame"]
+
+
+def test_write_parquet_round_trip():
+    input_csv = """fips,date,state,cases,positive_tests,extra
+45123,2020-04-02,SC,456,,b
+06045,2020-04-01,CA,234,0.0004,
+06045,2020-04-02,CA,,5e-05,a
+"""
+    df = common_df.read_csv(StringIO(input_csv), set_index=False)
+
+    with temppathlib.TemporaryDirectory() as tmp_dir, structlog.testing.capture_logs() as logs:
+        common_df.write_parquet(df, tmp_dir.path / "timeseries.parquet", structlog.get_logger())
+        results = common_df.read_parquet(tmp_dir.path / "timeseries.parquet")
+        results_without_index = common_df.read_parquet(
+            tmp_dir.path / "timeseries.parquet", set_index=False
+        )
+    assert [l["event"] for l in logs] == ["Fixing DataFrame index", "Writing DataFrame"]
+
+    expected = df.set_index(COMMON_FIELDS_TIMESERIES_KEYS).sort_index()
+    pd.testing.assert_frame_equal(results, expected)
+    pd.testing.assert_frame_equal(results_without_index, expected.reset_index())
+
+
+def test_write_csv_same_as_converting_all_columns():
+    df = pd.DataFrame(
+        {
+            CommonFields.FIPS: ["06045", "06045", "45123", "45123"],
+            CommonFields.DATE: pd.to_datetime(["2020-04-01", "2020-04-02"] * 2),
+            CommonFields.STATE: ["CA", "CA", "SC", None],
+            CommonFields.CASES: [1.0, 2.0, np.nan, 1_234_567_890_123.0],
+            CommonFields.DEATHS: [1, pd.NA, 2.5, None],
+            CommonFields.TOTAL_TESTS: [0.1, 1e-7, 2.0, np.nan],
+            CommonFields.POSITIVE_TESTS: pd.array([1, 2, None, 4], dtype="Int64"),
+            "extra_mixed": ["a", 1, pd.NA, 2.0],
+            "extra_bool": [True, False, True, False],
+        }
+    ).set_index(COMMON_FIELDS_TIMESERIES_KEYS)
+    df_original = df.copy()
+
+    with temppathlib.NamedTemporaryFile("w+") as tmp:
+        common_df.write_csv(df, tmp.path, structlog.get_logger())
+        results = tmp.file.read()
+
+    expected = common_df.sort_common_field_columns(df).replace({pd.NA: np.nan}).convert_dtypes()
+    expected_csv = expected.to_csv(date_format="%Y-%m-%d", index=True, float_format="%.12g")
+    assert results == expected_csv
+    assert "1234567890123" in results
+    pd.testing.assert_frame_equal(df, df_original)
+
+
+@pytest.mark.parametrize("chunk_rows", [1, 2, 100])
+def test_write_csv_chunked(chunk_rows):
+    input_csv = """fips,date,cases,extra
+06045,2020-04-01,234,a
+06045,2020-04-02,,
+45,2020-04-01,0.5,b
+45123,2020-04-02,456,
+"""
+    df = common_df.read_csv(StringIO(input_csv))
+
+    with temppathlib.TemporaryDirectory() as tmp_dir:
+        csv_path = tmp_dir.path / "timeseries.csv"
+        gz_path = tmp_dir.path / "timeseries.csv.gz"
+        common_df.write_csv(df, csv_path, structlog.get_logger(), chunk_rows=chunk_rows)
+        common_df.write_csv(df, gz_path, structlog.get_logger(), chunk_rows=chunk_rows)
+        assert csv_path.read_text() == input_csv
+        with gzip.open(gz_path, "rt") as f:
+            assert f.read() == input_csv
+
+
+def test_write_csv_chunked_empty():
+    df = pd.DataFrame([], columns=[CommonFields.DATE, CommonFields.FIPS, CommonFields.CASES])
+    with temppathlib.NamedTemporaryFile("w+") as tmp:
+        common_df.write_csv(df, tmp.path, structlog.get_logger(), chunk_rows=10)
+        assert "fips,date,cases\n" == tmp.file.read()
@@ -0,0 +1,215 @@
+import base64
+import gzip
+import hashlib
+import http.server
+import json
+import threading
+
+import pytest
+import requests
+import temppathlib
+
+from scripts import fetch_helpers
+
+
+class _SourceHandler(http.server.BaseHTTPRequestHandler):
+    """Serves `server.body` with an ETag, answering 304 when If-None-Match matches and 206 for a
+    Range with a matching If-Range. When `server.drop_after` is set the connection is closed
+    after sending that many bytes of the next body."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = self.server.body
+        if self.server.gzip:
+            # Like a gzip object in Google Cloud Storage, the hashes are of the compressed object.
+            body = gzip.compress(body)
+        etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+        md5 = base64.b64encode(hashlib.md5(body).digest()).decode()
+        self.server.requests.append(dict(self.headers))
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        start = 0
+        if self.headers.get("Range") and self.headers.get("If-Range") == etag:
+            start = int(self.headers["Range"].split("=")[1].rstrip("-"))
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}")
+        else:
+            self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", "Wed, 20 Jan 2021 00:00:00 GMT")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("x-goog-hash", f"crc32c=AAAAAA==, md5={self.server.md5 or md5}")
+        if self.server.gzip:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body) - start))
+        self.end_headers()
+        if self.server.drop_after is not None:
+            self.wfile.write(body[start : start + self.server.drop_after])
+            self.server.drop_after = None
+            self.close_connection = True
+            return
+        self.wfile.write(body[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def source_server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _SourceHandler)
+    server.body = b"fips,date,cases\n06075,2020-05-01,10\n"
+    server.requests = []
+    server.drop_after = None
+    server.md5 = None
+    server.gzip = False
+    server.daemon_threads = True
+    server.url = f"http://127.0.0.1:{server.server_port}/us-counties.csv"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetch_not_modified(source_server):
+    with temppathlib.TemporaryDirectory() as tmp:
+        path = tmp.path / "us-counties.csv"
+
+        result = fetch_helpers.fetch(source_server.url, path)
+        assert result.changed
+        assert result.bytes_downloaded == len(source_server.body)
+        assert path.read_bytes() == source_server.body
+        assert fetch_helpers.metadata_path(path).exists()
+        assert "If-None-Match" not in source_server.requests[-1]
+
+        result = fetch_helpers.fetch(source_server.url, path)
+        assert not result.changed
+        assert result.bytes_downloaded == 0
+        assert result.bytes_saved == len(source_server.body)
+        assert path.read_bytes() == source_server.body
+        assert source_server.requests[-1]["If-None-Match"]
+        assert source_server.requests[-1]["If-Modified-Since"] == "Wed, 20 Jan 2021 00:00:00 GMT"
+
+
+def test_fetch_not_modified_removes_partial_download(source_server):
+    with temppathlib.TemporaryDirectory() as tmp:
+        path = tmp.path / "us-counties.csv"
+        fetch_helpers.fetch(source_server.url, path)
+        # Left by an interrupted download of an earlier version.
+        path.with_name(path.name + ".part").write_bytes(b"fips,da")
+        path.with_name(path.name + ".part.json").write_text(
+            json.dumps({"url": source_server.url, "etag": '"old"'})
+        )
+
+        result = fetch_helpers.fetch(source_server.url, path)
+
+        assert not result.changed
+        assert path.read_bytes() == source_server.body
+        assert sorted(p.name for p in tmp.path.iterdir()) == [
+            "us-counties.csv",
+            "us-counties.csv.http.json",
+        ]
+
+
+def test_fetch_modified(source_server):
+    with temppathlib.TemporaryDirectory() as tmp:
+        path = tmp.path / "us-counties.csv"
+        fetch_helpers.fetch(source_server.url, path)
+
+        source_server.body += b"06075,2020-05-02,12\n"
+        result = fetch_helpers.fetch(source_server.url, path)
+        assert result.changed
+        assert result.bytes_saved == 0
+        assert path.read_bytes() == source_server.body
+        assert not path.with_name(path.name + ".part").exists()
+
+
+def test_fetch_unchanged_file_without_metadata(source_server):
+    with temppathlib.TemporaryDirectory() as tmp:
+        path = tmp.path / "us-counties.csv"
+        path.write_bytes(source_server.body)
+
+        result = fetch_helpers.fetch(source_server.url, path)
+        assert not result.changed
+        assert result.bytes_downloaded == len(source_server.body)
+
+
+def test_fetch_resumes_dropped_download(source_server, monkeypatch):
+    # Chunks that are completely received before the connection drops are kept.
+    monkeypatch.setattr(fetch_helpers, "DOWNLOAD_CHUNK_SIZE", 100)
+    source_server.body = bytes(range(256)) * 100
+    source_server.drop_after = 1000
+    with temppathlib.TemporaryDirectory() as tmp:
+        path = tmp.path / "data.parquet"
+
+        result = fetch_helpers.fetch(source_server.url, path)
+
+        assert path.read_bytes() == source_server.body
+        assert result.changed
+        assert result.bytes_downloaded == len(source_server.body) - 1000
+        assert "Range" not in source_server.requests[0]
+        assert source_server.requests[1]["Range"] == "bytes=1000-"
+        assert sorted(p.name for p in tmp.path.iterdir()) == [
+            "data.parquet",
+            "data.parquet.http.json",
+        ]
+
+
+def test_fetch_resumes_after_failed_call(source_server, monkeypatch):
+    # Chunks that are completely received before the connection drops are kept.
+    monkeypatch.setattr(fetch_helpers, "DOWNLOAD_CHUNK_SIZE", 100)
+    source_server.body = bytes(range(256)) * 100
+    source_server.drop_after = 1000
+    with temppathlib.TemporaryDirectory() as tmp:
+        path = tmp.path / "data.parquet"
+        with pytest.raises(requests.exceptions.ChunkedEncodingError):
+            fetch_helpers.fetch(source_server.url, path, attempts=1)
+        assert not path.exists()
+
+        fetch_helpers.fetch(source_server.url, path)
+        assert path.read_bytes() == source_server.body
+        assert source_server.requests[1]["Range"] == "bytes=1000-"
+
+
+def test_fetch_checksum_mismatch_keeps_old_file(source_server):
+    with temppathlib.TemporaryDirectory() as tmp:
+        path = tmp.path / "us-counties.csv"
+        fetch_helpers.fetch(source_server.url, path)
+        old_body = source_server.body
+
+        source_server.body += b"06075,2020-05-02,12\n"
+        source_server.md5 = base64.b64encode(hashlib.md5(b"other").digest()).decode()
+        with pytest.raises(fetch_helpers.DownloadVerificationError):
+            fetch_helpers.fetch(source_server.url, path)
+        assert path.read_bytes() == old_body
+        assert not path.with_name(path.name + ".part").exists()
+
+
+def test_fetch_content_encoding(source_server):
+    source_server.gzip = True
+    with temppathlib.TemporaryDirectory() as tmp:
+        path = tmp.path / "us-counties.csv"
+
+        result = fetch_helpers.fetch(source_server.url, path)
+
+        assert result.changed
+        assert path.read_bytes() == source_server.body
+
+
+def test_fetch_validate_failure_keeps_old_file(source_server):
+    def validate(part_path):
+        raise ValueError(f"Invalid {part_path.name}")
+
+    with temppathlib.TemporaryDirectory() as tmp:
+        path = tmp.path / "us-counties.csv"
+        fetch_helpers.fetch(source_server.url, path)
+        old_body = source_server.body
+
+        source_server.body += b"06075,2020-05-02,12\n"
+        with pytest.raises(ValueError, match="us-counties.csv.part"):
+            fetch_helpers.fetch(source_server.url, path, validate=validate)
+        assert path.read_bytes() == old_body
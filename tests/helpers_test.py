@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+import temppathlib
+
+from covidactnow.datapublic.common_fields import CommonFields
+from scripts import helpers
+
+
+def test_fips_from_int():
+    param = pd.Series([6, 36061, 6, 1001, 99999, 78], index=[5, 4, 3, 2, 1, 0], name="location")
+
+    results = helpers.fips_from_int(param)
+
+    expected = pd.Series(
+        ["06", "36061", "06", "01001", "99999", "78"], index=param.index, name="location"
+    )
+    pd.testing.assert_series_equal(results, expected)
+    # Same output as formatting every row.
+    pd.testing.assert_series_equal(results, param.apply(lambda v: f"{v:0>{2 if v < 100 else 5}}"))
+
+
+def test_fips_from_int_categorical():
+    param = pd.Series([1, 1001, np.nan])
+
+    results = helpers.fips_from_int(param, categorical=True)
+
+    assert results.dtype == "category"
+    assert list(results) == list(param.apply(lambda v: f"{v:0>{2 if v < 100 else 5}}"))
+
+
+def test_filter_start_dates():
+    start_dates = {"02": "2020-10-06", "04": "2020-09-02", "15": "2020-10-10"}
+    dates = pd.date_range("2020-08-25", "2020-10-15")
+    fips = ["02", "04", "15", "36", "02013", None]
+    df = pd.DataFrame(
+        {
+            CommonFields.FIPS: np.repeat(fips, len(dates)),
+            CommonFields.DATE: np.tile(dates, len(fips)),
+            CommonFields.CASES: np.arange(len(fips) * len(dates)),
+        }
+    ).sample(frac=1, random_state=1)
+    df.loc[df.sample(frac=0.05, random_state=2).index, CommonFields.DATE] = pd.NaT
+
+    results = helpers.filter_start_dates(df, "2020-09-01", start_dates)
+
+    # Same rows as filtering by the default and then each region with its own mask.
+    expected = df.loc[df[CommonFields.DATE] >= pd.to_datetime("2020-09-01")]
+    for region, start_date in start_dates.items():
+        expected = expected.loc[
+            (expected[CommonFields.FIPS] != region)
+            | (expected[CommonFields.DATE] >= pd.to_datetime(start_date))
+        ]
+    pd.testing.assert_frame_equal(results, expected)
+    assert results.loc[results[CommonFields.FIPS] == "02", CommonFields.DATE].min() == (
+        pd.Timestamp("2020-10-06")
+    )
+
+
+def test_region_metadata():
+    with temppathlib.TemporaryDirectory() as tmp:
+        county_fips_csv = tmp.path / "fips_population.csv"
+        county_fips_csv.write_text(
+            "fips,state,county,population\n"
+            "6075,CA,San Francisco County,881549\n"
+            "36061,NY,New York County,1628706\n"
+        )
+        census_state_path = tmp.path / "state.txt"
+        census_state_path.write_text(
+            "STATE|STUSAB|STATE_NAME|STATENS\n06|CA|California|01779778\n36|NY|New York|01779796\n"
+        )
+        region_metadata = helpers.load_region_metadata(county_fips_csv, census_state_path)
+        # The table is only read once.
+        assert helpers.load_region_metadata(county_fips_csv, census_state_path) is region_metadata
+
+    df = pd.DataFrame(
+        {
+            CommonFields.FIPS: ["06", "06075", "36061", "99999", "98"],
+            CommonFields.CASES: [1, 2, 3, 4, 5],
+        }
+    )
+    results = helpers.add_region_metadata(df, region_metadata)
+
+    expected = pd.DataFrame(
+        {
+            CommonFields.FIPS: ["06", "06075", "36061", "99999", "98"],
+            CommonFields.CASES: [1, 2, 3, 4, 5],
+            CommonFields.STATE: ["CA", "CA", "NY", np.nan, np.nan],
+            CommonFields.COUNTY: [
+                np.nan,
+                "San Francisco County",
+                "New York County",
+                np.nan,
+                np.nan,
+            ],
+            # Regions without metadata get their aggregate level from the FIPS length.
+            CommonFields.AGGREGATE_LEVEL: ["state", "county", "county", "county", "state"],
+        }
+    )
+    pd.testing.assert_frame_equal(results, expected, check_column_type=False)
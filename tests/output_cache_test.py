@@ -0,0 +1,103 @@
+import json
+import pathlib
+
+import structlog
+import temppathlib
+
+from scripts import output_cache
+
+
+def test_write_if_changed():
+    with temppathlib.TemporaryDirectory() as tmp, structlog.testing.capture_logs() as logs:
+        input_path = tmp.path / "raw" / "input.csv"
+        input_path.parent.mkdir()
+        input_path.write_text("a,b\n1,2\n")
+        code_path = tmp.path / "transform.py"
+        code_path.write_text("VERSION = 1\n")
+        output_path = tmp.path / "output.csv"
+        writes = []
+
+        def write_output():
+            writes.append(input_path.read_text())
+            output_path.write_text(input_path.read_text())
+
+        def update() -> bool:
+            return output_cache.write_if_changed(
+                output_path, [input_path], [code_path], write_output
+            )
+
+        assert not output_cache.is_up_to_date(output_path, [input_path], [code_path])
+        assert update()
+        assert output_cache.digest_path(output_path).exists()
+        assert output_cache.is_up_to_date(output_path, [input_path], [code_path])
+        # Same inputs and code, the output is not written again.
+        assert not update()
+        assert len(writes) == 1
+
+        input_path.write_text("a,b\n1,3\n")
+        assert not output_cache.is_up_to_date(output_path, [input_path], [code_path])
+        assert update()
+        assert not update()
+
+        code_path.write_text("VERSION = 2\n")
+        assert update()
+
+        output_path.unlink()
+        assert update()
+        assert len(writes) == 4
+
+    assert [l["event"] for l in logs] == [
+        "Inputs and code unchanged, skipping transform",
+        "Inputs or code changed",
+        "Inputs and code unchanged, skipping transform",
+        "Inputs or code changed",
+    ]
+    assert logs[1]["changed"] == ["raw/input.csv"]
+    assert [pathlib.PurePosixPath(name).name for name in logs[3]["changed"]] == ["transform.py"]
+
+
+def test_write_if_changed_code_with_same_name():
+    with temppathlib.TemporaryDirectory() as tmp, structlog.testing.capture_logs():
+        code_paths = [tmp.path / "a" / "helpers.py", tmp.path / "b" / "helpers.py"]
+        for code_path in code_paths:
+            code_path.parent.mkdir()
+            code_path.write_text("VERSION = 1\n")
+        output_path = tmp.path / "output.csv"
+
+        def update() -> bool:
+            return output_cache.write_if_changed(
+                output_path, [], code_paths, lambda: output_path.write_text("a\n")
+            )
+
+        assert update()
+        assert not update()
+        code_paths[0].write_text("VERSION = 2\n")
+        assert update()
+        code_paths[1].write_text("VERSION = 2\n")
+        assert update()
+
+
+def test_shared_code_is_relative_to_repo_root():
+    with temppathlib.TemporaryDirectory() as tmp, structlog.testing.capture_logs():
+        output_path = tmp.path / "output.csv"
+        output_cache.write_if_changed(output_path, [], [], lambda: output_path.write_text("a\n"))
+        digests = json.loads(output_cache.digest_path(output_path).read_text())
+    assert sorted(digests["code"]) == [
+        "covidactnow/datapublic/common_df.py",
+        "covidactnow/datapublic/common_fields.py",
+        "scripts/ccd_helpers.py",
+        "scripts/fetch_helpers.py",
+        "scripts/helpers.py",
+    ]
+
+
+def test_path_sha256_of_directory():
+    with temppathlib.TemporaryDirectory() as tmp:
+        (tmp.path / "a.csv").write_text("a")
+        digest = output_cache.path_sha256(tmp.path)
+        assert output_cache.path_sha256(tmp.path) == digest
+
+        (tmp.path / "b.csv").write_text("b")
+        assert output_cache.path_sha256(tmp.path) != digest
+        assert output_cache.path_sha256(tmp.path / "missing") is None
+
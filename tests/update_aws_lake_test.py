@@ -1,7 +1,27 @@
+import datetime
+import hashlib
+import io
+import json
+import pathlib
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+import botocore.exceptions
+import click.testing
+import pandas as pd
 import pytest
 import structlog
+import temppathlib
 
-from scripts.update_aws_lake import AwsDataLakeTransformer, DATA_ROOT, AwsDataLakeCopier
+from covidactnow.datapublic.common_fields import COMMON_LEGACY_REGION_FIELDS
+from scripts.update_aws_lake import (
+    AwsDataLakeTransformer,
+    DATA_ROOT,
+    AwsDataLakeCopier,
+    Fields,
+    main,
+    update_sources,
+)
 
 
 @pytest.mark.skip(
@@ -24,3 +44,373 @@ def test_load_something_from_google_survey():
     assert not df.empty
     assert df.at[("06075", "2020-05-01"), "smoothed_cli"] > 0
     assert df.at[("45", "2020-05-01"), "smoothed_cli"] > 0
+
+
+class FailingBody(io.BytesIO):
+    """A response body raising `exception` after the first read, like a broken connection."""
+
+    def __init__(self, body: bytes, exception: Exception):
+        super().__init__(body)
+        self.exception = exception
+        self.reads = 0
+
+    def read(self, size=-1):
+        self.reads += 1
+        if self.reads > 1:
+            raise self.exception
+        return super().read(1)
+
+
+def _read_timeout(key: str) -> Exception:
+    return botocore.exceptions.ReadTimeoutError(endpoint_url=f"s3://bucket/{key}")
+
+
+def _client_error(code: str, status_code: int) -> Callable[[str], Exception]:
+    def make_error(key: str) -> Exception:
+        response = {"Error": {"Code": code}, "ResponseMetadata": {"HTTPStatusCode": status_code}}
+        return botocore.exceptions.ClientError(response, "GetObject")
+
+    return make_error
+
+
+class FakeS3Client:
+    """Implements the parts of an S3 client used by AwsDataLakeCopier, with objects in memory."""
+
+    def __init__(
+        self,
+        objects: Dict[str, bytes],
+        failures: Optional[Dict[str, int]] = None,
+        make_error: Callable[[str], Exception] = _read_timeout,
+    ):
+        self.objects = objects
+        # Number of times get_object fails for a key before succeeding. A ClientError, made by
+        # `make_error`, is raised by get_object and other errors while reading the body.
+        self.failures = failures or {}
+        self.make_error = make_error
+        self.get_object_keys = []
+        self._lock = threading.Lock()
+
+    def get_paginator(self, operation_name):
+        assert operation_name == "list_objects"
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        keys = sorted(k for k in self.objects if k.startswith(Prefix))
+        # Two pages to check that all pages are read.
+        for page_keys in [keys[:2], keys[2:]]:
+            yield {"Contents": [self._list_entry(k) for k in page_keys]}
+
+    def _list_entry(self, key):
+        body = self.objects[key]
+        return {
+            "Key": key,
+            "ETag": f'"{hashlib.md5(body).hexdigest()}"',
+            "LastModified": datetime.datetime(2020, 11, 1, tzinfo=datetime.timezone.utc),
+            "Size": len(body),
+        }
+
+    def get_object(self, Bucket, Key):
+        with self._lock:
+            self.get_object_keys.append(Key)
+            failing = self.failures.get(Key, 0) > 0
+            if failing:
+                self.failures[Key] -= 1
+        if failing:
+            error = self.make_error(Key)
+            if isinstance(error, botocore.exceptions.ClientError):
+                raise error
+            return {"Body": FailingBody(self.objects[Key], error)}
+        return {"Body": io.BytesIO(self.objects[Key])}
+
+
+def _make_covidcast_objects() -> Dict[str, bytes]:
+    return {
+        "covidcast/json/data/fb-survey/part-00000.json": b'{"signal":"a"}\n',
+        "covidcast/json/data/fb-survey/part-00001.json": b'{"signal":"b"}\n',
+        "covidcast/json/data/jhu-csse/part-00000.json": b'{"signal":"c"}\n',
+        "covidcast/json/data/google-survey/part-00000.json": b'{"signal":"d"}\n' * 1000,
+        "covidcast/json/metadata/metadata.json": b"{}\n",
+    }
+
+
+def test_replace_local_mirror_downloads_in_parallel_with_retries():
+    s3 = FakeS3Client(
+        _make_covidcast_objects(), failures={"covidcast/json/data/fb-survey/part-00001.json": 2}
+    )
+    with temppathlib.TemporaryDirectory() as tmp, structlog.testing.capture_logs() as logs:
+        copier = AwsDataLakeCopier(
+            local_mirror_dir=tmp.path / "mirror",
+            s3=s3,
+            log=structlog.get_logger(),
+            download_workers=3,
+        )
+        copier.replace_local_mirror()
+
+        assert {name: sorted(p.name for p in paths) for name, paths in copier.get_sources()} == {
+            "fb-survey": ["part-00000.json", "part-00001.json"],
+            "google-survey": ["part-00000.json"],
+        }
+        assert (tmp.path / "mirror" / "fb-survey" / "part-00001.json").read_bytes() == (
+            b'{"signal":"b"}\n'
+        )
+        assert not list((tmp.path / "mirror").glob("*/*.tmp"))
+
+    assert s3.get_object_keys.count("covidcast/json/data/fb-survey/part-00001.json") == 3
+    assert [l["attempt"] for l in logs if l["event"] == "Retrying download"] == [1, 2]
+    progress = [l for l in logs if l["event"] == "Download progress"]
+    assert progress[-1]["files"] == 3
+
+
+@pytest.mark.parametrize(
+    "make_error",
+    [_client_error("SlowDown", 503), lambda key: OSError(28, "No space left on device")],
+)
+def test_replace_local_mirror_retries_throttling_and_os_errors(make_error):
+    key = "covidcast/json/data/fb-survey/part-00001.json"
+    s3 = FakeS3Client(_make_covidcast_objects(), failures={key: 2}, make_error=make_error)
+    with temppathlib.TemporaryDirectory() as tmp, structlog.testing.capture_logs() as logs:
+        copier = AwsDataLakeCopier(
+            local_mirror_dir=tmp.path / "mirror", s3=s3, log=structlog.get_logger()
+        )
+        copier.replace_local_mirror()
+
+        assert (tmp.path / "mirror" / "fb-survey" / "part-00001.json").read_bytes() == (
+            b'{"signal":"b"}\n'
+        )
+    assert s3.get_object_keys.count(key) == 3
+    assert [l["attempt"] for l in logs if l["event"] == "Retrying download"] == [1, 2]
+
+
+@pytest.mark.parametrize(
+    "make_error,failures,expected_exception,expected_attempts",
+    [
+        (_read_timeout, 3, botocore.exceptions.ReadTimeoutError, 3),
+        (_client_error("AccessDenied", 403), 1, botocore.exceptions.ClientError, 1),
+    ],
+)
+def test_replace_local_mirror_raises_after_retries(
+    make_error, failures, expected_exception, expected_attempts
+):
+    key = "covidcast/json/data/fb-survey/part-00000.json"
+    s3 = FakeS3Client(_make_covidcast_objects(), failures={key: failures}, make_error=make_error)
+    with temppathlib.TemporaryDirectory() as tmp, structlog.testing.capture_logs():
+        copier = AwsDataLakeCopier(
+            local_mirror_dir=tmp.path / "mirror", s3=s3, log=structlog.get_logger()
+        )
+        with pytest.raises(expected_exception):
+            copier.replace_local_mirror()
+
+        # The partial download is removed rather than left in the mirror.
+        assert not (tmp.path / "mirror" / "fb-survey" / "part-00000.json").exists()
+        assert not list((tmp.path / "mirror").glob("*/*.tmp"))
+    assert s3.get_object_keys.count(key) == expected_attempts
+
+
+def test_sync_local_mirror_downloads_only_changed_files():
+    objects = _make_covidcast_objects()
+    s3 = FakeS3Client(objects)
+    with temppathlib.TemporaryDirectory() as tmp, structlog.testing.capture_logs() as logs:
+        copier = AwsDataLakeCopier(
+            local_mirror_dir=tmp.path / "mirror", s3=s3, log=structlog.get_logger()
+        )
+        copier.sync_local_mirror()
+        assert len(s3.get_object_keys) == 3
+
+        s3.get_object_keys.clear()
+        objects["covidcast/json/data/fb-survey/part-00001.json"] = b'{"signal":"changed"}\n'
+        objects["covidcast/json/data/fb-survey/part-00002.json"] = b'{"signal":"new"}\n'
+        del objects["covidcast/json/data/google-survey/part-00000.json"]
+        copier.sync_local_mirror()
+
+        assert sorted(s3.get_object_keys) == [
+            "covidcast/json/data/fb-survey/part-00001.json",
+            "covidcast/json/data/fb-survey/part-00002.json",
+        ]
+        assert {name: sorted(p.name for p in paths) for name, paths in copier.get_sources()} == {
+            "fb-survey": ["part-00000.json", "part-00001.json", "part-00002.json"],
+        }
+        assert (tmp.path / "mirror" / "fb-survey" / "part-00001.json").read_bytes() == (
+            b'{"signal":"changed"}\n'
+        )
+
+        s3.get_object_keys.clear()
+        copier.sync_local_mirror()
+        assert s3.get_object_keys == []
+
+    finished = [l for l in logs if l["event"] == "Finished sync of local mirror directory"]
+    assert [(l["downloaded_files"], l["removed_files"]) for l in finished] == [
+        (3, 0),
+        (2, 1),
+        (0, 0),
+    ]
+
+
+def test_sync_local_mirror_removes_files_not_in_bucket_without_manifest():
+    s3 = FakeS3Client(_make_covidcast_objects())
+    with temppathlib.TemporaryDirectory() as tmp, structlog.testing.capture_logs() as logs:
+        mirror_dir = tmp.path / "mirror"
+        # Files from before the first manifest and from an interrupted sync.
+        (mirror_dir / "fb-survey").mkdir(parents=True)
+        (mirror_dir / "fb-survey" / "part-00000.json").write_text('{"signal":"old"}\n')
+        (mirror_dir / "fb-survey" / "part-00009.json").write_text('{"signal":"removed"}\n')
+        (mirror_dir / "fb-survey" / "part-00001.json.tmp").write_text('{"sig')
+        (mirror_dir / "old-source").mkdir()
+        (mirror_dir / "old-source" / "part-00000.json").write_text('{"signal":"removed"}\n')
+        copier = AwsDataLakeCopier(local_mirror_dir=mirror_dir, s3=s3, log=structlog.get_logger())
+
+        copier.sync_local_mirror()
+
+        assert {name: sorted(p.name for p in paths) for name, paths in copier.get_sources()} == {
+            "fb-survey": ["part-00000.json", "part-00001.json"],
+            "google-survey": ["part-00000.json"],
+        }
+        assert (mirror_dir / "fb-survey" / "part-00000.json").read_bytes() == b'{"signal":"a"}\n'
+        assert sorted(p.name for p in (mirror_dir / "fb-survey").iterdir()) == [
+            "part-00000.json",
+            "part-00001.json",
+        ]
+
+    finished = [l for l in logs if l["event"] == "Finished sync of local mirror directory"]
+    assert [(l["downloaded_files"], l["removed_files"]) for l in finished] == [(3, 3)]
+
+
+def _write_covidcast_part(path: pathlib.Path, rows: List[Dict[str, Any]]):
+    path.write_text("".join(json.dumps(row) + "\n" for row in rows))
+
+
+@pytest.mark.parametrize("parse_workers", [1, 2])
+def test_load_json_lines(parse_workers):
+    def row(geo_value, time_value, value, **extra):
+        return dict(
+            geo_value=geo_value,
+            signal="smoothed_cli",
+            time_value=time_value,
+            direction=None,
+            sample_size=100,
+            stderr=0.5,
+            time_type="day",
+            geo_type="county",
+            value=value,
+            data_source="fb-survey",
+            **extra,
+        )
+
+    with temppathlib.TemporaryDirectory() as tmp, structlog.testing.capture_logs() as logs:
+        _write_covidcast_part(
+            tmp.path / "part-00000.json", [row(6075, 20200501, 1.5), row(6075, 20200502, 2.5)]
+        )
+        _write_covidcast_part(
+            tmp.path / "part-00001.json", [row(45, 20200501, 3.5, new_field="surprise")]
+        )
+        transformer = AwsDataLakeTransformer(
+            geo_fields_to_common_fields=pd.DataFrame(), parse_workers=parse_workers
+        )
+        df = transformer._load_json_lines(structlog.get_logger(), sorted(tmp.path.glob("*.json")))
+
+    assert list(df.columns) == list(Fields)
+    assert df[Fields.TIME_VALUE].tolist() == [
+        pd.Timestamp("2020-05-01"),
+        pd.Timestamp("2020-05-02"),
+        pd.Timestamp("2020-05-01"),
+    ]
+    assert df[Fields.VALUE].tolist() == [1.5, 2.5, 3.5]
+    assert df[Fields.GEO_VALUE].tolist() == [6075, 6075, 45]
+    assert df[Fields.SIGNAL].dtype == "category"
+    assert df[Fields.GEO_TYPE].tolist() == ["county", "county", "county"]
+    assert [(l["event"], l["unknown_fields"]) for l in logs] == [
+        ("Found unknown fields. Did the structure of the JSON change?", {"new_field"})
+    ]
+
+
+def test_make_column_per_signal():
+    input_df = pd.DataFrame(
+        [
+            ("county", 6075, "day", "2020-05-01", "sig_a", 1.0),
+            ("county", 6075, "day", "2020-05-01", "sig_b", 2.0),
+            ("county", 6075, "day", "2020-05-02", "sig_b", 4.0),
+            ("county", 1001, "day", "2020-05-01", "sig_a", 5.0),
+            # Duplicates of the first row. The last value that is not missing is kept.
+            ("county", 6075, "day", "2020-05-01", "sig_a", 3.0),
+            ("county", 6075, "day", "2020-05-01", "sig_a", None),
+        ],
+        columns=[
+            Fields.GEO_TYPE,
+            Fields.GEO_VALUE,
+            Fields.TIME_TYPE,
+            Fields.TIME_VALUE,
+            Fields.SIGNAL,
+            Fields.VALUE,
+        ],
+    )
+    input_df[Fields.TIME_VALUE] = pd.to_datetime(input_df[Fields.TIME_VALUE])
+    transformer = AwsDataLakeTransformer(geo_fields_to_common_fields=pd.DataFrame())
+
+    with structlog.testing.capture_logs() as logs:
+        df = transformer._make_column_per_signal(input_df, structlog.get_logger())
+
+    expected = pd.DataFrame(
+        [
+            ("county", 1001, "day", "2020-05-01", 5.0, None),
+            ("county", 6075, "day", "2020-05-01", 3.0, 2.0),
+            ("county", 6075, "day", "2020-05-02", None, 4.0),
+        ],
+        columns=[
+            Fields.GEO_TYPE,
+            Fields.GEO_VALUE,
+            Fields.TIME_TYPE,
+            Fields.TIME_VALUE,
+            "sig_a",
+            "sig_b",
+        ],
+    )
+    expected[Fields.TIME_VALUE] = pd.to_datetime(expected[Fields.TIME_VALUE])
+    expected[["sig_a", "sig_b"]] = expected[["sig_a", "sig_b"]].astype(float)
+    pd.testing.assert_frame_equal(df, expected)
+    assert [(l["event"], l["count"], len(l["rows"])) for l in logs] == [
+        ("Found duplicate values", 1, 3)
+    ]
+
+
+@pytest.mark.parametrize("jobs,parse_workers", [(1, 1), (2, 1), (2, 2)])
+def test_update_sources_isolates_failures(jobs, parse_workers):
+    geo_fields_to_common_fields = pd.DataFrame(
+        [("county", 6075, "06075", "CA", "USA", "San Francisco County", "county")],
+        columns=[Fields.GEO_TYPE, Fields.GEO_VALUE] + COMMON_LEGACY_REGION_FIELDS,
+    ).set_index([Fields.GEO_TYPE, Fields.GEO_VALUE])
+    transformer = AwsDataLakeTransformer(
+        geo_fields_to_common_fields=geo_fields_to_common_fields, parse_workers=parse_workers
+    )
+    row = dict(
+        geo_value="06075",
+        signal="smoothed_cli",
+        time_value=20200501,
+        time_type="day",
+        geo_type="county",
+        value=1.5,
+    )
+
+    with temppathlib.TemporaryDirectory() as tmp, structlog.testing.capture_logs() as logs:
+        _write_covidcast_part(tmp.path / "good.json", [row])
+        (tmp.path / "bad.json").write_text("{not json\n")
+        sources = [
+            ("bad-source", [tmp.path / "bad.json"]),
+            ("good-source", [tmp.path / "good.json"]),
+        ]
+
+        failed_sources = update_sources(transformer, sources, tmp.path, jobs=jobs)
+
+        assert failed_sources == ["bad-source"]
+        assert not (tmp.path / "timeseries-bad-source.csv").exists()
+        assert (tmp.path / "timeseries-good-source.csv").read_text() == (
+            "fips,date,state,country,county,aggregate_level,smoothed_cli\n"
+            "06075,2020-05-01,CA,USA,San Francisco County,county,1.5\n"
+        )
+    assert [l["source_name"] for l in logs if l["event"] == "Failed to update source"] == [
+        "bad-source"
+    ]
+
+
+def test_main_rejects_jobs_with_parse_workers():
+    result = click.testing.CliRunner().invoke(main, ["--jobs", "2", "--parse-workers", "2"])
+    assert result.exit_code == 2
+    assert "--jobs and --parse-workers can't both be more than 1" in result.output
@@ -1,7 +1,10 @@
 import io
+import shutil
 
 import pytest
 import pandas as pd
+import structlog
+import temppathlib
 
 from covidactnow.datapublic import common_df
 from scripts import update_nytimes_data
@@ -62,6 +65,31 @@ def test_remove_ct_cases(is_ct_county):
     pd.testing.assert_series_equal(expected_cases, results.cases)
 
 
+def test_remove_state_backfill_weighted_by_county_new_cases():
+    backfill_records = [("09", "2020-07-24", 100), ("09", "2020-07-25", 30)]
+    data_buf = io.StringIO(
+        "fips,state,date,aggregate_level,cases\n"
+        "09001,CT,2020-07-23,county,100\n"
+        "09001,CT,2020-07-24,county,175\n"
+        "09001,CT,2020-07-25,county,190\n"
+        "09003,CT,2020-07-23,county,50\n"
+        "09003,CT,2020-07-24,county,75\n"
+        "09003,CT,2020-07-25,county,90\n"
+        "09999,CT,2020-07-24,county,7\n"
+        "09,CT,2020-07-23,state,150\n"
+        "09,CT,2020-07-24,state,257\n"
+        "09,CT,2020-07-25,state,287\n"
+    )
+    data = common_df.read_csv(data_buf, set_index=False)
+
+    results = update_nytimes_data.remove_state_backfilled_cases(data, backfill_records)
+
+    # Backfills are split between counties by their new cases on the date of the backfill and
+    # subtracted from all following dates. Unknown county 09999 is not adjusted.
+    expected_cases = pd.Series([100, 100, 100, 50, 50, 50, 7, 150, 157, 157], name="cases")
+    pd.testing.assert_series_equal(results.cases, expected_cases)
+
+
 def test_remove_county_backfill():
 
     backfill = [("48113", "2020-08-17", 500)]
@@ -131,3 +159,141 @@ def test_remove_ma_county_cases():
     )
     expected = common_df.read_csv(data_buf, set_index=False)
     pd.testing.assert_frame_equal(results, expected)
+
+
+def _write_nytimes_raw_files(updater: NYTimesUpdater, counties_csv: str, states_csv: str):
+    updater.county_path.write_text("date,county,state,fips,cases,deaths\n" + counties_csv)
+    updater.state_path.write_text("date,state,fips,cases,deaths\n" + states_csv)
+
+
+def test_update_nytimes_incremental_matches_full_rebuild():
+    counties = (
+        "2020-07-23,Fairfield,Connecticut,09001,100,1\n"
+        "2020-07-24,Fairfield,Connecticut,09001,175,1\n"
+        "2020-07-23,New Haven,Connecticut,09009,50,\n"
+        "2020-07-24,New Haven,Connecticut,09009,75,2\n"
+        "2020-07-23,New York City,New York,,500,10\n"
+        "2020-07-24,New York City,New York,,510,10\n"
+        "2020-07-23,Albany,New York,36001,20,1\n"
+        "2020-07-24,Albany,New York,36001,21,1\n"
+    )
+    states = (
+        "2020-07-23,Connecticut,09,150,1\n"
+        "2020-07-24,Connecticut,09,257,3\n"
+        "2020-07-23,New York,36,520,11\n"
+        "2020-07-24,New York,36,531,11\n"
+    )
+    # The new version revises Albany on 7/24 and adds 7/25.
+    new_counties = counties.replace(
+        "2020-07-24,Albany,New York,36001,21", "2020-07-24,Albany,New York,36001,22"
+    ) + (
+        "2020-07-25,Fairfield,Connecticut,09001,190,1\n"
+        "2020-07-25,New Haven,Connecticut,09009,90,2\n"
+        "2020-07-25,New York City,New York,,530,11\n"
+        "2020-07-25,Albany,New York,36001,25,1\n"
+    )
+    new_states = states.replace("2020-07-24,New York,36,531", "2020-07-24,New York,36,532") + (
+        "2020-07-25,Connecticut,09,287,3\n" "2020-07-25,New York,36,555,12\n"
+    )
+    log = structlog.get_logger()
+
+    with temppathlib.TemporaryDirectory() as tmp:
+        (tmp.path / "misc").mkdir()
+        shutil.copy(DATA_ROOT / "misc" / "state.txt", tmp.path / "misc" / "state.txt")
+        updater = NYTimesUpdater.make_with_data_root(tmp.path)
+        updater.raw_data_root.mkdir()
+
+        _write_nytimes_raw_files(updater, counties, states)
+        previous_data = updater.load_state_and_county_data()
+        common_df.write_csv(
+            updater.transform(previous_data.copy()), updater.timeseries_output_path, log
+        )
+
+        _write_nytimes_raw_files(updater, new_counties, new_states)
+        incremental = updater.transform_incrementally(
+            previous_data, updater.load_state_and_county_data()
+        )
+        full = updater.transform(updater.load_state_and_county_data())
+
+        incremental_path = tmp.path / "incremental.csv"
+        full_path = tmp.path / "full.csv"
+        common_df.write_csv(incremental, incremental_path, log)
+        common_df.write_csv(full, full_path, log)
+        assert incremental_path.read_text() == full_path.read_text()
+        assert "2020-07-25" in full_path.read_text()
+
+
+def test_update_nytimes_incremental_only_when_output_is_up_to_date(monkeypatch):
+    counties = (
+        "2020-07-23,Albany,New York,36001,20,1\n"
+        "2020-07-24,Albany,New York,36001,21,1\n"
+        "2020-07-23,Fairfield,Connecticut,09001,100,1\n"
+        "2020-07-24,Fairfield,Connecticut,09001,175,1\n"
+    )
+    states = (
+        "2020-07-23,Connecticut,09,100,1\n"
+        "2020-07-24,Connecticut,09,175,1\n"
+        "2020-07-23,New York,36,20,1\n"
+        "2020-07-24,New York,36,21,1\n"
+    )
+    revised_counties = counties.replace(
+        "2020-07-24,Fairfield,Connecticut,09001,175", "2020-07-24,Fairfield,Connecticut,09001,180"
+    )
+    versions = [
+        (counties, states),
+        (counties + "2020-07-25,Albany,New York,36001,25,1\n", states),
+        (counties + "2020-07-25,Albany,New York,36001,26,1\n", states),
+        (revised_counties + "2020-07-25,Albany,New York,36001,27,1\n", states),
+    ]
+    incremental_calls = []
+    transform_incrementally = NYTimesUpdater.transform_incrementally
+
+    def recording_transform_incrementally(self, previous_data, data):
+        incremental_calls.append(len(data))
+        return transform_incrementally(self, previous_data, data)
+
+    monkeypatch.setattr(
+        NYTimesUpdater, "transform_incrementally", recording_transform_incrementally
+    )
+    monkeypatch.setattr(NYTimesUpdater, "is_new_data_available", lambda self: True)
+
+    with temppathlib.TemporaryDirectory() as tmp:
+        (tmp.path / "misc").mkdir()
+        shutil.copy(DATA_ROOT / "misc" / "state.txt", tmp.path / "misc" / "state.txt")
+        updater = NYTimesUpdater.make_with_data_root(tmp.path)
+        updater.raw_data_root.mkdir()
+        code_path = tmp.path / "update_nytimes_data.py"
+        code_path.write_text("VERSION = 1\n")
+        fetched_versions = iter(versions[1:])
+        monkeypatch.setattr(
+            NYTimesUpdater,
+            "update_source_data",
+            lambda self: _write_nytimes_raw_files(self, *next(fetched_versions)),
+        )
+
+        def update():
+            update_nytimes_data.update(
+                updater, fetch=True, incremental=True, code_paths=[code_path]
+            )
+            full = updater.transform(updater.load_state_and_county_data())
+            full_path = tmp.path / "full.csv"
+            common_df.write_csv(full, full_path, structlog.get_logger())
+            assert updater.timeseries_output_path.read_text() == full_path.read_text()
+
+        _write_nytimes_raw_files(updater, *versions[0])
+        update_nytimes_data.update(updater, fetch=False, incremental=False, code_paths=[code_path])
+
+        # The output is up to date with the raw data and code so only changes are transformed.
+        update()
+        assert len(incremental_calls) == 1
+
+        # The code changed since the output was written.
+        code_path.write_text("VERSION = 2\n")
+        update()
+        assert len(incremental_calls) == 1
+
+        # The raw data was replaced without writing the output, as if the last update failed
+        # after fetching. Connecticut is unchanged by the next fetch but the output is stale.
+        _write_nytimes_raw_files(updater, revised_counties, states)
+        update()
+        assert len(incremental_calls) == 1
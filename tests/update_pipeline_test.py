@@ -0,0 +1,129 @@
+import multiprocessing
+
+import click
+import pytest
+
+from scripts import update_pipeline
+from scripts.update_pipeline import Node
+from scripts.update_pipeline import NodeStatus
+
+
+# Runs the pipeline's own click command with --help, which succeeds without side effects.
+_OK_MODULE, _OK_ARGS = "scripts.update_pipeline", ("--help",)
+_FAILING_MODULE = "scripts.module_that_does_not_exist"
+
+# Module state set by one node, which must not be visible to nodes run later.
+_STATE = {}
+
+
+def _child_process():
+    pass
+
+
+@click.command()
+@click.option("--set-state", is_flag=True)
+@click.option("--start-child", is_flag=True)
+@click.option("--exit-code", type=int)
+@click.pass_context
+def main(ctx, set_state: bool, start_child: bool, exit_code: int):
+    if _STATE:
+        raise ValueError(f"State leaked from another node: {_STATE}")
+    if set_state:
+        _STATE["set"] = True
+    if start_child:
+        # Fails if the node runs in a daemon process.
+        child = multiprocessing.Process(target=_child_process)
+        child.start()
+        child.join()
+        if child.exitcode != 0:
+            raise ValueError(f"Child exited with code {child.exitcode}")
+    if exit_code is not None:
+        ctx.exit(exit_code)
+
+
+def test_build_dependencies():
+    nodes = [
+        Node("tsa", _OK_MODULE, outputs=("states/tx/tsa.csv",)),
+        Node("fips", _OK_MODULE, inputs=("states/tx/tsa.csv",), outputs=("states/tx/fips.csv",)),
+        Node("dir-reader", _OK_MODULE, inputs=("states/tx",)),
+        Node("other", _OK_MODULE, outputs=("other",)),
+    ]
+    assert update_pipeline.build_dependencies(nodes) == {
+        "tsa": set(),
+        "fips": {"tsa"},
+        "dir-reader": {"tsa", "fips"},
+        "other": set(),
+    }
+
+
+def test_build_dependencies_cycle():
+    nodes = [
+        Node("a", _OK_MODULE, inputs=("b.csv",), outputs=("a.csv",)),
+        Node("b", _OK_MODULE, inputs=("a.csv",), outputs=("b.csv",)),
+    ]
+    with pytest.raises(ValueError, match="cycle"):
+        update_pipeline.build_dependencies(nodes)
+
+
+def test_update_sh_nodes_are_valid():
+    dependencies = update_pipeline.build_dependencies(update_pipeline.NODES)
+    assert dependencies["texas-fips-hospitalizations"] == {"texas-tsa-hospitalizations"}
+
+
+def test_run_pipeline_non_fatal_failure_continues():
+    nodes = [
+        Node("source", _FAILING_MODULE, outputs=("source.csv",), fatal=False),
+        Node("user", _OK_MODULE, _OK_ARGS, inputs=("source.csv",)),
+        Node("independent", _OK_MODULE, _OK_ARGS),
+    ]
+    results = update_pipeline.run_pipeline(nodes, jobs=2)
+    assert [(r.name, r.status) for r in results] == [
+        ("source", NodeStatus.FAILED),
+        ("user", NodeStatus.SUCCEEDED),
+        ("independent", NodeStatus.SUCCEEDED),
+    ]
+    assert "independent" in update_pipeline.format_timing_table(results)
+
+
+def test_run_pipeline_fatal_failure_stops():
+    nodes = [
+        Node("source", _FAILING_MODULE, outputs=("source.csv",)),
+        Node("user", _OK_MODULE, _OK_ARGS, inputs=("source.csv",)),
+    ]
+    results = update_pipeline.run_pipeline(nodes, jobs=1)
+    assert [(r.name, r.status) for r in results] == [
+        ("source", NodeStatus.FAILED),
+        ("user", NodeStatus.SKIPPED),
+    ]
+
+
+def test_run_pipeline_module_state_does_not_leak():
+    nodes = [
+        Node("first", __name__, ("--set-state",), outputs=("first.csv",)),
+        Node("second", __name__, inputs=("first.csv",)),
+    ]
+    results = update_pipeline.run_pipeline(nodes, jobs=1)
+    assert [(r.name, r.status) for r in results] == [
+        ("first", NodeStatus.SUCCEEDED),
+        ("second", NodeStatus.SUCCEEDED),
+    ]
+
+
+def test_run_pipeline_exit_code():
+    nodes = [
+        Node("exit-0", __name__, ("--exit-code", "0")),
+        Node("exit-1", __name__, ("--exit-code", "1"), outputs=("exit-1.csv",)),
+        Node("user", _OK_MODULE, _OK_ARGS, inputs=("exit-1.csv",)),
+    ]
+    results = update_pipeline.run_pipeline(nodes, jobs=1)
+    assert [(r.name, r.status) for r in results] == [
+        ("exit-0", NodeStatus.SUCCEEDED),
+        ("exit-1", NodeStatus.FAILED),
+        ("user", NodeStatus.SKIPPED),
+    ]
+
+
+def test_run_pipeline_node_starts_process():
+    nodes = [Node("parent", __name__, ("--start-child",))]
+    results = update_pipeline.run_pipeline(nodes, jobs=1)
+    assert [(r.name, r.status) for r in results] == [("parent", NodeStatus.SUCCEEDED)]